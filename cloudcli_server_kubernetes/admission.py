@@ -0,0 +1,65 @@
+import time
+import uuid
+import logging
+import threading
+
+from . import common, config, metrics
+
+
+class AdmissionException(common.CloudcliException):
+
+    def __init__(self, message, retry_after_seconds):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+
+_queue_depth = None
+_queue_depth_time = 0
+_queue_depth_lock = threading.Lock()
+
+
+def get_queue_depth():
+    # number of messages waiting in the default queue, cached to avoid a broker round trip per request
+    global _queue_depth, _queue_depth_time
+    with _queue_depth_lock:
+        if _queue_depth is None or time.monotonic() - _queue_depth_time > config.ADMISSION_QUEUE_DEPTH_CACHE_SECONDS:
+            from .celery import app
+            with app.connection_for_read() as conn:
+                _queue_depth = conn.default_channel.queue_declare(queue=app.conf.task_default_queue, passive=True).message_count
+            _queue_depth_time = time.monotonic()
+        return _queue_depth
+
+
+def check(creds):
+    # raises AdmissionException if the submission should be retried later
+    from . import history
+    queue_depth = inflight = None
+    try:
+        if config.ADMISSION_MAX_QUEUE_DEPTH:
+            queue_depth = get_queue_depth()
+        if config.ADMISSION_MAX_INFLIGHT_PER_CREDS:
+            inflight = history.count_inflight(creds)
+    except Exception:
+        # admission control should not block submissions when the broker or database can't be checked
+        logging.exception('Failed to check admission limits')
+    if queue_depth is not None and queue_depth >= config.ADMISSION_MAX_QUEUE_DEPTH:
+        metrics.observe_admission(queue_depth, inflight, 'rejected', 'queue_depth')
+        raise AdmissionException('Too many pending tasks, please try again later', config.ADMISSION_RETRY_AFTER_SECONDS)
+    if inflight is not None and inflight >= config.ADMISSION_MAX_INFLIGHT_PER_CREDS:
+        metrics.observe_admission(queue_depth, inflight, 'rejected', 'inflight')
+        raise AdmissionException('Too many pending tasks for these credentials, wait for them to complete and try again', config.ADMISSION_RETRY_AFTER_SECONDS)
+    metrics.observe_admission(queue_depth, inflight, 'admitted')
+
+
+def submit(task, creds, *args):
+    # sends the task with the creds as the last argument, returns the task id
+    from . import history
+    check(creds)
+    args = (*args, creds)
+    task_id = str(uuid.uuid4())
+    history.record_submitted(task_id, task, args)
+    try:
+        return task.apply_async(args, task_id=task_id).id
+    except Exception:
+        history.record_submit_failed(task_id, task, args)
+        raise
@@ -1,6 +1,6 @@
 from celery import Celery
 
-from . import config
+from . import config, metrics, tracing, history
 
 
 app = Celery(
@@ -14,5 +14,21 @@ app = Celery(
     task_reject_on_worker_lost=True,
     task_acks_late=True,
     # must run celery beat!
-    result_expires=60*60*24*14
+    result_expires=60*60*24*14,
+    beat_schedule={
+        'cleanup_task_history': {
+            'task': 'cleanup_task_history',
+            'schedule': config.TASK_HISTORY_CLEANUP_INTERVAL_SECONDS,
+        },
+    },
 )
+
+# database results are deleted in batches by the cleanup_task_history task instead of the celery backend cleanup
+# set after creating the app because celery ignores None keyword arguments
+if history.is_database_result_backend():
+    app.conf.result_expires = None
+
+
+metrics.connect_celery_signals()
+tracing.connect_celery_signals()
+history.connect_celery_signals()
@@ -3,12 +3,17 @@ import base64
 
 import click
 
-from .lib.cnf import Cnf
-from .lib.cluster import Cluster
-from . import tasks, common
+# commands import only the modules they need, to keep cli startup fast
+
+
+def get_cluster(config):
+    from .lib.cnf import Cnf
+    from .lib.cluster import Cluster
+    return Cluster(Cnf(config, creds='env'))
 
 
 def cli_wait_task_status(task_id, wait):
+    from . import common
     if wait:
         print(f'Waiting for task {task_id}')
         res = common.wait_task_status(task_id, 'env')
@@ -37,6 +42,7 @@ def main():
 @click.option('--raw', is_flag=True)
 @click.option('--wait', is_flag=True)
 def task_status(task_id, result, meta, raw, wait):
+    from . import common
     if raw:
         assert not result and not meta and not wait
         from .celery import app
@@ -68,6 +74,14 @@ def task_status(task_id, result, meta, raw, wait):
         exit(1)
 
 
+@main.command()
+@click.argument('output_file')
+def openapi_schema(output_file):
+    # generated at build time and served by the web app, see OPENAPI_SCHEMA_FILE
+    from .web import write_openapi_schema
+    write_openapi_schema(output_file)
+
+
 @main.group()
 def cluster():
     pass
@@ -76,7 +90,7 @@ def cluster():
 @cluster.command()
 @click.argument('config')
 def server_token(config):
-    cluster_server, cluster_token = Cluster(Cnf(config, creds='env')).get_cluster_server_token()
+    cluster_server, cluster_token = get_cluster(config).get_cluster_server_token()
     print(f'Cluster server: {cluster_server}')
     print(f'Cluster token: {cluster_token}')
 
@@ -84,19 +98,28 @@ def server_token(config):
 @cluster.command()
 @click.argument('config')
 def status(config):
-    print(json.dumps(Cluster(Cnf(config, creds='env')).get_status(), indent=2))
+    print(json.dumps(get_cluster(config).get_status(), indent=2))
+
+
+@cluster.command()
+@click.argument('config')
+@click.option('--limit', default=50)
+def operations(config, limit):
+    from .history import get_recent_operations
+    print(json.dumps(get_recent_operations(get_cluster(config), limit), indent=2))
 
 
 @cluster.command()
 @click.argument('config')
 def kubeconfig(config):
-    print(Cluster(Cnf(config, creds='env')).get_kubeconfig())
+    print(get_cluster(config).get_kubeconfig())
 
 
 @cluster.command()
 @click.argument('config')
 @click.option('--wait', is_flag=True)
 def create(config, wait):
+    from . import tasks
     config = parse_base64(config)
     cli_wait_task_status(tasks.create_cluster.delay(config, 'env').id, wait)
 
@@ -104,9 +127,81 @@ def create(config, wait):
 @cluster.command()
 @click.argument('config')
 @click.option('--wait', is_flag=True)
-def update(config, wait):
+@click.option('--plan', is_flag=True, help='Only show which nodes will be created, updated or left unchanged')
+def update(config, wait, plan):
+    config = parse_base64(config)
+    if plan:
+        assert not wait
+        from .lib.plan import get_plan
+        print(json.dumps(get_plan(get_cluster(config)), indent=2))
+    else:
+        from . import tasks
+        cli_wait_task_status(tasks.update_cluster.delay(config, 'env').id, wait)
+
+
+@cluster.command()
+@click.argument('config')
+@click.argument('command', required=False)
+@click.option('--script-file', help='Run the script from this file instead of a command')
+@click.option('--nodepool', 'nodepool_names', multiple=True, help='Node pool to run on, can be set multiple times, all node pools if not set')
+@click.option('--node', 'node_numbers', multiple=True, type=int, help='Node number to run on, can be set multiple times, all nodes if not set')
+@click.option('--max-parallel', type=int, help='Max nodes to run on at the same time, defaults to SSH_FANOUT_MAX_PARALLEL')
+@click.option('--timeout', 'timeout_seconds', type=int, help='Max seconds for the command on each node, defaults to SSH_COMMAND_TIMEOUT_SECONDS')
+@click.option('--task', is_flag=True, help='Run in a celery task instead of locally')
+@click.option('--wait', is_flag=True)
+def run(config, command, script_file, nodepool_names, node_numbers, max_parallel, timeout_seconds, task, wait):
+    # runs locally by default, printing the output of each node as it arrives
+    from .lib import ssh
+    assert bool(command) != bool(script_file), 'either a command or --script-file is required'
+    if script_file:
+        with open(script_file) as f:
+            command = ssh.get_run_script_command(f.read())
+    config = parse_base64(config)
+    if task:
+        from . import tasks
+        cli_wait_task_status(tasks.run_cluster_command.delay(
+            config, command, list(nodepool_names), list(node_numbers), max_parallel, timeout_seconds, 'env'
+        ).id, wait)
+    else:
+        import threading
+        print_lock = threading.Lock()
+
+        def on_output(node, line):
+            with print_lock:
+                print(f'[{node.nodepool.name}-{node.node_number}] {line.rstrip()}', flush=True)
+
+        res = get_cluster(config).run_command(command, nodepool_names, node_numbers, max_parallel, on_output, timeout_seconds)
+        for node_res in res['nodes']:
+            node_res.pop('output')
+        print(json.dumps(res, indent=2))
+        if res['failed']:
+            exit(1)
+
+
+@cluster.command()
+@click.argument('config')
+@click.argument('bundle_id')
+@click.argument('output_file')
+def diagnostics_bundle(config, bundle_id, output_file):
+    # downloads a zip archive collected by the collect_diagnostics task, the bundle_id is in the task result
+    from .lib import diagnostics
+    config = parse_base64(config)
+    bundle = diagnostics.get_bundle(bundle_id, get_cluster(config).cnf.creds)
+    assert bundle, 'Diagnostics bundle not found'
+    with open(output_file, 'wb') as f:
+        for chunk in diagnostics.iter_bundle_chunks(bundle_id):
+            f.write(chunk)
+    print(f'Saved {bundle.size} bytes to {output_file}')
+
+
+@cluster.command()
+@click.argument('config')
+@click.option('--nodepool', default='controlplane', help='Node pool which node config is used for the image server')
+@click.option('--image-name', help='Defaults to a name based on the cluster name and rke2 version')
+def golden_image(config, nodepool, image_name):
+    from .lib import goldenimage
     config = parse_base64(config)
-    cli_wait_task_status(tasks.update_cluster.delay(config, 'env').id, wait)
+    print(json.dumps(goldenimage.create(get_cluster(config), nodepool, image_name), indent=2))
 
 
 @main.group()
@@ -118,7 +213,7 @@ def nodepool():
 @click.argument('config')
 @click.argument('nodepool')
 def node_numbers(config, nodepool):
-    print(Cluster(Cnf(config, creds='env')).node_pools[nodepool].node_numbers())
+    print(get_cluster(config).node_pools[nodepool].node_numbers())
 
 
 @main.group()
@@ -131,7 +226,7 @@ def node():
 @click.argument('nodepool')
 @click.argument('node_number')
 def create(config, nodepool, node_number):
-    print(json.dumps(Cluster(Cnf(config, creds='env')).node_pools[nodepool].get_node(int(node_number)).create(), indent=2))
+    print(json.dumps(get_cluster(config).node_pools[nodepool].get_node(int(node_number)).create(), indent=2))
 
 
 @node.command()
@@ -139,4 +234,4 @@ def create(config, nodepool, node_number):
 @click.argument('nodepool')
 @click.argument('node_number')
 def update(config, nodepool, node_number):
-    print(json.dumps(Cluster(Cnf(config, creds='env')).node_pools[nodepool].get_node(int(node_number)).update(), indent=2))
+    print(json.dumps(get_cluster(config).node_pools[nodepool].get_node(int(node_number)).update(), indent=2))
@@ -1,32 +1,58 @@
-import time
+import hmac
 import json
+import time
+import zlib
+import hashlib
 import logging
+import threading
 import traceback
+from collections import OrderedDict
 
-from fastapi.responses import JSONResponse
-
-from . import config
+from . import config, timing
 
 
 class CloudcliException(Exception):
     pass
 
 
-def setup_logging(**kwargs):
-    level = kwargs.pop('level', config.LOG_LEVEL)
-    logging.basicConfig(level=getattr(logging, level), **kwargs)
+class LRUCache:
+
+    def __init__(self, max_size, ttl_seconds=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
 
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self.lock:
+            self.items[key] = (value, expires_at)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
 
-class IndentedJSONResponse(JSONResponse):
+    def clear(self):
+        with self.lock:
+            self.items.clear()
 
-    def render(self, content) -> bytes:
-        return json.dumps(
-            content,
-            ensure_ascii=False,
-            allow_nan=False,
-            indent=2,
-            separators=(",", ":"),
-        ).encode("utf-8")
+
+def setup_logging(**kwargs):
+    level = kwargs.pop('level', config.LOG_LEVEL)
+    logging.basicConfig(level=getattr(logging, level), **kwargs)
 
 
 def wait_task_status(task_id, creds):
@@ -85,52 +111,116 @@ def get_task_status(task_id, creds):
         raise Exception(f'failed to get task status for task_id {task_id}: {e}') from e
 
 
+def get_node_statuses(task_statuses):
+    # counts node task results by status (e.g. updated / unchanged) over the whole task tree
+    node_statuses = {}
+    for task_status in task_statuses:
+        subtask_node_statuses = task_status['meta'].get('node_statuses') or {}
+        if isinstance(task_status['result'], dict) and task_status['result'].get('status'):
+            subtask_node_statuses = {task_status['result']['status']: 1}
+        for status, count in subtask_node_statuses.items():
+            node_statuses[status] = node_statuses.get(status, 0) + count
+    return node_statuses
+
+
+def get_creds_fingerprint(creds):
+    # results are stored with a fingerprint of the creds, to verify the creds of status requests without storing them
+    auth_client_id, auth_secret = creds
+    return hashlib.sha256(f'{auth_client_id}\0{auth_secret}'.encode()).hexdigest()
+
+
+def truncate_traceback(tb):
+    # the end of the traceback has the most relevant frames and the exception
+    if tb and len(tb) > config.RESULT_TRACEBACK_MAX_CHARS:
+        return '...\n' + tb[-config.RESULT_TRACEBACK_MAX_CHARS:]
+    return tb
+
+
+def encode_result_payload(payload):
+    # payloads larger than RESULT_COMPRESS_MIN_BYTES are stored as compressed json
+    try:
+        encoded = json.dumps(payload, separators=(',', ':')).encode()
+    except TypeError:
+        return payload
+    if len(encoded) < config.RESULT_COMPRESS_MIN_BYTES:
+        return payload
+    return {'payload_zlib': zlib.compress(encoded)}
+
+
+def decode_result_payload(result):
+    if 'payload_zlib' in result:
+        return json.loads(zlib.decompress(result['payload_zlib']))
+    return result
+
+
 class CeleryRunnerResult:
     object_name = 'common'
 
-    def __init__(self, task_name, result, creds, error=None, tb=None, meta=None):
+    def __init__(self, task_name, result, creds, error=None, tb=None, meta=None, timing=None):
         self.task_name = task_name
         self.result = result
         self.creds = creds
         self.error = error
         self.traceback = tb
         self.meta = meta
+        self.timing = timing
 
     def export(self):
         if callable(self.result):
-            try:
-                self.result = self.result()
-            except Exception as e:
-                self.result = None
-                self.error = str(e) if isinstance(e, CloudcliException) else 'An unexpected error occurred, please try again later'
-                self.traceback = traceback.format_exc()
-                logging.debug(self.traceback)
+            with timing.profile() as timing_profile:
+                try:
+                    self.result = self.result()
+                except Exception as e:
+                    self.result = None
+                    self.error = str(e) if isinstance(e, CloudcliException) else 'An unexpected error occurred, please try again later'
+                    self.traceback = traceback.format_exc()
+                    logging.debug(self.traceback)
+            self.timing = timing_profile.export()
+        payload = {
+            'result': self.result,
+            'error': self.error,
+            'traceback': truncate_traceback(self.traceback),
+            'meta': self.meta,
+            'timing': self.timing,
+        }
         return {
             '__result_type': 'CeleryRunnerResult',
             'object_name': self.object_name,
             'task_name': self.task_name,
-            'result': self.result,
-            'error': self.error,
-            'traceback': self.traceback,
-            'creds': self.creds,
-            'meta': self.meta,
+            'creds_fingerprint': get_creds_fingerprint(self.creds) if self.creds else None,
+            **encode_result_payload({key: value for key, value in payload.items() if value is not None}),
         }
 
+    def store(self):
+        # stores the result as a completed task, so clients use the usual task_status flow without running a task
+        import uuid
+        from .celery import app
+        task_id = str(uuid.uuid4())
+        app.backend.store_result(task_id, self.export(), 'SUCCESS')
+        return task_id
+
     @classmethod
     def parse(cls, result, creds):
         logging.debug(f'parsing result: {result} / {creds}')
         if isinstance(result, dict) and result.get('__result_type') == 'CeleryRunnerResult':
             object_name = result.get('object_name')
             task_name = result.get('task_name')
+            # results stored before the creds fingerprint was added have the creds
             result_creds = result.get('creds')
-            result_result = result.get('result')
-            result_error = result.get('error')
-            result_traceback = result.get('traceback')
-            result_meta = result.get('meta')
-            if object_name and task_name and result_creds:
-                if result_creds != creds:
+            result_creds_fingerprint = result.get('creds_fingerprint')
+            payload = decode_result_payload(result)
+            result_result = payload.get('result')
+            result_error = payload.get('error')
+            result_traceback = payload.get('traceback')
+            result_meta = payload.get('meta')
+            result_timing = payload.get('timing')
+            if object_name and task_name and (result_creds or result_creds_fingerprint):
+                if result_creds_fingerprint:
+                    if not creds or not hmac.compare_digest(result_creds_fingerprint, get_creds_fingerprint(creds)):
+                        raise CloudcliException(f'invalid result')
+                elif result_creds != creds:
                     raise CloudcliException(f'invalid result')
-                resultargs = (task_name, result_result, creds, result_error, result_traceback, result_meta)
+                resultargs = (task_name, result_result, creds, result_error, result_traceback, result_meta, result_timing)
                 if object_name == 'cluster':
                     from .lib.cluster import ClusterCeleryRunnerResult
                     return ClusterCeleryRunnerResult(*resultargs)
@@ -144,7 +234,10 @@ class CeleryRunnerResult:
         return result
 
     def get_task_status_meta(self):
-        return self.meta or {}
+        meta = self.meta or {}
+        if self.timing:
+            meta = {**meta, 'timing': self.timing}
+        return meta
 
     def get_task_status(self):
         if self.result:
@@ -168,6 +261,13 @@ class CeleryRunnerResult:
         meta = self.get_task_status_meta() or {}
         task_ids = task_ids or []
         task_statuses = meta['subtasks'] = [get_task_status(task_id, self.creds) for task_id in task_ids]
+        meta['timing'] = timing.aggregate([
+            self.timing,
+            *[task_status['meta'].get('timing') for task_status in task_statuses]
+        ])
+        node_statuses = get_node_statuses(task_statuses)
+        if node_statuses:
+            meta['node_statuses'] = node_statuses
         if self.error:
             state = 'FAILURE'
             error = self.error
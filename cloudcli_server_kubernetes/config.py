@@ -11,6 +11,9 @@ KAMATERA_API_SERVER = os.getenv("KAMATERA_API_SERVER", 'https://cloudcli.cloudwm
 KAMATERA_API_CLIENT_ID = os.getenv("KAMATERA_API_CLIENT_ID")
 KAMATERA_API_SECRET = os.getenv("KAMATERA_API_SECRET")
 
+# interval between checks of a queued Kamatera server command status
+KAMATERA_COMMAND_POLL_SECONDS = float(os.getenv('KAMATERA_COMMAND_POLL_SECONDS', '2'))
+
 CLOUDCLI_DEBUG = os.getenv("CLOUDCLI_DEBUG", "yes").lower() in ['1', 'true', "yes"]
 LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if CLOUDCLI_DEBUG else "INFO")
 
@@ -29,3 +32,97 @@ DEFAULT_SERVER_CONFIG = json.loads(os.getenv('DEFAULT_SERVER_CONFIG', '''{
     "billingcycle": "hourly",
     "monthlypackage": ""
 }'''))
+
+# when enabled, ssh metrics are labeled per node, this may cause high cardinality on large clusters
+METRICS_NODE_LABELS = os.getenv('METRICS_NODE_LABELS', 'no').lower() in ['1', 'true', 'yes']
+# port for the celery worker metrics exporter, disabled if not set
+CELERY_METRICS_PORT = int(os.getenv('CELERY_METRICS_PORT') or 0)
+
+# tracing exporter: empty to disable, "file" to append spans as JSON lines to TRACING_FILE
+# or "zipkin" to send spans to a Zipkin compatible collector at TRACING_ZIPKIN_URL
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', '')
+TRACING_FILE = os.getenv('TRACING_FILE', 'traces.jsonl')
+TRACING_ZIPKIN_URL = os.getenv('TRACING_ZIPKIN_URL', 'http://localhost:9411/api/v2/spans')
+TRACING_SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'cloudcli-server-kubernetes')
+
+# per-process cache of parsed and validated cluster configurations
+CLUSTER_CACHE_SIZE = int(os.getenv('CLUSTER_CACHE_SIZE', '64'))
+CLUSTER_CACHE_TTL_SECONDS = int(os.getenv('CLUSTER_CACHE_TTL_SECONDS', '600'))
+
+# database for cloudcli state, by default uses the celery result backend database
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# rolling updates - interval between scheduler checks and max time to wait for an updated node to be ready
+ROLLING_UPDATE_POLL_SECONDS = int(os.getenv('ROLLING_UPDATE_POLL_SECONDS', '5'))
+ROLLING_UPDATE_READY_TIMEOUT_SECONDS = int(os.getenv('ROLLING_UPDATE_READY_TIMEOUT_SECONDS', '900'))
+# rolling updates - failed scheduler checks are retried, after this time the pending node tasks are marked as failed
+ROLLING_UPDATE_ERROR_TIMEOUT_SECONDS = int(os.getenv('ROLLING_UPDATE_ERROR_TIMEOUT_SECONDS', '900'))
+
+# max time to wait for rke2 to be installed by the server init script (cluster.bootstrap: init-script / golden image)
+RKE2_BOOTSTRAP_TIMEOUT_SECONDS = int(os.getenv('RKE2_BOOTSTRAP_TIMEOUT_SECONDS', '900'))
+
+# ssh connection options, a connection is dropped after SSH_SERVER_ALIVE_COUNT_MAX unanswered keepalives
+SSH_CONNECT_TIMEOUT_SECONDS = int(os.getenv('SSH_CONNECT_TIMEOUT_SECONDS', '10'))
+SSH_SERVER_ALIVE_INTERVAL_SECONDS = int(os.getenv('SSH_SERVER_ALIVE_INTERVAL_SECONDS', '15'))
+SSH_SERVER_ALIVE_COUNT_MAX = int(os.getenv('SSH_SERVER_ALIVE_COUNT_MAX', '4'))
+# max time for a single ssh command, must be longer than RKE2_BOOTSTRAP_TIMEOUT_SECONDS
+SSH_COMMAND_TIMEOUT_SECONDS = int(os.getenv('SSH_COMMAND_TIMEOUT_SECONDS', '1800'))
+# readiness probing of port 22 after server creation, with exponential backoff between attempts
+SSH_READY_TIMEOUT_SECONDS = int(os.getenv('SSH_READY_TIMEOUT_SECONDS', '300'))
+SSH_READY_PROBE_TIMEOUT_SECONDS = float(os.getenv('SSH_READY_PROBE_TIMEOUT_SECONDS', '3'))
+SSH_READY_BACKOFF_INITIAL_SECONDS = float(os.getenv('SSH_READY_BACKOFF_INITIAL_SECONDS', '0.5'))
+SSH_READY_BACKOFF_MAX_SECONDS = float(os.getenv('SSH_READY_BACKOFF_MAX_SECONDS', '10'))
+SSH_READY_MAX_CONCURRENCY = int(os.getenv('SSH_READY_MAX_CONCURRENCY', '32'))
+# running a command on many nodes: max nodes at a time, and max output chars kept per node (the tail of the output)
+SSH_FANOUT_MAX_PARALLEL = int(os.getenv('SSH_FANOUT_MAX_PARALLEL', '20'))
+SSH_FANOUT_OUTPUT_MAX_CHARS = int(os.getenv('SSH_FANOUT_OUTPUT_MAX_CHARS', '10000'))
+
+# port of the rke2 artifacts mirror on controlplane-1 (cluster.rke2-mirror: controlplane), served on the private network
+RKE2_MIRROR_PORT = int(os.getenv('RKE2_MIRROR_PORT', '8089'))
+
+# warm pool servers which are still being created or claimed after this time are considered failed and their slot is freed
+WARM_POOL_STALE_SECONDS = int(os.getenv('WARM_POOL_STALE_SECONDS', '3600'))
+
+# cluster status snapshots older than this are refreshed in the background when read
+CLUSTER_SNAPSHOT_MAX_AGE_SECONDS = int(os.getenv('CLUSTER_SNAPSHOT_MAX_AGE_SECONDS', '300'))
+
+# kubernetes api client used for the cluster status and node readiness
+KUBE_API_TIMEOUT_SECONDS = int(os.getenv('KUBE_API_TIMEOUT_SECONDS', '10'))
+KUBE_API_POOL_SIZE = int(os.getenv('KUBE_API_POOL_SIZE', '4'))
+
+# cached kubeconfigs are served without running a task until they expire or the controlplane ip changes
+KUBECONFIG_CACHE_TTL_SECONDS = int(os.getenv('KUBECONFIG_CACHE_TTL_SECONDS', '3600'))
+# fernet keys used to encrypt the cached kubeconfigs, comma separated, the first one encrypts and all of them decrypt
+# generate with `python -c 'from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())'`
+# kubeconfigs are not cached if it's not set
+KUBECONFIG_CACHE_ENCRYPTION_KEYS = os.getenv('KUBECONFIG_CACHE_ENCRYPTION_KEYS')
+
+# openapi schema generated at build time by `cloudclik8s openapi-schema`, used if it matches the app version
+OPENAPI_SCHEMA_FILE = os.getenv('OPENAPI_SCHEMA_FILE')
+OPENAPI_CACHE_MAX_AGE_SECONDS = int(os.getenv('OPENAPI_CACHE_MAX_AGE_SECONDS', '86400'))
+
+# task results larger than this are stored compressed, tracebacks in task results are truncated to the last chars
+RESULT_COMPRESS_MIN_BYTES = int(os.getenv('RESULT_COMPRESS_MIN_BYTES', '1024'))
+RESULT_TRACEBACK_MAX_CHARS = int(os.getenv('RESULT_TRACEBACK_MAX_CHARS', '2000'))
+
+# task history, cluster journal and celery task results are deleted after this time, in batches, by the cleanup task
+TASK_HISTORY_EXPIRES_SECONDS = int(os.getenv('TASK_HISTORY_EXPIRES_SECONDS', str(60 * 60 * 24 * 14)))
+TASK_HISTORY_CLEANUP_INTERVAL_SECONDS = int(os.getenv('TASK_HISTORY_CLEANUP_INTERVAL_SECONDS', '3600'))
+TASK_HISTORY_CLEANUP_BATCH_SIZE = int(os.getenv('TASK_HISTORY_CLEANUP_BATCH_SIZE', '1000'))
+
+# diagnostics bundles: collection stops at the max archive size or after the timeout, each file is capped at the max file size
+DIAGNOSTICS_MAX_BYTES = int(os.getenv('DIAGNOSTICS_MAX_BYTES', str(100 * 1024 * 1024)))
+DIAGNOSTICS_MAX_FILE_BYTES = int(os.getenv('DIAGNOSTICS_MAX_FILE_BYTES', str(10 * 1024 * 1024)))
+DIAGNOSTICS_TIMEOUT_SECONDS = int(os.getenv('DIAGNOSTICS_TIMEOUT_SECONDS', '300'))
+# the archive is stored in the database in chunks, bundles are deleted by the cleanup task after DIAGNOSTICS_EXPIRES_SECONDS
+DIAGNOSTICS_CHUNK_BYTES = int(os.getenv('DIAGNOSTICS_CHUNK_BYTES', str(1024 * 1024)))
+DIAGNOSTICS_EXPIRES_SECONDS = int(os.getenv('DIAGNOSTICS_EXPIRES_SECONDS', str(60 * 60 * 24 * 3)))
+
+# admission control of provisioning submissions (create / update), rejected with 429 when a limit is reached, 0 disables a limit
+# max messages waiting in the broker queue, checked at most every ADMISSION_QUEUE_DEPTH_CACHE_SECONDS per web process
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv('ADMISSION_MAX_QUEUE_DEPTH', '1000'))
+ADMISSION_QUEUE_DEPTH_CACHE_SECONDS = float(os.getenv('ADMISSION_QUEUE_DEPTH_CACHE_SECONDS', '5'))
+# max pending and running tasks per creds, tasks not updated for ADMISSION_INFLIGHT_STALE_SECONDS are not counted
+ADMISSION_MAX_INFLIGHT_PER_CREDS = int(os.getenv('ADMISSION_MAX_INFLIGHT_PER_CREDS', '500'))
+ADMISSION_INFLIGHT_STALE_SECONDS = int(os.getenv('ADMISSION_INFLIGHT_STALE_SECONDS', '3600'))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', '30'))
@@ -0,0 +1,150 @@
+import hashlib
+import datetime
+import threading
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Index, String, Integer, DateTime, Text, LargeBinary
+
+from . import config
+
+
+metadata = MetaData()
+
+# last applied rke2 config fingerprint of each node
+node_state = Table(
+    'cloudcli_node_state', metadata,
+    Column('account', String(64), primary_key=True),
+    Column('cluster_name', String(255), primary_key=True),
+    Column('nodepool_name', String(255), primary_key=True),
+    Column('node_number', Integer, primary_key=True),
+    Column('fingerprint', String(64), nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+# idle servers with rke2 preinstalled, each cluster has a fixed number of slots
+# the primary key makes sure a slot is filled and claimed only once
+warm_server = Table(
+    'cloudcli_warm_server', metadata,
+    Column('account', String(64), primary_key=True),
+    Column('cluster_name', String(255), primary_key=True),
+    Column('slot', Integer, primary_key=True),
+    Column('server_name_prefix', String(255), nullable=False),
+    Column('status', String(32), nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+# last known cluster status, used to return the status without live api / ssh calls
+# it's returned only for requests with the same creds which saved it
+cluster_snapshot = Table(
+    'cloudcli_cluster_snapshot', metadata,
+    Column('account', String(64), primary_key=True),
+    Column('cluster_name', String(255), primary_key=True),
+    Column('creds_fingerprint', String(64), nullable=False),
+    Column('status', Text, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+    Column('refresh_requested_at', DateTime, nullable=True),
+)
+
+# kubeconfig of each cluster
+# it's returned only for requests with the same creds which saved it
+kubeconfig_cache = Table(
+    'cloudcli_kubeconfig_cache', metadata,
+    Column('account', String(64), primary_key=True),
+    Column('cluster_name', String(255), primary_key=True),
+    Column('creds_fingerprint', String(64), nullable=False),
+    Column('controlplane_ip', String(64), nullable=False),
+    Column('kubeconfig', Text, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+# state of each cluster task, kept until TASK_HISTORY_EXPIRES_SECONDS
+task_history = Table(
+    'cloudcli_task_history', metadata,
+    Column('task_id', String(155), primary_key=True),
+    Column('account', String(64), nullable=False),
+    Column('cluster_name', String(255), nullable=False),
+    Column('creds_fingerprint', String(64), nullable=False),
+    Column('task_name', String(255), nullable=False),
+    Column('nodepool_name', String(255), nullable=True),
+    Column('node_number', Integer, nullable=True),
+    Column('state', String(32), nullable=False),
+    Column('error', Text, nullable=True),
+    Column('created_at', DateTime, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+    Index('ix_cloudcli_task_history_cluster', 'account', 'cluster_name', 'created_at'),
+    Index('ix_cloudcli_task_history_created_at', 'created_at'),
+    Index('ix_cloudcli_task_history_inflight', 'creds_fingerprint', 'state', 'updated_at'),
+)
+
+# append only journal of the operations on each cluster, readable only with the same creds
+cluster_journal = Table(
+    'cloudcli_cluster_journal', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('account', String(64), nullable=False),
+    Column('cluster_name', String(255), nullable=False),
+    Column('creds_fingerprint', String(64), nullable=False),
+    Column('task_id', String(155), nullable=False),
+    Column('event', String(64), nullable=False),
+    Column('details', Text, nullable=True),
+    Column('created_at', DateTime, nullable=False),
+    Index('ix_cloudcli_cluster_journal_cluster', 'account', 'cluster_name', 'created_at'),
+    Index('ix_cloudcli_cluster_journal_created_at', 'created_at'),
+)
+
+
+# diagnostics bundles collected from the cluster nodes, readable only with the same creds
+# the size is set when the bundle is complete
+diagnostics_bundle = Table(
+    'cloudcli_diagnostics_bundle', metadata,
+    Column('bundle_id', String(36), primary_key=True),
+    Column('account', String(64), nullable=False),
+    Column('cluster_name', String(255), nullable=False),
+    Column('creds_fingerprint', String(64), nullable=False),
+    Column('size', Integer, nullable=True),
+    Column('created_at', DateTime, nullable=False),
+    Index('ix_cloudcli_diagnostics_bundle_created_at', 'created_at'),
+)
+
+# the zip archive of each diagnostics bundle, split into chunks of DIAGNOSTICS_CHUNK_BYTES
+diagnostics_chunk = Table(
+    'cloudcli_diagnostics_chunk', metadata,
+    Column('bundle_id', String(36), primary_key=True),
+    Column('chunk_number', Integer, primary_key=True),
+    Column('data', LargeBinary, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Index('ix_cloudcli_diagnostics_chunk_created_at', 'created_at'),
+)
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_database_url():
+    if config.DATABASE_URL:
+        return config.DATABASE_URL
+    else:
+        # by default, use the same database as the celery result backend
+        from .celery import app
+        result_backend = app.conf.result_backend
+        assert result_backend.startswith('db+'), 'DATABASE_URL is required when not using a database result backend'
+        return result_backend[3:]
+
+
+def get_engine():
+    url = get_database_url()
+    with _engines_lock:
+        if url not in _engines:
+            engine = create_engine(url, pool_pre_ping=True)
+            metadata.create_all(engine)
+            _engines[url] = engine
+        return _engines[url]
+
+
+def get_account(creds):
+    # the account is identified by the auth client id, it's hashed to avoid storing it in the db
+    auth_client_id = creds[0] if creds else None
+    assert auth_client_id, 'Auth credentials are missing'
+    return hashlib.sha256(auth_client_id.encode()).hexdigest()
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,264 @@
+import json
+import inspect
+import logging
+import datetime
+
+from . import config
+
+
+# internal tasks which run repeatedly are not recorded
+EXCLUDED_TASK_NAMES = ['schedule_nodepool_nodes', 'cleanup_task_history']
+
+RESULT_BACKEND_DATE_DONE_INDEX = 'ix_celery_taskmeta_date_done'
+
+
+def get_task_cluster(task, args, kwargs):
+    # returns the cluster and the task arguments, or None if the task is not a cluster task
+    if task.name in EXCLUDED_TASK_NAMES or task.name.startswith('celery.'):
+        return None
+    from .lib.cluster import Cluster
+    task_args = inspect.signature(task.run).bind_partial(*(args or []), **(kwargs or {})).arguments
+    if 'cnf' not in task_args:
+        return None
+    return Cluster.init_from_cnf_creds(task_args['cnf'], task_args.get('creds')), task_args
+
+
+def get_result_error(retval):
+    if isinstance(retval, dict) and retval.get('__result_type') == 'CeleryRunnerResult':
+        from .common import decode_result_payload
+        return decode_result_payload(retval).get('error')
+    elif isinstance(retval, Exception):
+        return str(retval)
+    return None
+
+
+def add_journal_entry(conn, cluster, task_id, event, details=None):
+    from . import db
+    from .common import get_creds_fingerprint
+    conn.execute(db.cluster_journal.insert().values(
+        account=db.get_account(cluster.cnf.creds),
+        cluster_name=cluster.name,
+        creds_fingerprint=get_creds_fingerprint(cluster.cnf.creds),
+        task_id=task_id,
+        event=event,
+        details=json.dumps(details) if details else None,
+        created_at=db.utcnow(),
+    ))
+
+
+def replace_task(conn, task_id, task, cluster, task_args, state, event):
+    from . import db
+    from .common import get_creds_fingerprint
+    details = {key: task_args[key] for key in ['nodepool_name', 'node_number'] if task_args.get(key) is not None}
+    # tasks may be redelivered, so the history row is replaced
+    conn.execute(db.task_history.delete().where(db.task_history.c.task_id == task_id))
+    conn.execute(db.task_history.insert().values(
+        task_id=task_id,
+        account=db.get_account(cluster.cnf.creds),
+        cluster_name=cluster.name,
+        creds_fingerprint=get_creds_fingerprint(cluster.cnf.creds),
+        task_name=task.name,
+        nodepool_name=details.get('nodepool_name'),
+        node_number=details.get('node_number'),
+        state=state,
+        error=None,
+        created_at=db.utcnow(),
+        updated_at=db.utcnow(),
+    ))
+    add_journal_entry(conn, cluster, task_id, f'{task.name}_{event}', details)
+
+
+def record_submitted(task_id, task, args):
+    # called by the web app before sending the task, so queued tasks are counted by the admission control
+    from . import db
+    try:
+        task_cluster = get_task_cluster(task, args, {})
+        if task_cluster:
+            with db.get_engine().begin() as conn:
+                replace_task(conn, task_id, task, *task_cluster, 'PENDING', 'submitted')
+    except Exception:
+        logging.exception(f'Failed to record task history for {task_id}')
+
+
+def record_submit_failed(task_id, task, args):
+    # called by the web app if sending the task failed, so it's not counted as in flight by the admission control
+    # only a pending row is updated, in case the task was sent and already started
+    from . import db
+    try:
+        task_cluster = get_task_cluster(task, args, {})
+        if task_cluster:
+            cluster, _ = task_cluster
+            with db.get_engine().begin() as conn:
+                if conn.execute(db.task_history.update().where(
+                    (db.task_history.c.task_id == task_id) & (db.task_history.c.state == 'PENDING')
+                ).values(state='FAILURE', error='Failed to submit the task', updated_at=db.utcnow())).rowcount:
+                    add_journal_entry(conn, cluster, task_id, f'{task.name}_failed', {'error': 'Failed to submit the task'})
+    except Exception:
+        logging.exception(f'Failed to record task history for {task_id}')
+
+
+def on_task_prerun(task_id=None, task=None, args=None, kwargs=None, **_):
+    from . import db
+    try:
+        task_cluster = get_task_cluster(task, args, kwargs)
+        if task_cluster:
+            with db.get_engine().begin() as conn:
+                replace_task(conn, task_id, task, *task_cluster, 'STARTED', 'started')
+    except Exception:
+        logging.exception(f'Failed to record task history for {task_id}')
+
+
+def on_task_postrun(task_id=None, task=None, args=None, kwargs=None, retval=None, state=None, **_):
+    from . import db
+    try:
+        task_cluster = get_task_cluster(task, args, kwargs)
+        if not task_cluster:
+            return
+        cluster, _ = task_cluster
+        error = get_result_error(retval)
+        state = 'FAILURE' if error else (state or 'SUCCESS')
+        with db.get_engine().begin() as conn:
+            conn.execute(db.task_history.update().where(db.task_history.c.task_id == task_id).values(
+                state=state,
+                error=error,
+                updated_at=db.utcnow(),
+            ))
+            add_journal_entry(conn, cluster, task_id, f'{task.name}_{"failed" if state == "FAILURE" else "finished"}', {'error': error} if error else None)
+    except Exception:
+        logging.exception(f'Failed to record task history for {task_id}')
+
+
+def connect_celery_signals():
+    from celery import signals
+    signals.task_prerun.connect(on_task_prerun, weak=False)
+    signals.task_postrun.connect(on_task_postrun, weak=False)
+
+
+def count_inflight(creds):
+    # pending and running tasks of the creds, tasks which were not updated for a long time are assumed lost
+    from sqlalchemy import func
+    from . import db
+    from .common import get_creds_fingerprint
+    updated_after = db.utcnow() - datetime.timedelta(seconds=config.ADMISSION_INFLIGHT_STALE_SECONDS)
+    with db.get_engine().connect() as conn:
+        return conn.execute(
+            db.task_history.select().with_only_columns(func.count()).where(
+                (db.task_history.c.creds_fingerprint == get_creds_fingerprint(creds))
+                & db.task_history.c.state.in_(['PENDING', 'STARTED'])
+                & (db.task_history.c.updated_at > updated_after)
+            )
+        ).scalar()
+
+
+def get_recent_operations(cluster, limit=50):
+    # returns the journal entries of the cluster, most recent first, with the current state of their tasks
+    from . import db
+    from .common import get_creds_fingerprint
+    with db.get_engine().connect() as conn:
+        rows = conn.execute(
+            db.cluster_journal.select().where(
+                (db.cluster_journal.c.account == db.get_account(cluster.cnf.creds))
+                & (db.cluster_journal.c.cluster_name == cluster.name)
+                & (db.cluster_journal.c.creds_fingerprint == get_creds_fingerprint(cluster.cnf.creds))
+            ).order_by(db.cluster_journal.c.created_at.desc(), db.cluster_journal.c.id.desc()).limit(limit)
+        ).fetchall()
+        task_states = {
+            row.task_id: row.state
+            for row in conn.execute(db.task_history.select().where(
+                db.task_history.c.task_id.in_({row.task_id for row in rows})
+            ))
+        } if rows else {}
+    return [
+        {
+            'time': row.created_at.isoformat(),
+            'task_id': row.task_id,
+            'event': row.event,
+            'task_state': task_states.get(row.task_id),
+            **(json.loads(row.details) if row.details else {}),
+        }
+        for row in rows
+    ]
+
+
+def delete_batches(conn_factory, table, key_columns, time_column, before, batch_size):
+    # short transactions of up to batch_size rows, to avoid long locks on large tables
+    # rows are deleted by their primary key columns, so each batch deletes exactly the selected rows
+    from sqlalchemy import tuple_
+    deleted = 0
+    while True:
+        with conn_factory() as conn:
+            keys = conn.execute(
+                table.select().with_only_columns(*key_columns).where(time_column < before).limit(batch_size)
+            ).all()
+            if len(key_columns) == 1:
+                where = key_columns[0].in_([key[0] for key in keys])
+            else:
+                where = tuple_(*key_columns).in_([tuple(key) for key in keys])
+            if keys:
+                conn.execute(table.delete().where(where))
+        deleted += len(keys)
+        if len(keys) < batch_size:
+            return deleted
+
+
+def cleanup(expires_seconds=None, batch_size=None):
+    # replaces the celery backend cleanup, which deletes all the expired task results in a single statement
+    from . import db
+    from celery.backends.database.models import Task
+    expires_seconds = expires_seconds or config.TASK_HISTORY_EXPIRES_SECONDS
+    batch_size = batch_size or config.TASK_HISTORY_CLEANUP_BATCH_SIZE
+    before = db.utcnow() - datetime.timedelta(seconds=expires_seconds)
+    engine = db.get_engine()
+    taskmeta = Task.__table__
+    diagnostics_before = db.utcnow() - datetime.timedelta(seconds=config.DIAGNOSTICS_EXPIRES_SECONDS)
+    return {
+        'task_history': delete_batches(engine.begin, db.task_history, [db.task_history.c.task_id], db.task_history.c.created_at, before, batch_size),
+        'cluster_journal': delete_batches(engine.begin, db.cluster_journal, [db.cluster_journal.c.id], db.cluster_journal.c.created_at, before, batch_size),
+        'task_results': delete_batches(
+            get_result_backend_engine(create_index=True).begin, taskmeta, [taskmeta.c.id], taskmeta.c.date_done, before, batch_size
+        ) if is_database_result_backend() else 0,
+        'diagnostics_chunks': delete_batches(
+            engine.begin, db.diagnostics_chunk, [db.diagnostics_chunk.c.bundle_id, db.diagnostics_chunk.c.chunk_number],
+            db.diagnostics_chunk.c.created_at, diagnostics_before, batch_size
+        ),
+        'diagnostics_bundles': delete_batches(
+            engine.begin, db.diagnostics_bundle, [db.diagnostics_bundle.c.bundle_id], db.diagnostics_bundle.c.created_at, diagnostics_before, batch_size
+        ),
+    }
+
+
+def is_database_result_backend():
+    from .celery import app
+    return (app.conf.result_backend or '').startswith('db+')
+
+
+def get_result_backend_engine(create_index=False):
+    from .celery import app
+    session = app.backend.ResultSession()
+    try:
+        engine = session.get_bind()
+    finally:
+        session.close()
+    if create_index:
+        create_result_backend_index(engine)
+    return engine
+
+
+def get_result_backend_index():
+    # the index is defined on a copy of the celery results table, so the celery table definition is unchanged
+    # on postgres it's created concurrently so it doesn't block writing task results
+    from sqlalchemy import Index, MetaData, Table, Column, DateTime
+    from celery.backends.database.models import Task
+    taskmeta = Task.__table__
+    return Index(
+        RESULT_BACKEND_DATE_DONE_INDEX,
+        Table(taskmeta.name, MetaData(), Column('date_done', DateTime), schema=taskmeta.schema).c.date_done,
+        postgresql_concurrently=True,
+    )
+
+
+def create_result_backend_index(engine):
+    # results tables created by celery before 5.6 have no index on date_done, without it each cleanup batch scans the whole table
+    # creating an index concurrently requires running outside of a transaction
+    with engine.connect() as conn:
+        get_result_backend_index().create(conn.execution_options(isolation_level='AUTOCOMMIT'), checkfirst=True)
@@ -5,7 +5,7 @@ import datetime
 
 import requests
 
-from .. import config, common
+from .. import config, common, metrics, tracing, timing
 
 
 class CloudcliApiException(common.CloudcliException):
@@ -30,12 +30,19 @@ def cloudcli_server_request(path, creds, **kwargs):
     auth_client_id, auth_secret = get_auth_client_id_secret(creds)
     url = "%s%s" % (config.KAMATERA_API_SERVER, path)
     method = kwargs.pop("method", "GET")
-    res = requests.request(method=method, url=url, headers={
-        "AuthClientId": auth_client_id,
-        "AuthSecret": auth_secret,
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }, **kwargs)
+    with (
+        tracing.span('cloudcli_server_request', path=path, method=method) as span,
+        metrics.time_cloudcli_server_request(path, method) as metrics_labels,
+        timing.record('api')
+    ):
+        res = requests.request(method=method, url=url, headers={
+            "AuthClientId": auth_client_id,
+            "AuthSecret": auth_secret,
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }, **kwargs)
+        metrics_labels['status'] = res.status_code
+        span.set_tag('status', res.status_code)
     try:
         data = res.json()
     except:
@@ -55,12 +62,17 @@ def find_server_command_in_queue(command_info, server_name_startswith, creds):
     return None
 
 
-def get_server_info(creds, name_startswith):
-    common.logging.debug(f'cloudcli get_server_info name_startswith={name_startswith}')
+def get_servers_info(creds, name_startswith):
     status, res = cloudcli_server_request("/service/server/info", creds, method="POST", json={"name": f'{name_startswith}-.*'})
     if status != 200:
         assert 'No servers found' in res['message'], f'Unexpected error {status}: {res}'
         res = []
+    return res
+
+
+def get_server_info(creds, name_startswith):
+    common.logging.debug(f'cloudcli get_server_info name_startswith={name_startswith}')
+    res = get_servers_info(creds, name_startswith)
     if len(res) == 0:
         return None
     elif len(res) > 1:
@@ -73,6 +85,36 @@ def get_server_name(name_startswith):
     return f'{name_startswith}-{secrets.token_urlsafe(5)}'
 
 
+def run_server_operation(creds, path, data, error_message):
+    # server operations return the queued command id, we wait for it to complete
+    status, res = cloudcli_server_request(path, creds, method="POST", json=data)
+    if status != 200:
+        raise CloudcliApiException(f'{error_message}: {status} {res}')
+    if isinstance(res, list) and len(res) == 1:
+        command = wait_command(creds, res[0])
+        # a timeout returns an empty command
+        if command.get('status') != 'complete':
+            raise CloudcliApiException(f'{error_message}: {command.get("status") or "timeout waiting for command"}')
+        return command
+    return res
+
+
+def rename_server(creds, name, new_name):
+    return run_server_operation(creds, "/service/server/rename", {"name": name, "new-name": new_name}, 'Rename server failed')
+
+
+def poweroff_server(creds, name):
+    return run_server_operation(creds, "/service/server/poweroff", {"name": name, "force": True}, 'Power off server failed')
+
+
+def terminate_server(creds, name):
+    return run_server_operation(creds, "/service/server/terminate", {"name": name, "force": True}, 'Terminate server failed')
+
+
+def create_server_image(creds, name, image_name):
+    return run_server_operation(creds, "/service/server/image", {"name": name, "image-name": image_name}, 'Create server image failed')
+
+
 def get_command_status(creds, command_id) -> dict:
     status, response = cloudcli_server_request("/service/queue?id=" + str(command_id), creds)
     if status != 200 or len(response) != 1 or not isinstance(response[0], dict):
@@ -82,8 +124,15 @@ def get_command_status(creds, command_id) -> dict:
 
 
 def wait_command(creds, command_id):
+    with tracing.span('wait_command', command_id=command_id) as span, timing.record('wait'):
+        command = _wait_command(creds, command_id)
+        span.set_tag('status', command.get('status'))
+        return command
+
+
+def _wait_command(creds, command_id):
     logging.debug("Waiting for command_id to complete %s" % command_id)
-    wait_poll_interval_seconds = 2
+    wait_poll_interval_seconds = config.KAMATERA_COMMAND_POLL_SECONDS
     wait_timeout_seconds = 3600
     start_time = datetime.datetime.now()
     max_time = start_time + datetime.timedelta(seconds=wait_timeout_seconds)
@@ -94,10 +143,12 @@ def wait_command(creds, command_id):
             logging.warning("WARNING! Timeout waiting for command (timeout_seconds={0}, command_id={1})".format(
                 str(wait_timeout_seconds), str(command_id)
             ))
+            metrics.observe_wait_command('timeout', (datetime.datetime.now() - start_time).total_seconds())
             return command
         time.sleep(wait_poll_interval_seconds)
         command = get_command_status(creds, command_id)
         if command.get("status") in ["complete", "error"]:
+            metrics.observe_wait_command(command["status"], (datetime.datetime.now() - start_time).total_seconds())
             return command
 
 
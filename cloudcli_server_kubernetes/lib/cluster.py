@@ -1,18 +1,37 @@
+import json
+import typing
+import hashlib
+import threading
 from functools import partial
-
-import celery
-from celery.result import GroupResult
-from ruamel.yaml import YAML, StringIO
+from urllib.parse import urlparse
 
 from .nodepool import NodePool
 from .cnf import Cnf
-from .. import common
+from . import cloudcli, rke2, kubeapi, kubeconfigcache
+from .. import common, config
+
+if typing.TYPE_CHECKING:
+    import celery
+    from celery.result import GroupResult
 
 
 class ClusterException(common.CloudcliException):
     pass
 
 
+# validated clusters are cached per process, tasks for the same cluster receive the same config
+cluster_cache = common.LRUCache(config.CLUSTER_CACHE_SIZE, config.CLUSTER_CACHE_TTL_SECONDS)
+
+
+def get_cluster_cache_key(cnf, creds):
+    # the key includes the creds, so a cached cluster is never returned for a different credentials set
+    digest = hashlib.sha256()
+    digest.update((cnf if isinstance(cnf, str) else json.dumps(cnf, sort_keys=True)).encode())
+    digest.update(b'\0')
+    digest.update(json.dumps(list(creds) if isinstance(creds, (list, tuple)) else creds).encode())
+    return digest.hexdigest()
+
+
 class Cluster:
 
     def __init__(self, cnf: Cnf):
@@ -21,10 +40,17 @@ class Cluster:
             nodepool_name: NodePool(self, nodepool_name)
             for nodepool_name in self.cnf.node_pools.keys()
         }
+        self.kube_api = None
+        self.kube_api_lock = threading.Lock()
 
     @classmethod
     def init_from_cnf_creds(cls, cnf, creds=None):
-        return cls(Cnf(cnf, creds))
+        cache_key = get_cluster_cache_key(cnf, creds)
+        cluster = cluster_cache.get(cache_key)
+        if cluster is None:
+            cluster = cls(Cnf(cnf, creds))
+            cluster_cache.set(cache_key, cluster)
+        return cluster
 
     @property
     def name(self):
@@ -47,12 +73,26 @@ class Cluster:
         assert cluster_server and cluster_token, 'Cluster server and token are missing'
         return cluster_server, cluster_token
 
+    def get_rke2_artifacts_url(self):
+        rke2_mirror = self.cnf.rke2_mirror
+        if rke2_mirror == 'controlplane':
+            controlplane_server_info = self.node_pools['controlplane'].get_node(1).get_server_info()
+            if not controlplane_server_info:
+                raise ClusterException('Controlplane server not found, it is required for the rke2 mirror')
+            _, private_ip = cloudcli.get_server_public_private_ips(controlplane_server_info)
+            return rke2.get_rke2_artifacts_url(f'http://{private_ip}:{config.RKE2_MIRROR_PORT}')
+        elif rke2_mirror:
+            return rke2.get_rke2_artifacts_url(rke2_mirror)
+        else:
+            return None
+
     def get_status(self):
         common.logging.debug('Cluster.get_status')
         controlplane_node = self.node_pools['controlplane'].get_node(1)
         controlplane_server_info = controlplane_node.get_server_info()
         controlplane_public_ip, controlplane_private_ip = controlplane_node.get_public_private_ips(controlplane_server_info)
         cluster_server, _ = self.get_cluster_server_token(controlplane_server_info)
+        kubeconfigcache.invalidate(self, controlplane_public_ip)
         status = {
             'cluster_server': cluster_server,
             'controlplane_public_ip': controlplane_public_ip,
@@ -64,20 +104,77 @@ class Cluster:
                 node_number: node_pool.get_node(node_number).get_server_info()
                 for node_number in node_pool.node_numbers()
             }
-        status['kubectl_version'] = str(controlplane_node.kubectl('version', controlplane_server_info)).strip().split('\n')
-        status['kubectl_top_node'] = str(controlplane_node.kubectl('top node', controlplane_server_info)).strip().split('\n')
+        status.update(self.call_kube_api(lambda kube_api: {
+            'kubernetes_version': kube_api.get_version().get('gitVersion'),
+            'nodes': kubeapi.get_nodes_status(kube_api),
+        }, controlplane_server_info))
         return status
 
-    def get_kubeconfig(self):
+    def run_command(self, command, nodepool_names=None, node_numbers=None, max_parallel=None, on_output=None, timeout_seconds=None):
+        # runs the command on the selected nodes of all the node pools concurrently
+        # node_numbers selects the nodes with these numbers in each of the selected node pools
+        from . import ssh
+        for nodepool_name in nodepool_names or []:
+            if nodepool_name not in self.node_pools:
+                raise ClusterException(f'Node pool {nodepool_name} not found')
+        nodes = [
+            node
+            for nodepool_name in nodepool_names or self.node_pools.keys()
+            for node in self.node_pools[nodepool_name].get_nodes(node_numbers)
+        ]
+        return ssh.get_run_summary(ssh.run_on_nodes(nodes, command, max_parallel, on_output, timeout_seconds))
+
+    def get_kube_api(self, controlplane_server_info=None):
+        # the client is kept on the cluster, which is cached per process, so connections are reused between tasks
+        # the cluster is shared between threads, the lock makes sure only one client is created
+        # a new client is created if the controlplane ip changed, e.g. if controlplane-1 was recreated
+        controlplane_ip = None
+        if controlplane_server_info:
+            controlplane_ip, _ = self.node_pools['controlplane'].get_node(1).get_public_private_ips(controlplane_server_info)
+        with self.kube_api_lock:
+            if self.kube_api is None or (controlplane_ip and urlparse(self.kube_api.server).hostname != controlplane_ip):
+                if controlplane_ip:
+                    kubeconfigcache.invalidate(self, controlplane_ip)
+                self.kube_api = kubeapi.KubeApiClient(self.get_kubeconfig(controlplane_server_info, cached=True))
+            return self.kube_api
+
+    def call_kube_api(self, func, controlplane_server_info=None):
+        kube_api = None
+        try:
+            kube_api = self.get_kube_api(controlplane_server_info)
+            return func(kube_api)
+        except Exception:
+            # the kubeconfig may be outdated, e.g. if controlplane-1 was recreated
+            with self.kube_api_lock:
+                if self.kube_api is kube_api:
+                    self.kube_api = None
+            kubeconfigcache.invalidate(self)
+            raise
+
+    def get_nodes_ready(self):
+        return self.call_kube_api(lambda kube_api: {
+            node['metadata']['name']: kubeapi.is_node_ready(node)
+            for node in kube_api.get_nodes()
+        })
+
+    def get_kubeconfig(self, controlplane_server_info=None, cached=False):
+        from ruamel.yaml import YAML, StringIO
+        if cached:
+            kubeconfig = kubeconfigcache.get(self)
+            if kubeconfig:
+                return kubeconfig
         controlplane_node = self.node_pools['controlplane'].get_node(1)
-        controlplane_server_info = controlplane_node.get_server_info()
+        if not controlplane_server_info:
+            controlplane_server_info = controlplane_node.get_server_info()
         kubeconfig = self.node_pools['controlplane'].get_node(1).ssh('cat /etc/rancher/rke2/rke2.yaml', controlplane_server_info)
         public_ip, _ = controlplane_node.get_public_private_ips(controlplane_server_info)
         kubeconfig = YAML(typ='safe').load(kubeconfig)
         kubeconfig['clusters'][0]['cluster']['server'] = f'https://{public_ip}:6443'
         stream = StringIO()
         YAML(typ='safe').dump(kubeconfig, stream)
-        return stream.getvalue()
+        kubeconfig = stream.getvalue()
+        kubeconfigcache.save(self, public_ip, kubeconfig)
+        return kubeconfig
 
 
 class ClusterCeleryRunner:
@@ -95,30 +192,87 @@ class ClusterCeleryRunner:
     def get_node_celery_runner(self, nodepool_name, node_number):
         return self.cluster.node_pools[nodepool_name].get_node(node_number).get_celery_runner()
 
-    def create(self, task: celery.Task):
+    def create(self, task: 'celery.Task'):
         from cloudcli_server_kubernetes.tasks import create_nodepool
         return ClusterCeleryRunnerResult('create', partial(self.create_update, task, create_nodepool), self.cluster.cnf.creds).export()
 
-    def update(self, task: celery.Task):
-        from cloudcli_server_kubernetes.tasks import update_nodepool
-        return ClusterCeleryRunnerResult('update', partial(self.create_update, task, update_nodepool), self.cluster.cnf.creds).export()
+    def update(self, task: 'celery.Task'):
+        return ClusterCeleryRunnerResult('update', partial(self.apply_update_plan, task), self.cluster.cnf.creds).export()
 
-    def get_cluster_status(self, task: celery.Task):
-        return ClusterCeleryRunnerResult('get_cluster_status', self.cluster.get_status, self.cluster.cnf.creds).export()
+    def get_plan(self, task: 'celery.Task'):
+        from .plan import get_plan
+        return ClusterCeleryRunnerResult('get_plan', partial(get_plan, self.cluster), self.cluster.cnf.creds).export()
 
-    def get_kubeconfig(self, task: celery.Task):
+    def get_cluster_status(self, task: 'celery.Task'):
+        from . import snapshot
+        return ClusterCeleryRunnerResult('get_cluster_status', partial(snapshot.refresh, self.cluster), self.cluster.cnf.creds).export()
+
+    def get_kubeconfig(self, task: 'celery.Task'):
         return ClusterCeleryRunnerResult('get_kubeconfig', self.cluster.get_kubeconfig, self.cluster.cnf.creds).export()
 
-    def create_update(self, task: celery.Task, create_update_task):
+    def run_command(self, task: 'celery.Task', command, nodepool_names=None, node_numbers=None, max_parallel=None, timeout_seconds=None):
+        # the output is streamed to the worker log, the result has the exit code and output tail of each node
+
+        def on_output(node, line):
+            common.logging.info(f'{node.server_name_prefix}: {line.rstrip()}')
+
+        return ClusterCeleryRunnerResult('run_command', partial(
+            self.cluster.run_command, command, nodepool_names, node_numbers, max_parallel, on_output, timeout_seconds
+        ), self.cluster.cnf.creds).export()
+
+    def collect_diagnostics(self, task: 'celery.Task'):
+        from . import diagnostics
+        return ClusterCeleryRunnerResult('collect_diagnostics', partial(diagnostics.collect, self.cluster), self.cluster.cnf.creds).export()
+
+    def replenish_warm_pool(self, task: 'celery.Task'):
+        return ClusterCeleryRunnerResult('replenish_warm_pool', self.apply_replenish_warm_pool, self.cluster.cnf.creds).export()
+
+    def apply_replenish_warm_pool(self):
+        import celery
+        from cloudcli_server_kubernetes.tasks import create_warm_server
+        from . import warmpool
+        trimmed_slots = warmpool.trim_slots(self.cluster)
+        reserved_slots = warmpool.reserve_slots(self.cluster)
         cnf = self.cluster.cnf.export()
-        group_result: GroupResult = celery.chain(
-            create_update_task.si(cnf, 'controlplane'),
+        group_result: 'GroupResult' = celery.group(
+            create_warm_server.si(cnf, slot) for slot in reserved_slots
+        ).delay() if reserved_slots else None
+        return {
+            'trimmed_slots': trimmed_slots,
+            'reserved_slots': reserved_slots,
+            'create_task_ids': [c.id for c in group_result.children] if group_result else [],
+        }
+
+    def create_warm_server(self, task: 'celery.Task', slot):
+        from . import warmpool
+        return ClusterCeleryRunnerResult('create_warm_server', partial(warmpool.create_server, self.cluster, slot), self.cluster.cnf.creds).export()
+
+    def apply_update_plan(self, task: 'celery.Task'):
+        from cloudcli_server_kubernetes.tasks import update_nodepool
+        from .plan import get_plan
+        return self.create_update(task, update_nodepool, get_plan(self.cluster))
+
+    def create_update(self, task: 'celery.Task', create_update_task, update_plan=None):
+        import celery
+        cnf = self.cluster.cnf.export()
+
+        def get_signature(nodepool_name):
+            if update_plan:
+                return create_update_task.si(cnf, nodepool_name, None, update_plan['node_pools'][nodepool_name])
+            else:
+                return create_update_task.si(cnf, nodepool_name)
+
+        group_result: 'GroupResult' = celery.chain(
+            get_signature('controlplane'),
             celery.group(
-                create_update_task.si(cnf, nodepool_name)
+                get_signature(nodepool_name)
                 for nodepool_name in self.cluster.node_pools.keys()
                 if nodepool_name != 'controlplane'
             )
         ).delay()
+        # also when the warm pool is disabled, to terminate the remaining warm pool servers
+        from cloudcli_server_kubernetes.tasks import replenish_warm_pool
+        replenish_warm_pool.delay(cnf)
         task_ids = [group_result.id]
         result = group_result
         while result.parent:
@@ -126,6 +280,7 @@ class ClusterCeleryRunner:
             result = result.parent
         return {
             'task_ids': task_ids,
+            **({'plan': update_plan} if update_plan else {}),
         }
 
 
@@ -3,15 +3,33 @@ import json
 from typing import Optional
 from functools import cached_property
 
-from ruamel.yaml import YAML
-
 from .. import common, config
 
 
+# ssh - rke2 is installed over ssh after the server is created
+# init-script - rke2 is installed by the server init script on first boot
+BOOTSTRAP_METHODS = ['ssh', 'init-script']
+
+
 class CnfConfigError(common.CloudcliException):
     pass
 
 
+def yaml_safe_load(stream):
+    from ruamel.yaml import YAML
+    return YAML(typ='safe').load(stream)
+
+
+def parse_cnf_string(cnf):
+    # configs passed between tasks are exported as JSON, parsing them with json is much faster than YAML
+    if cnf.startswith('{'):
+        try:
+            return json.loads(cnf)
+        except ValueError:
+            pass
+    return yaml_safe_load(cnf)
+
+
 def parse_file(file):
     if file:
         file = os.path.expanduser(file)
@@ -38,8 +56,13 @@ class CnfNodePool:
             assert len(self.nodes) > 0, f'{msg}.nodes is required'
             if not self.cnf.allow_high_availability and self.name == 'controlplane':
                 assert len(self.nodes) == 1, f'{msg}.nodes must be 1 when high availability is disabled'
+            assert self.max_parallel is None or self.max_parallel > 0, f'{msg}.max-parallel must be a positive number'
+            assert self.max_unavailable is None or self.max_unavailable > 0, f'{msg}.max-unavailable must be a positive number'
+            assert self.join_concurrency > 0, f'{msg}.join-concurrency must be a positive number'
         except AssertionError as e:
             raise CnfConfigError(str(e))
+        except (ValueError, TypeError):
+            raise CnfConfigError(f'{msg}.nodes, max-parallel, max-unavailable and join-concurrency must be numbers')
 
     @cached_property
     def name(self) -> str:
@@ -72,6 +95,21 @@ class CnfNodePool:
             **(self.node_pool_config.get('rke2-config') or {}),
         }
 
+    @cached_property
+    def max_parallel(self) -> Optional[int]:
+        max_parallel = self.node_pool_config.get('max-parallel')
+        return int(max_parallel) if max_parallel is not None else None
+
+    @cached_property
+    def max_unavailable(self) -> Optional[int]:
+        max_unavailable = self.node_pool_config.get('max-unavailable')
+        return int(max_unavailable) if max_unavailable is not None else None
+
+    @cached_property
+    def join_concurrency(self) -> int:
+        # number of controlplane nodes which join the cluster at the same time after the first node is ready
+        return int(self.node_pool_config.get('join-concurrency') or 1)
+
 
 class Cnf:
 
@@ -85,11 +123,11 @@ class Cnf:
                         except:
                             raise CnfConfigError('Invalid JSON file')
                     elif cnf.endswith('.yaml'):
-                        cnf = YAML(typ='safe').load(f)
+                        cnf = yaml_safe_load(f)
                     else:
                         raise CnfConfigError('Unsupported file format')
             else:
-                cnf = YAML(typ='safe').load(cnf)
+                cnf = parse_cnf_string(cnf)
         if not isinstance(cnf, dict):
             raise CnfConfigError('Invalid config format')
         self.cnf = cnf
@@ -106,8 +144,14 @@ class Cnf:
             assert self.ssh_key_private, 'cluster.ssh-key.private is required'
             assert self.ssh_key_public, 'cluster.ssh-key.public is required'
             assert self.private_network_name, 'cluster.private-network.name is required'
+            assert not self.rke2_mirror or self.rke2_mirror == 'controlplane' or self.rke2_mirror.startswith(('http://', 'https://')), \
+                'cluster.rke2-mirror must be "controlplane" or a mirror url'
+            assert self.bootstrap in BOOTSTRAP_METHODS, f'cluster.bootstrap must be one of: {", ".join(BOOTSTRAP_METHODS)}'
             for node_pool in self.node_pools.values():
                 node_pool.validate()
+            assert self.warm_pool_size >= 0, 'cluster.warm-pool.size must not be negative'
+            if self.warm_pool_size:
+                assert self.warm_pool_node_pool in self.node_pools, 'cluster.warm-pool.node-pool must be one of the node pools'
             assert self.auth_client_id and self.auth_secret, 'Auth credentials are missing'
         except AssertionError as e:
             raise CnfConfigError(str(e))
@@ -163,6 +207,26 @@ class Cnf:
     def controlplane_server_name(self) -> Optional[str]:
         return self.cluster.get('controlplane-server-name')
 
+    @cached_property
+    def bootstrap(self) -> str:
+        return self.cluster.get('bootstrap') or 'ssh'
+
+    @cached_property
+    def rke2_mirror(self) -> Optional[str]:
+        return self.cluster.get('rke2-mirror')
+
+    @cached_property
+    def warm_pool(self) -> dict:
+        return self.cluster.get('warm-pool') or {}
+
+    @cached_property
+    def warm_pool_size(self) -> int:
+        return int(self.warm_pool.get('size') or 0)
+
+    @cached_property
+    def warm_pool_node_pool(self) -> Optional[str]:
+        return self.warm_pool.get('node-pool')
+
     @cached_property
     def allow_high_availability(self) -> bool:
         return bool(self.cluster.get('allow-high-availability'))
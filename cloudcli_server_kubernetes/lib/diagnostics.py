@@ -0,0 +1,230 @@
+import io
+import os
+import json
+import time
+import uuid
+import typing
+import logging
+import zipfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .. import common, config
+
+if typing.TYPE_CHECKING:
+    from .cluster import Cluster
+    from .node import Node
+
+
+class DiagnosticsException(common.CloudcliException):
+    pass
+
+
+KUBECTL = 'KUBECONFIG=/etc/rancher/rke2/rke2.yaml /var/lib/rancher/rke2/bin/kubectl'
+
+# values of rke2 config keys which contain any of these words are redacted, e.g. etcd-s3-secret-key or datastore-endpoint
+REDACTED_RKE2_CONFIG_KEY_WORDS = ['token', 'secret', 'password', 'passwd', 'key', 'credential', 'endpoint']
+
+# files collected from each node, the commands limit the output to max_bytes
+NODE_FILES = [
+    ('rke2-journal.log', "journalctl -u 'rke2-*' --no-pager | tail -c {max_bytes}"),
+    ('rke2-config.yaml', (
+        "sed -E 's/^(\\s*\"?[a-z0-9_-]*(" + '|'.join(REDACTED_RKE2_CONFIG_KEY_WORDS) + ")[a-z0-9_-]*\"?\\s*:).*/\\1 REDACTED/I'"
+        " /etc/rancher/rke2/config.yaml | head -c {max_bytes}"
+    )),
+]
+
+# files collected only from the first controlplane node
+CLUSTER_FILES = [
+    ('kubectl-get-nodes.txt', f'{KUBECTL} get nodes -o wide | head -c {{max_bytes}}'),
+    ('kubectl-describe-nodes.txt', f'{KUBECTL} describe nodes | head -c {{max_bytes}}'),
+    ('kubectl-get-pods.txt', f'{KUBECTL} get pods -A -o wide | head -c {{max_bytes}}'),
+    ('kubectl-get-events.txt', f'{KUBECTL} get events -A --sort-by=.lastTimestamp | head -c {{max_bytes}}'),
+]
+
+COPY_BLOCK_BYTES = 64 * 1024
+
+
+class ChunkWriter(io.RawIOBase):
+    # unseekable file which stores the written data in the database in chunks, so the archive is never fully in memory
+
+    def __init__(self, bundle_id):
+        super().__init__()
+        self.bundle_id = bundle_id
+        self.buffer = bytearray()
+        self.chunk_number = 0
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= config.DIAGNOSTICS_CHUNK_BYTES:
+            self.save_chunk(bytes(self.buffer[:config.DIAGNOSTICS_CHUNK_BYTES]))
+            del self.buffer[:config.DIAGNOSTICS_CHUNK_BYTES]
+        return len(data)
+
+    def save_chunk(self, data):
+        from .. import db
+        with db.get_engine().begin() as conn:
+            conn.execute(db.diagnostics_chunk.insert().values(
+                bundle_id=self.bundle_id,
+                chunk_number=self.chunk_number,
+                data=data,
+                created_at=db.utcnow(),
+            ))
+        self.chunk_number += 1
+
+    def close(self):
+        if not self.closed and self.buffer:
+            self.save_chunk(bytes(self.buffer))
+            self.buffer.clear()
+        super().close()
+
+
+class FileWriter:
+    # writes the command output lines to a file, up to the max file size
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.truncated = False
+
+    def __call__(self, line):
+        data = line.encode()
+        if self.size + len(data) > config.DIAGNOSTICS_MAX_FILE_BYTES:
+            self.truncated = True
+        else:
+            self.f.write(data)
+            self.size += len(data)
+
+
+def collect_node_files(node: 'Node', files, tmpdir, deadline, stopped: threading.Event):
+    # runs the node commands one by one, returns the output filename and result of each file
+    results = []
+    try:
+        server_info = node.get_server_info()
+        if not server_info:
+            raise DiagnosticsException('Server does not exist')
+    except Exception as e:
+        error = str(e) if isinstance(e, common.CloudcliException) else 'Failed to get server info'
+        return [(f'{node.server_name_prefix}/{name}', None, {'error': error}) for name, _ in files]
+    for name, command in files:
+        name = f'{node.server_name_prefix}/{name}'
+        remaining_seconds = deadline - time.monotonic()
+        if stopped.is_set() or remaining_seconds <= 0:
+            results.append((name, None, {'error': 'Skipped, the diagnostics size or time limit was reached'}))
+            continue
+        filename = os.path.join(tmpdir, name.replace('/', '_'))
+        try:
+            with open(filename, 'wb') as f:
+                file_writer = FileWriter(f)
+                res = node.ssh_exec(command.format(max_bytes=config.DIAGNOSTICS_MAX_FILE_BYTES), server_info, file_writer, remaining_seconds)
+            results.append((name, filename, {
+                'exit_code': res['exit_code'],
+                'error': res['error'],
+                'bytes': file_writer.size,
+                'truncated': file_writer.truncated,
+            }))
+        except Exception as e:
+            if not isinstance(e, common.CloudcliException):
+                logging.exception(f'Failed to collect {name}')
+            results.append((name, None, {'error': str(e) if isinstance(e, common.CloudcliException) else 'An unexpected error occurred'}))
+    return results
+
+
+def write_file(zf: zipfile.ZipFile, writer: ChunkWriter, name, filename):
+    # copies the file into the archive, returns False if the archive size limit was reached
+    # the limit is checked before each block, so the archive may exceed it by about one block
+    with open(filename, 'rb') as src, zf.open(name, 'w') as dst:
+        while block := src.read(COPY_BLOCK_BYTES):
+            if writer.size >= config.DIAGNOSTICS_MAX_BYTES:
+                return False
+            dst.write(block)
+    return True
+
+
+def collect(cluster: 'Cluster'):
+    # collects the diagnostics files from all the nodes in parallel into a zip archive stored in the database
+    # each node output is written to a temporary file, which is added to the archive when the node completes
+    from .. import db
+    bundle_id = str(uuid.uuid4())
+    with db.get_engine().begin() as conn:
+        conn.execute(db.diagnostics_bundle.insert().values(
+            bundle_id=bundle_id,
+            account=db.get_account(cluster.cnf.creds),
+            cluster_name=cluster.name,
+            creds_fingerprint=common.get_creds_fingerprint(cluster.cnf.creds),
+            size=None,
+            created_at=db.utcnow(),
+        ))
+    deadline = time.monotonic() + config.DIAGNOSTICS_TIMEOUT_SECONDS
+    stopped = threading.Event()
+    nodes = [node for nodepool in cluster.node_pools.values() for node in nodepool.get_nodes()]
+    manifest = {'cluster_name': cluster.name, 'files': {}, 'truncated': False}
+    writer = ChunkWriter(bundle_id)
+    with (
+        tempfile.TemporaryDirectory() as tmpdir,
+        zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_DEFLATED) as zf,
+        ThreadPoolExecutor(max(1, min(len(nodes), config.SSH_FANOUT_MAX_PARALLEL))) as executor,
+    ):
+        futures = [
+            executor.submit(collect_node_files, node, NODE_FILES + (CLUSTER_FILES if node.is_first_controlplane else []), tmpdir, deadline, stopped)
+            for node in nodes
+        ]
+        for future in as_completed(futures):
+            for name, filename, res in future.result():
+                if filename and not stopped.is_set():
+                    if not write_file(zf, writer, name, filename):
+                        stopped.set()
+                        res['truncated'] = True
+                        manifest['truncated'] = True
+                elif filename:
+                    res = {'exit_code': None, 'error': 'Skipped, the diagnostics size or time limit was reached'}
+                if filename:
+                    os.unlink(filename)
+                manifest['files'][name] = res
+        manifest['timed_out'] = time.monotonic() > deadline
+        zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+    writer.close()
+    with db.get_engine().begin() as conn:
+        conn.execute(db.diagnostics_bundle.update().where(db.diagnostics_bundle.c.bundle_id == bundle_id).values(size=writer.size))
+    return {
+        'bundle_id': bundle_id,
+        'size': writer.size,
+        'files_collected': len([res for res in manifest['files'].values() if res.get('exit_code') == 0]),
+        'files_failed': len([res for res in manifest['files'].values() if res.get('exit_code') != 0]),
+        'truncated': manifest['truncated'],
+        'timed_out': manifest['timed_out'],
+    }
+
+
+def get_bundle(bundle_id, creds):
+    # returns the completed bundle, or None if it doesn't exist or was saved by other creds
+    from .. import db
+    with db.get_engine().connect() as conn:
+        return conn.execute(db.diagnostics_bundle.select().where(
+            (db.diagnostics_bundle.c.bundle_id == bundle_id)
+            & (db.diagnostics_bundle.c.account == db.get_account(creds))
+            & (db.diagnostics_bundle.c.creds_fingerprint == common.get_creds_fingerprint(creds))
+            & db.diagnostics_bundle.c.size.isnot(None)
+        )).first()
+
+
+def iter_bundle_chunks(bundle_id):
+    # one chunk per query, so a download holds at most one chunk in memory
+    from .. import db
+    chunk_number = 0
+    while True:
+        with db.get_engine().connect() as conn:
+            data = conn.execute(db.diagnostics_chunk.select().with_only_columns(db.diagnostics_chunk.c.data).where(
+                (db.diagnostics_chunk.c.bundle_id == bundle_id)
+                & (db.diagnostics_chunk.c.chunk_number == chunk_number)
+            )).scalar()
+        if data is None:
+            return
+        yield data
+        chunk_number += 1
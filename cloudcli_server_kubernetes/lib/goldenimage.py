@@ -0,0 +1,70 @@
+import re
+import time
+import typing
+import logging
+
+from . import cloudcli, rke2
+from .. import common, config
+
+if typing.TYPE_CHECKING:
+    from .cluster import Cluster
+
+
+class GoldenImageException(common.CloudcliException):
+    pass
+
+
+def get_default_image_name(cluster: 'Cluster'):
+    return f'{cluster.name}-rke2-{re.sub("[^a-zA-Z0-9]", "-", config.RKE2_VERSION)}'
+
+
+def wait_server_powered_off(creds, server_name_prefix):
+    # the preparation script powers off the server when it's done
+    max_time = time.time() + config.RKE2_BOOTSTRAP_TIMEOUT_SECONDS
+    while time.time() < max_time:
+        server_info = cloudcli.get_server_info(creds, server_name_prefix)
+        if server_info and server_info.get('power') == 'off':
+            return server_info
+        time.sleep(10)
+    raise GoldenImageException('Timeout waiting for the golden image server to be prepared')
+
+
+def terminate_server(creds, server_name_prefix):
+    server_info = cloudcli.get_server_info(creds, server_name_prefix)
+    if server_info:
+        try:
+            cloudcli.terminate_server(creds, server_info['name'])
+        except Exception:
+            logging.exception(f'Failed to terminate golden image server {server_info["name"]}')
+
+
+def create(cluster: 'Cluster', nodepool_name='controlplane', image_name=None):
+    # creates a temporary server from the node pool node config with rke2 preinstalled and saves it as an image
+    # nodes created from the image skip the rke2 download and install
+    creds = cluster.cnf.creds
+    image_name = image_name or get_default_image_name(cluster)
+    server_name_prefix = f'{cluster.name}-golden'
+    if cloudcli.get_server_info(creds, server_name_prefix):
+        raise GoldenImageException(f'Golden image server {server_name_prefix} already exists, delete it and try again')
+    cluster.node_pools[nodepool_name].create_server(
+        server_name_prefix, rke2.get_rke2_golden_image_script(cluster.get_rke2_artifacts_url())
+    )
+    try:
+        server_info = wait_server_powered_off(creds, server_name_prefix)
+    except Exception:
+        terminate_server(creds, server_name_prefix)
+        raise
+    try:
+        image = cloudcli.create_server_image(creds, server_info['name'], image_name)
+    except Exception as e:
+        # the prepared server is kept, so the image can be created from it manually
+        raise GoldenImageException(
+            f'Failed to create the golden image, the prepared server {server_info["name"]} was kept: {e}'
+        ) from e
+    terminate_server(creds, server_name_prefix)
+    return {
+        'image_name': image_name,
+        'rke2_version': config.RKE2_VERSION,
+        'image': image,
+        'message': 'Golden image created, set it as the image in the node pools node-config',
+    }
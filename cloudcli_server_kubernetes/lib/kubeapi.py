@@ -0,0 +1,84 @@
+import os
+import base64
+import tempfile
+
+from .. import common, config, tracing
+
+
+class KubeApiException(common.CloudcliException):
+    pass
+
+
+class KubeApiClient:
+    # calls the kubernetes api server using the cluster kubeconfig, keeps the connections open between calls
+
+    def __init__(self, kubeconfig: str):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from .cnf import yaml_safe_load
+        kubeconfig = yaml_safe_load(kubeconfig)
+        cluster = kubeconfig['clusters'][0]['cluster']
+        user = kubeconfig['users'][0]['user']
+        self.server = cluster['server'].rstrip('/')
+        # requests requires the certificates as files, they are deleted with the client
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=config.KUBE_API_POOL_SIZE))
+        if cluster.get('certificate-authority-data'):
+            self.session.verify = self.write_file('ca.crt', cluster['certificate-authority-data'])
+        if user.get('client-certificate-data') and user.get('client-key-data'):
+            self.session.cert = (
+                self.write_file('client.crt', user['client-certificate-data']),
+                self.write_file('client.key', user['client-key-data']),
+            )
+        if user.get('token'):
+            self.session.headers['Authorization'] = f'Bearer {user["token"]}'
+
+    def write_file(self, filename, data_b64):
+        filename = os.path.join(self.tmpdir.name, filename)
+        with open(filename, 'wb') as f:
+            f.write(base64.b64decode(data_b64))
+        os.chmod(filename, 0o600)
+        return filename
+
+    def get(self, path, allow_not_found=False):
+        with tracing.span('kube_api_request', path=path) as span:
+            res = self.session.get(f'{self.server}{path}', timeout=config.KUBE_API_TIMEOUT_SECONDS)
+            span.set_tag('status', res.status_code)
+        if allow_not_found and res.status_code == 404:
+            return None
+        if res.status_code != 200:
+            raise KubeApiException(f'Kubernetes API request failed: {path} {res.status_code}')
+        return res.json()
+
+    def get_version(self):
+        return self.get('/version')
+
+    def get_nodes(self):
+        return self.get('/api/v1/nodes')['items']
+
+    def get_node_metrics(self):
+        # requires the metrics server, which is installed by default in rke2
+        node_metrics = self.get('/apis/metrics.k8s.io/v1beta1/nodes', allow_not_found=True)
+        return {item['metadata']['name']: item['usage'] for item in node_metrics['items']} if node_metrics else {}
+
+
+def is_node_ready(node):
+    return any(
+        condition['type'] == 'Ready' and condition['status'] == 'True'
+        for condition in node['status'].get('conditions', [])
+    )
+
+
+def get_nodes_status(kube_api: KubeApiClient):
+    node_metrics = kube_api.get_node_metrics()
+    return {
+        node['metadata']['name']: {
+            'ready': is_node_ready(node),
+            'kubelet_version': node['status'].get('nodeInfo', {}).get('kubeletVersion'),
+            'addresses': {address['type']: address['address'] for address in node['status'].get('addresses', [])},
+            'capacity': node['status'].get('capacity', {}),
+            'usage': node_metrics.get(node['metadata']['name']),
+        }
+        for node in kube_api.get_nodes()
+    }
@@ -0,0 +1,84 @@
+import typing
+import logging
+
+from .. import common, config
+
+if typing.TYPE_CHECKING:
+    from .cluster import Cluster
+
+
+def get_fernet():
+    # returns None if the cache is disabled because no encryption key is configured
+    from cryptography.fernet import Fernet, MultiFernet
+    if not config.KUBECONFIG_CACHE_ENCRYPTION_KEYS:
+        return None
+    return MultiFernet([Fernet(key.strip()) for key in config.KUBECONFIG_CACHE_ENCRYPTION_KEYS.split(',') if key.strip()])
+
+
+def get_where(cluster: 'Cluster'):
+    from .. import db
+    return (
+        (db.kubeconfig_cache.c.account == db.get_account(cluster.cnf.creds))
+        & (db.kubeconfig_cache.c.cluster_name == cluster.name)
+    )
+
+
+def save(cluster: 'Cluster', controlplane_ip, kubeconfig):
+    from .. import db
+    try:
+        fernet = get_fernet()
+        if fernet is None:
+            return
+        with db.get_engine().begin() as conn:
+            conn.execute(db.kubeconfig_cache.delete().where(get_where(cluster)))
+            conn.execute(db.kubeconfig_cache.insert().values(
+                account=db.get_account(cluster.cnf.creds),
+                cluster_name=cluster.name,
+                creds_fingerprint=common.get_creds_fingerprint(cluster.cnf.creds),
+                controlplane_ip=controlplane_ip,
+                kubeconfig=fernet.encrypt(kubeconfig.encode()).decode(),
+                updated_at=db.utcnow(),
+            ))
+    except Exception:
+        logging.exception(f'Failed to cache kubeconfig for {cluster.name}')
+
+
+def get(cluster: 'Cluster'):
+    # returns the cached kubeconfig or None if it's missing, expired, was saved by other creds or can't be decrypted
+    from .. import db
+    try:
+        fernet = get_fernet()
+        if fernet is None:
+            return None
+        with db.get_engine().connect() as conn:
+            row = conn.execute(db.kubeconfig_cache.select().where(
+                get_where(cluster) & (db.kubeconfig_cache.c.creds_fingerprint == common.get_creds_fingerprint(cluster.cnf.creds))
+            )).first()
+        if row is None or (db.utcnow() - row.updated_at).total_seconds() > config.KUBECONFIG_CACHE_TTL_SECONDS:
+            return None
+        return fernet.decrypt(row.kubeconfig.encode()).decode()
+    except Exception:
+        logging.exception(f'Failed to get cached kubeconfig for {cluster.name}')
+        return None
+
+
+def invalidate(cluster: 'Cluster', controlplane_ip=None):
+    # when controlplane_ip is set, invalidates only if the cached kubeconfig is for a different ip
+    from .. import db
+    where = get_where(cluster)
+    if controlplane_ip:
+        where = where & (db.kubeconfig_cache.c.controlplane_ip != controlplane_ip)
+    try:
+        with db.get_engine().begin() as conn:
+            conn.execute(db.kubeconfig_cache.delete().where(where))
+    except Exception:
+        logging.exception(f'Failed to invalidate cached kubeconfig for {cluster.name}')
+
+
+def get_kubeconfig_task_id(cluster: 'Cluster'):
+    # stores the cached kubeconfig as a completed get_kubeconfig task result, returns None if it's not cached
+    from .cluster import ClusterCeleryRunnerResult
+    kubeconfig = get(cluster)
+    if kubeconfig is None:
+        return None
+    return ClusterCeleryRunnerResult('get_kubeconfig', kubeconfig, cluster.cnf.creds, meta={'cached': True}).store()
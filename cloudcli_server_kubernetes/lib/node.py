@@ -1,20 +1,18 @@
 import os
-import json
-import base64
 import typing
+import contextlib
 import logging
 import tempfile
 import subprocess
 
-import celery
-
-from .. import config, common
-from ..celery import app as celery_app
+from .. import config, common, metrics, tracing, timing
 
 from . import cloudcli
 from . import rke2
+from . import ssh
 
 if typing.TYPE_CHECKING:
+    import celery
     from .nodepool import NodePool
 
 
@@ -55,65 +53,107 @@ class Node:
     def creds(self):
         return self.nodepool.cluster.cnf.creds
 
-    def create_server(self):
-        command_id = cloudcli.find_server_command_in_queue(cloudcli.CREATE_SERVER_COMMAND_INFO, self.server_name_prefix, self.creds)
-        if not command_id:
-            node_config = {
-                **config.DEFAULT_SERVER_CONFIG,
-                **self.nodepool.node_pool_config
-            }
-            data = {
-                "name": cloudcli.get_server_name(self.server_name_prefix),
-                "password": "",
-                "passwordValidate": "",
-                "ssh-key": self.nodepool.cluster.cnf.ssh_key_public,
-                "datacenter": self.nodepool.cluster.cnf.datacenter,
-                "image": node_config['image'],
-                "cpu": node_config['cpu'],
-                "ram": node_config['ram'],
-                "disk": node_config['disk'],
-                "dailybackup": node_config['dailybackup'],
-                "managed": node_config['managed'],
-                "network": f"id=0,name=wan,ip=auto id=1,name={self.nodepool.cluster.cnf.private_network_name},ip=auto",
-                "quantity": 1,
-                "billingcycle": node_config['billingcycle'],
-                "monthlypackage": node_config['monthlypackage'],
-                "poweronaftercreate": "yes",
-            }
-            logging.debug(f'Creating server\n{json.dumps(data, indent=2)}')
-            status, res = cloudcli.cloudcli_server_request("/service/server", self.creds, method="POST", json=data)
-            if status != 200 or len(res) != 1:
-                raise NodeException(f'Create server failed: {status} {res}')
-            command_id = res[0]
-        cloudcli.wait_command(self.creds, command_id)
-        server_info = self.get_server_info()
-        if not server_info:
-            raise NodeException('Server not found after creation')
-        return server_info
+    def create_server(self, init_script=None):
+        return self.nodepool.create_server(self.server_name_prefix, init_script)
 
-    def create(self):
-        server_info = self.get_server_info()
-        if not server_info:
-            server_info = self.create_server()
-        is_server = self.nodepool.cluster.cnf.node_pools[self.nodepool.name].is_server
-        if self.nodepool.name == 'controlplane' and self.node_number == 1:
+    @property
+    def is_server(self):
+        return self.nodepool.cluster.cnf.node_pools[self.nodepool.name].is_server
+
+    @property
+    def is_first_controlplane(self):
+        return self.nodepool.name == 'controlplane' and self.node_number == 1
+
+    def get_rke2_args(self, cluster_server_token=None):
+        if self.is_first_controlplane:
             cluster_server, cluster_token = None, None
         else:
-            cluster_server, cluster_token = self.nodepool.cluster.get_cluster_server_token()
-        rke2_init_script = rke2.get_rke2_init_script(
+            cluster_server, cluster_token = cluster_server_token or self.nodepool.cluster.get_cluster_server_token()
+        return (
             self.server_name_prefix,
-            is_server,
+            self.is_server,
             cluster_server,
             cluster_token,
+            self.nodepool.cluster.cnf.node_pools[self.nodepool.name].rke2_config,
         )
-        rke2_systemd_unit = rke2.get_rke2_systemd_unit(is_server)
-        self.ssh_run_script(f'''
-            if systemctl is-active {rke2_systemd_unit}; then
-                echo RKE2 already installed
-            else
-                {rke2_init_script}
-            fi
-        ''', server_info)
+
+    @property
+    def serves_rke2_mirror(self):
+        return self.is_first_controlplane and self.nodepool.cluster.cnf.rke2_mirror == 'controlplane'
+
+    def get_rke2_fingerprint(self, rke2_args):
+        return rke2.get_rke2_fingerprint(*rke2_args, serve_mirror=self.serves_rke2_mirror)
+
+    def get_rke2_install_kwargs(self):
+        if self.serves_rke2_mirror:
+            return {'serve_mirror': True}
+        else:
+            return {'artifacts_url': self.nodepool.cluster.get_rke2_artifacts_url()}
+
+    def record_state(self, rke2_args):
+        from . import plan
+        try:
+            plan.record_node_state(self, self.get_rke2_fingerprint(rke2_args))
+        except Exception:
+            logging.exception(f'Failed to record node state for {self.server_name_prefix}')
+        if self.is_first_controlplane:
+            from . import kubeconfigcache
+            kubeconfigcache.invalidate(self.nodepool.cluster)
+
+    def claim_warm_server(self):
+        from . import warmpool
+        server_info = warmpool.claim(self)
+        if server_info:
+            from cloudcli_server_kubernetes.tasks import replenish_warm_pool
+            replenish_warm_pool.delay(self.nodepool.cluster.cnf.export())
+            # a recently created warm pool server may still be booting or installing rke2
+            self.wait_ssh_ready(server_info)
+            self.ssh_run_script(rke2.get_rke2_wait_preinstall_script(config.RKE2_BOOTSTRAP_TIMEOUT_SECONDS), server_info)
+        return server_info
+
+    def create(self):
+        server_info = self.get_server_info()
+        if not server_info:
+            server_info = self.claim_warm_server()
+        if not server_info and self.nodepool.cluster.cnf.bootstrap == 'init-script':
+            # rke2 install starts on first boot, we only need to wait for it to complete
+            rke2_args = self.get_rke2_args()
+            server_info = self.create_server(rke2.get_rke2_init_script(*rke2_args, **self.get_rke2_install_kwargs()))
+            self.wait_ssh_ready(server_info)
+            self.wait_rke2_bootstrap(rke2_args, server_info)
+            self.record_state(rke2_args)
+        else:
+            if not server_info:
+                server_info = self.create_server()
+                self.wait_ssh_ready(server_info)
+            rke2_args = self.get_rke2_args()
+            rke2_init_script = rke2.get_rke2_init_script(*rke2_args, **self.get_rke2_install_kwargs())
+            rke2_systemd_unit = rke2.get_rke2_systemd_unit(self.is_server)
+            output = self.ssh_run_script(f'''
+                if systemctl is-active {rke2_systemd_unit}; then
+                    echo RKE2 already installed
+                else
+                    {rke2_init_script}
+                fi
+            ''', server_info)
+            if 'RKE2 already installed' not in str(output):
+                self.record_state(rke2_args)
+        return {
+            'nodepool_name': self.nodepool.name,
+            'node_number': self.node_number,
+            'message': 'Server Created Successfully',
+        }
+
+    def wait_rke2_bootstrap(self, rke2_args, server_info):
+        script = rke2.get_rke2_wait_bootstrap_script(self.get_rke2_fingerprint(rke2_args), config.RKE2_BOOTSTRAP_TIMEOUT_SECONDS)
+        try:
+            self.ssh_run_script(script, server_info)
+        except subprocess.CalledProcessError:
+            raise NodeException('RKE2 installation by the server init script did not complete')
+
+    def create_server_only(self):
+        if not self.get_server_info():
+            self.create_server()
         return {
             'nodepool_name': self.nodepool.name,
             'node_number': self.node_number,
@@ -128,20 +168,49 @@ class Node:
             server_info = self.get_server_info()
         return cloudcli.get_server_public_private_ips(server_info)
 
-    def ssh(self, command, server_info=None):
+    def wait_ssh_ready(self, server_info=None):
+        # a newly created server may not accept ssh connections yet
         public_ip, _ = self.get_public_private_ips(server_info)
+        ssh.wait_ssh_ready([public_ip])
+
+    @contextlib.contextmanager
+    def ssh_key_file(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             filename = os.path.join(tmpdir, 'id_rsa')
             with open(filename, 'w') as f:
                 f.write(self.nodepool.cluster.cnf.ssh_key_private)
             os.chmod(filename, 0o600)
-            return subprocess.check_output([
-                'ssh', '-i', filename, '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null', f'root@{public_ip}', command
-            ], text=True)
+            yield filename
+
+    def ssh(self, command, server_info=None):
+        public_ip, _ = self.get_public_private_ips(server_info)
+        with (
+            tracing.span('ssh', node=self.server_name_prefix),
+            metrics.time_node_ssh(self.server_name_prefix),
+            timing.record('ssh'),
+            self.ssh_key_file() as filename
+        ):
+            try:
+                return subprocess.check_output([
+                    'ssh', '-i', filename, *ssh.get_ssh_options(), f'root@{public_ip}', command
+                ], text=True, timeout=config.SSH_COMMAND_TIMEOUT_SECONDS)
+            except subprocess.TimeoutExpired:
+                raise ssh.SshException(f'SSH command on {self.server_name_prefix} did not complete in {config.SSH_COMMAND_TIMEOUT_SECONDS} seconds')
+
+    def ssh_exec(self, command, server_info=None, on_output=None, timeout_seconds=None):
+        # unlike ssh, returns the exit code instead of raising on failure, and streams the output to on_output
+        public_ip, _ = self.get_public_private_ips(server_info)
+        with (
+            tracing.span('ssh', node=self.server_name_prefix),
+            metrics.time_node_ssh(self.server_name_prefix),
+            timing.record('ssh'),
+            self.ssh_key_file() as filename
+        ):
+            return ssh.run(['ssh', '-i', filename, *ssh.get_ssh_options(), f'root@{public_ip}', command], on_output, timeout_seconds)
 
     def ssh_run_script(self, script, server_info=None):
-        script_b64 = base64.b64encode(script.encode()).decode()
-        return self.ssh(f'echo {script_b64} | base64 -d | bash', server_info)
+        with tracing.span('ssh_run_script', node=self.server_name_prefix):
+            return self.ssh(ssh.get_run_script_command(script), server_info)
 
     def kubectl(self, command, server_info=None):
         return self.ssh(f'KUBECONFIG=/etc/rancher/rke2/rke2.yaml /var/lib/rancher/rke2/bin/kubectl {command}', server_info)
@@ -150,22 +219,19 @@ class Node:
         server_info = self.get_server_info()
         if not server_info:
             raise NodeException('Server does not exist')
-        is_server = self.nodepool.cluster.cnf.node_pools[self.nodepool.name].is_server
-        if self.nodepool.name == 'controlplane' and self.node_number == 1:
-            cluster_server, cluster_token = None, None
+        rke2_args = self.get_rke2_args()
+        rke2_update_script = rke2.get_rke2_update_script(*rke2_args, **self.get_rke2_install_kwargs())
+        output = self.ssh_run_script(rke2_update_script, server_info)
+        self.record_state(rke2_args)
+        if rke2.RKE2_UNCHANGED_MESSAGE in str(output):
+            status, message = 'unchanged', 'Server Unchanged'
         else:
-            cluster_server, cluster_token = self.nodepool.cluster.get_cluster_server_token()
-        rke2_update_script = rke2.get_rke2_update_script(
-            self.server_name_prefix,
-            is_server,
-            cluster_server,
-            cluster_token,
-        )
-        self.ssh(rke2_update_script, server_info)
+            status, message = 'updated', 'Server Updated Successfully'
         return {
             'nodepool_name': self.nodepool.name,
             'node_number': self.node_number,
-            'message': 'Server Updated Successfully',
+            'message': message,
+            'status': status,
         }
 
 
@@ -174,13 +240,19 @@ class NodeCeleryRunner:
     def __init__(self, node):
         self.node = node
 
-    def create(self, task: celery.Task):
+    def create(self, task: 'celery.Task'):
         return common.CeleryRunnerResult(
             'create_node', self.node.create, self.node.creds,
             meta={'nodepool_name': self.node.nodepool.name, 'node_number': self.node.node_number}
         ).export()
 
-    def update(self, task: celery.Task):
+    def create_server(self, task: 'celery.Task'):
+        return common.CeleryRunnerResult(
+            'create_node_server', self.node.create_server_only, self.node.creds,
+            meta={'nodepool_name': self.node.nodepool.name, 'node_number': self.node.node_number}
+        ).export()
+
+    def update(self, task: 'celery.Task'):
         return common.CeleryRunnerResult(
             'update_node', self.node.update, self.node.creds,
             meta={'nodepool_name': self.node.nodepool.name, 'node_number': self.node.node_number}
@@ -1,13 +1,15 @@
+import json
 import typing
+import logging
 from functools import partial
 
-import celery
-from celery.result import AsyncResult, GroupResult
-
 from .node import Node, NodeException
-from .. import common
+from . import cloudcli
+from .. import common, config
 
 if typing.TYPE_CHECKING:
+    import celery
+    from celery.result import AsyncResult, GroupResult
     from .cluster import Cluster
 
 
@@ -28,11 +30,58 @@ class NodePool:
             raise NodeException(f'Node {node_number} not found in nodepool {self.name}')
         return Node(self, node_number)
 
+    def get_nodes(self, node_numbers=None) -> list[Node]:
+        return [Node(self, node_number) for node_number in self.node_numbers() if not node_numbers or node_number in node_numbers]
+
+    def run_command(self, command, node_numbers=None, max_parallel=None, on_output=None, timeout_seconds=None):
+        from . import ssh
+        return ssh.get_run_summary(ssh.run_on_nodes(self.get_nodes(node_numbers), command, max_parallel, on_output, timeout_seconds))
+
     @property
     def node_pool_config(self) -> dict:
         return self.cluster.cnf.node_pools[self.name].node_pool_config
 
+    def create_server(self, server_name_prefix, init_script=None):
+        creds = self.cluster.cnf.creds
+        command_id = cloudcli.find_server_command_in_queue(cloudcli.CREATE_SERVER_COMMAND_INFO, server_name_prefix, creds)
+        if not command_id:
+            node_config = {
+                **config.DEFAULT_SERVER_CONFIG,
+                **self.cluster.cnf.node_pools[self.name].node_config
+            }
+            data = {
+                "name": cloudcli.get_server_name(server_name_prefix),
+                "password": "",
+                "passwordValidate": "",
+                "ssh-key": self.cluster.cnf.ssh_key_public,
+                "datacenter": self.cluster.cnf.datacenter,
+                "image": node_config['image'],
+                "cpu": node_config['cpu'],
+                "ram": node_config['ram'],
+                "disk": node_config['disk'],
+                "dailybackup": node_config['dailybackup'],
+                "managed": node_config['managed'],
+                "network": f"id=0,name=wan,ip=auto id=1,name={self.cluster.cnf.private_network_name},ip=auto",
+                "quantity": 1,
+                "billingcycle": node_config['billingcycle'],
+                "monthlypackage": node_config['monthlypackage'],
+                "poweronaftercreate": "yes",
+            }
+            if init_script:
+                data["script-file"] = f'#!/bin/bash\n{init_script}\n'
+            logging.debug(f'Creating server\n{json.dumps(data, indent=2)}')
+            status, res = cloudcli.cloudcli_server_request("/service/server", creds, method="POST", json=data)
+            if status != 200 or len(res) != 1:
+                raise NodeException(f'Create server failed: {status} {res}')
+            command_id = res[0]
+        cloudcli.wait_command(creds, command_id)
+        server_info = cloudcli.get_server_info(creds, server_name_prefix)
+        if not server_info:
+            raise NodeException('Server not found after creation')
+        return server_info
+
     def get_create_celery_group(self):
+        import celery
         if self.name == 'controlplane':
             raise NodeException('to create controlplane nodes, run create cluster or create a specific controlplane node')
         return celery.group(
@@ -41,6 +90,7 @@ class NodePool:
         )
 
     def get_update_celery_group(self):
+        import celery
         if self.name == 'controlplane':
             raise NodeException('to update controlplane nodes, run update cluster or update a specific controlplane node')
         return celery.group(
@@ -54,7 +104,7 @@ class NodePoolCeleryRunner:
     def __init__(self, nodepool):
         self.nodepool = nodepool
 
-    def create(self, task: celery.Task):
+    def create(self, task: 'celery.Task'):
         from cloudcli_server_kubernetes.tasks import create_node
         return NodePoolCeleryRunnerResult(
             'create', partial(self.create_update, task, create_node), self.nodepool.cluster.cnf.creds,
@@ -63,31 +113,106 @@ class NodePoolCeleryRunner:
             }
         ).export()
 
-    def update(self, task: celery.Task):
-        from cloudcli_server_kubernetes.tasks import update_node
+    def update(self, task: 'celery.Task', nodepool_plan=None):
         return NodePoolCeleryRunnerResult(
-            'update', partial(self.create_update, task, update_node), self.nodepool.cluster.cnf.creds,
+            'update', partial(self.apply_update_plan, task, nodepool_plan), self.nodepool.cluster.cnf.creds,
             meta={
                 'nodepool_name': self.nodepool.name
             }
         ).export()
 
-    def create_update(self, task: celery.Task, create_update_task):
+    def apply_update_plan(self, task: 'celery.Task', nodepool_plan=None):
+        import celery
+        from cloudcli_server_kubernetes.tasks import create_node, update_node
+        if nodepool_plan is None:
+            from .plan import get_plan
+            nodepool_plan = get_plan(self.nodepool.cluster, [self.nodepool.name])['node_pools'][self.nodepool.name]
+        cnf_node_pool = self.nodepool.cluster.cnf.node_pools[self.nodepool.name]
+        if cnf_node_pool.max_parallel or cnf_node_pool.max_unavailable:
+            return {
+                'nodepool_name': self.nodepool.name,
+                'nodes_task_ids': self.start_schedule(
+                    [
+                        *[('create_node', node_number) for node_number in nodepool_plan['create']],
+                        *[('update_node', node_number) for node_number in nodepool_plan['update']],
+                    ],
+                    cnf_node_pool.max_parallel, cnf_node_pool.max_unavailable
+                ),
+                'plan': nodepool_plan,
+            }
         cnf = self.nodepool.cluster.cnf.export()
-        if self.nodepool.name == 'controlplane':
-            first_server_result: AsyncResult = create_update_task.si(cnf, 'controlplane', 1).delay()
-            other_servers_group_result: GroupResult = celery.group(
-                create_update_task.si(cnf, 'controlplane', node_number)
-                for node_number in self.nodepool.node_numbers()
-                if node_number != 1
-            ).delay()
+        signatures = [
+            *[create_node.si(cnf, self.nodepool.name, node_number) for node_number in nodepool_plan['create']],
+            *[update_node.si(cnf, self.nodepool.name, node_number) for node_number in nodepool_plan['update']],
+        ]
+        servers_group_result: 'GroupResult' = celery.group(signatures).delay() if signatures else None
+        return {
+            'nodepool_name': self.nodepool.name,
+            'nodes_task_ids': [c.id for c in servers_group_result.children] if servers_group_result else [],
+            'plan': nodepool_plan,
+        }
+
+    def create_controlplane(self, task: 'celery.Task'):
+        # all controlplane servers are created in parallel, but only the first node installs rke2 right away
+        # the other nodes join the cluster after the first node is ready, join-concurrency nodes at a time
+        import celery
+        from cloudcli_server_kubernetes.tasks import create_node, create_node_server
+        cnf = self.nodepool.cluster.cnf.export()
+        other_node_numbers = [node_number for node_number in self.nodepool.node_numbers() if node_number != 1]
+        if not other_node_numbers:
+            first_server_result: 'AsyncResult' = create_node.si(cnf, 'controlplane', 1).delay()
             return {
                 'nodepool_name': self.nodepool.name,
                 'first_node_task_id': first_server_result.id,
-                'other_nodes_task_ids': [c.id for c in other_servers_group_result.children]
+                'other_nodes_task_ids': [],
+                'servers_task_ids': [],
             }
+        servers_result: 'GroupResult' = celery.group(
+            create_node_server.si(cnf, 'controlplane', node_number)
+            for node_number in other_node_numbers
+        ).delay()
+        join_concurrency = self.nodepool.cluster.cnf.node_pools['controlplane'].join_concurrency
+        first_node_task_id, *other_nodes_task_ids = self.start_schedule(
+            [('create_node', node_number) for node_number in other_node_numbers],
+            join_concurrency, join_concurrency, barrier=('create_node', 1)
+        )
+        return {
+            'nodepool_name': self.nodepool.name,
+            'first_node_task_id': first_node_task_id,
+            'other_nodes_task_ids': other_nodes_task_ids,
+            'servers_task_ids': [c.id for c in servers_result.children],
+        }
+
+    def start_schedule(self, node_tasks, max_parallel=None, max_unavailable=None, barrier=None):
+        # node task ids are assigned in advance so they can be returned before the node tasks start
+        from .scheduler import NodePoolScheduler
+        from cloudcli_server_kubernetes.tasks import schedule_nodepool_nodes
+        schedule = NodePoolScheduler.init_schedule(node_tasks, max_parallel, max_unavailable, barrier)
+        nodes_task_ids = [node_task['task_id'] for node_task in schedule['pending']]
+        if nodes_task_ids:
+            schedule_nodepool_nodes.delay(self.nodepool.cluster.cnf.export(), self.nodepool.name, schedule)
+        return nodes_task_ids
+
+    def run_schedule(self, task: 'celery.Task', schedule):
+        from .. import config
+        from .scheduler import NodePoolScheduler
+        from cloudcli_server_kubernetes.tasks import schedule_nodepool_nodes
+        scheduler = NodePoolScheduler(self.nodepool, schedule)
+        scheduler.tick()
+        if not scheduler.is_done:
+            schedule_nodepool_nodes.apply_async(
+                (self.nodepool.cluster.cnf.export(), self.nodepool.name, scheduler.schedule),
+                countdown=config.ROLLING_UPDATE_POLL_SECONDS
+            )
+        return scheduler.get_summary()
+
+    def create_update(self, task: 'celery.Task', create_update_task):
+        import celery
+        cnf = self.nodepool.cluster.cnf.export()
+        if self.nodepool.name == 'controlplane':
+            return self.create_controlplane(task)
         else:
-            servers_group_result: GroupResult = celery.group(
+            servers_group_result: 'GroupResult' = celery.group(
                 create_update_task.si(cnf, self.nodepool.name, node_number)
                 for node_number in self.nodepool.node_numbers()
             ).delay()
@@ -107,10 +232,14 @@ class NodePoolCeleryRunnerResult(common.CeleryRunnerResult):
         assert self.task_name in ['create', 'update']
         task_ids = []
         if not self.error:
-            if self.result['nodepool_name'] == 'controlplane':
-                task_ids = [self.result['first_node_task_id'], *self.result['other_nodes_task_ids']]
-            else:
+            if 'nodes_task_ids' in self.result:
                 task_ids = self.result['nodes_task_ids']
+            else:
+                task_ids = [
+                    self.result['first_node_task_id'],
+                    *self.result['other_nodes_task_ids'],
+                    *self.result.get('servers_task_ids', []),
+                ]
         return self.get_multi_tasks_status(
             f'{self.task_name}_nodepool',
             task_ids
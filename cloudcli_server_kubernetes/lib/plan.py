@@ -0,0 +1,100 @@
+import typing
+
+from . import cloudcli
+from .. import common
+
+if typing.TYPE_CHECKING:
+    from .cluster import Cluster
+    from .node import Node
+
+
+PLAN_ACTIONS = ['create', 'update', 'unchanged']
+
+
+class PlanException(common.CloudcliException):
+    pass
+
+
+def record_node_state(node: 'Node', fingerprint):
+    from .. import db
+    account = db.get_account(node.creds)
+    where = (
+        (db.node_state.c.account == account)
+        & (db.node_state.c.cluster_name == node.nodepool.cluster.name)
+        & (db.node_state.c.nodepool_name == node.nodepool.name)
+        & (db.node_state.c.node_number == node.node_number)
+    )
+    with db.get_engine().begin() as conn:
+        conn.execute(db.node_state.delete().where(where))
+        conn.execute(db.node_state.insert().values(
+            account=account,
+            cluster_name=node.nodepool.cluster.name,
+            nodepool_name=node.nodepool.name,
+            node_number=node.node_number,
+            fingerprint=fingerprint,
+            updated_at=db.utcnow(),
+        ))
+
+
+def get_recorded_fingerprints(cluster: 'Cluster'):
+    from .. import db
+    query = db.node_state.select().where(
+        (db.node_state.c.account == db.get_account(cluster.cnf.creds))
+        & (db.node_state.c.cluster_name == cluster.name)
+    )
+    with db.get_engine().connect() as conn:
+        return {
+            (row.nodepool_name, row.node_number): row.fingerprint
+            for row in conn.execute(query)
+        }
+
+
+def get_nodes_server_info(cluster: 'Cluster'):
+    # a single api call to get all the cluster servers instead of a call per node
+    servers_info = cloudcli.get_servers_info(cluster.cnf.creds, cluster.name)
+    nodes_server_info = {}
+    for node_pool in cluster.node_pools.values():
+        for node_number in node_pool.node_numbers():
+            server_name_prefix = node_pool.get_node(node_number).server_name_prefix
+            matching_servers = [
+                server_info for server_info in servers_info
+                if server_info['name'].startswith(f'{server_name_prefix}-')
+            ]
+            if len(matching_servers) > 1:
+                raise PlanException(f"Multiple matching servers found: {','.join([s['name'] for s in matching_servers])}")
+            elif len(matching_servers) == 1:
+                nodes_server_info[server_name_prefix] = matching_servers[0]
+    return nodes_server_info
+
+
+def get_plan(cluster: 'Cluster', nodepool_names=None):
+    nodepool_names = nodepool_names or list(cluster.node_pools.keys())
+    nodes_server_info = get_nodes_server_info(cluster)
+    recorded_fingerprints = get_recorded_fingerprints(cluster)
+    controlplane_node = cluster.node_pools['controlplane'].get_node(1)
+    controlplane_server_info = nodes_server_info.get(controlplane_node.server_name_prefix)
+    cluster_server_token = None
+    node_pools = {}
+    for nodepool_name in nodepool_names:
+        node_pool = cluster.node_pools[nodepool_name]
+        nodepool_plan = node_pools[nodepool_name] = {action: [] for action in PLAN_ACTIONS}
+        for node_number in node_pool.node_numbers():
+            node = node_pool.get_node(node_number)
+            recorded_fingerprint = recorded_fingerprints.get((nodepool_name, node_number))
+            if node.server_name_prefix not in nodes_server_info:
+                action = 'create'
+            elif not recorded_fingerprint or not controlplane_server_info:
+                action = 'update'
+            else:
+                if not node.is_first_controlplane and not cluster_server_token:
+                    cluster_server_token = cluster.get_cluster_server_token(controlplane_server_info)
+                fingerprint = node.get_rke2_fingerprint(node.get_rke2_args(cluster_server_token))
+                action = 'unchanged' if fingerprint == recorded_fingerprint else 'update'
+            nodepool_plan[action].append(node_number)
+    return {
+        'node_pools': node_pools,
+        'summary': {
+            action: sum(len(nodepool_plan[action]) for nodepool_plan in node_pools.values())
+            for action in PLAN_ACTIONS
+        }
+    }
@@ -1,10 +1,24 @@
+import os
 import json
 import base64
+import hashlib
+from urllib.parse import quote
 
 from .. import config
 
 
-def get_rke2_config(node_name, is_server, cluster_server, cluster_token):
+RKE2_FINGERPRINT_FILE = '/etc/rancher/rke2/cloudcli-fingerprint'
+RKE2_PREINSTALLED_FILE = '/var/lib/cloudcli/rke2-preinstalled'
+RKE2_UNCHANGED_MESSAGE = 'CLOUDCLI_RKE2_UNCHANGED'
+RKE2_UPDATED_MESSAGE = 'CLOUDCLI_RKE2_UPDATED'
+
+# files required for an install using INSTALL_RKE2_ARTIFACT_PATH, served by the mirror under a directory per rke2 version
+RKE2_ARTIFACTS = ['rke2.linux-amd64.tar.gz', 'sha256sum-amd64.txt', 'rke2-images.linux-amd64.tar.zst']
+RKE2_MIRROR_PATH = '/var/lib/cloudcli/rke2-mirror'
+RKE2_ARTIFACTS_PATH = '/root/rke2-artifacts'
+
+
+def get_rke2_config(node_name, is_server, cluster_server, cluster_token, extra_config=None):
     rke2_config = {
         'node-name': node_name,
         'node-ip': "${PRIVATE_IP}",
@@ -26,16 +40,135 @@ def get_rke2_config(node_name, is_server, cluster_server, cluster_token):
         })
     else:
         assert cluster_server and cluster_token, 'Both cluster server and token are required for agent nodes'
+    if extra_config:
+        rke2_config.update(extra_config)
     return rke2_config
 
 
+def get_rke2_fingerprint(node_name, is_server, cluster_server, cluster_token, extra_config=None, serve_mirror=False):
+    # identifies the applied rke2 config and version, if it didn't change there is no need to update the node
+    # serving the mirror is included only when enabled, so the fingerprints of nodes which don't serve it are unchanged
+    rke2_config = get_rke2_config(node_name, is_server, cluster_server, cluster_token, extra_config)
+    return hashlib.sha256(json.dumps({
+        'rke2_config': rke2_config,
+        'rke2_version': config.RKE2_VERSION,
+        **({'serve_mirror': True} if serve_mirror else {}),
+    }, sort_keys=True).encode()).hexdigest()
+
+
+def get_rke2_artifacts_url(mirror_url):
+    return f'{mirror_url.rstrip("/")}/{quote(config.RKE2_VERSION)}'
+
+
+def get_rke2_upstream_urls():
+    # the upstream url of each file served by the mirror
+    release_url = f'https://github.com/rancher/rke2/releases/download/{quote(config.RKE2_VERSION)}'
+    return {
+        **{filename: f'{release_url}/{filename}' for filename in RKE2_ARTIFACTS},
+        'install.sh': 'https://get.rke2.io',
+    }
+
+
+def get_rke2_mirror_setup_commands():
+    # downloads the artifacts once and serves them to the other nodes over the private network
+    # expects PRIVATE_IP to be set
+    version_path = f'{RKE2_MIRROR_PATH}/{config.RKE2_VERSION}'
+    systemd_unit_b64 = base64.b64encode('\n'.join([
+        '[Unit]',
+        'Description=cloudcli rke2 artifacts mirror',
+        'After=network-online.target',
+        '[Service]',
+        f'ExecStart=/usr/bin/python3 -m http.server {config.RKE2_MIRROR_PORT} --bind ${{PRIVATE_IP}} --directory {RKE2_MIRROR_PATH}',
+        'Restart=always',
+        '[Install]',
+        'WantedBy=multi-user.target',
+        '',
+    ]).encode()).decode()
+    return [
+        f'mkdir -p "{version_path}"',
+        *[
+            f'( [ -f "{version_path}/{filename}" ] || ( curl -sfL -o "{version_path}/{filename}.tmp" {url} && mv "{version_path}/{filename}.tmp" "{version_path}/{filename}" ) )'
+            for filename, url in get_rke2_upstream_urls().items()
+        ],
+        f'echo {systemd_unit_b64} | base64 -d | envsubst > /etc/systemd/system/cloudcli-rke2-mirror.service',
+        'systemctl daemon-reload',
+        'systemctl enable cloudcli-rke2-mirror',
+        'systemctl restart cloudcli-rke2-mirror',
+    ]
+
+
+def get_rke2_skip_installed_command(install_commands):
+    # servers from the warm pool or a golden image already have the rke2 binaries of the required version
+    return (
+        f'( [ "$(/usr/local/bin/rke2 --version 2>/dev/null | head -1 | cut -d" " -f3)" == "{config.RKE2_VERSION}" ]'
+        f' && echo "RKE2 {config.RKE2_VERSION} binaries already installed"'
+        f' || ( {" && ".join(install_commands)} ) )'
+    )
+
+
+def get_rke2_install_commands(rke2_type, artifacts_url=None, serve_mirror=False):
+    # the tarball install includes both the server and agent systemd units, the type only affects the rpm install
+    if serve_mirror:
+        artifacts_path = f'{RKE2_MIRROR_PATH}/{config.RKE2_VERSION}'
+        return [
+            *get_rke2_mirror_setup_commands(),
+            get_rke2_skip_installed_command([
+                f'INSTALL_RKE2_ARTIFACT_PATH="{artifacts_path}" INSTALL_RKE2_TYPE={rke2_type} INSTALL_RKE2_METHOD=tar sh "{artifacts_path}/install.sh"',
+            ]),
+        ]
+    elif artifacts_url:
+        return [get_rke2_skip_installed_command([
+            f'rm -rf {RKE2_ARTIFACTS_PATH}',
+            f'mkdir -p {RKE2_ARTIFACTS_PATH}',
+            # the mirror may not have the version yet, e.g. the controlplane which serves it is still being updated to it
+            *[
+                f'( curl -sfL -o {RKE2_ARTIFACTS_PATH}/{filename} {artifacts_url}/{filename}'
+                f' || curl -sfL -o {RKE2_ARTIFACTS_PATH}/{filename} {url} )'
+                for filename, url in get_rke2_upstream_urls().items()
+            ],
+            f'INSTALL_RKE2_ARTIFACT_PATH={RKE2_ARTIFACTS_PATH} INSTALL_RKE2_TYPE={rke2_type} INSTALL_RKE2_METHOD=tar sh {RKE2_ARTIFACTS_PATH}/install.sh',
+        ])]
+    else:
+        return [get_rke2_skip_installed_command([
+            f'curl -sfL https://get.rke2.io | INSTALL_RKE2_VERSION={config.RKE2_VERSION} INSTALL_RKE2_TYPE={rke2_type} INSTALL_RKE2_METHOD=tar sh -',
+        ])]
+
+
+def get_rke2_preinstall_script(artifacts_url=None):
+    # installs the rke2 binaries without configuring or starting rke2, used for warm pool servers
+    return ' && '.join([
+        *get_rke2_install_commands('agent', artifacts_url),
+        f'mkdir -p {os.path.dirname(RKE2_PREINSTALLED_FILE)}',
+        f'echo {config.RKE2_VERSION} > {RKE2_PREINSTALLED_FILE}',
+    ])
+
+
+def get_rke2_golden_image_script(artifacts_url=None):
+    # prepares the server to be saved as an image and powers it off when done
+    return ' && '.join([
+        'export DEBIAN_FRONTEND=noninteractive',
+        'apt-get update',
+        'apt-get install -y gettext-base curl',
+        get_rke2_preinstall_script(artifacts_url),
+        'apt-get clean',
+        '( cloud-init clean --logs || true )',
+        'truncate -s 0 /etc/machine-id',
+        'rm -f /var/lib/dbus/machine-id',
+        'poweroff',
+    ])
+
+
+def get_rke2_wait_preinstall_script(timeout_seconds):
+    return get_rke2_wait_file_script(RKE2_PREINSTALLED_FILE, config.RKE2_VERSION, timeout_seconds)
+
+
 def get_rke2_systemd_unit(is_server):
     rke2_type = 'server' if is_server else 'agent'
     return f'rke2-{rke2_type}'
 
 
-def get_rke2_init_script(node_name, is_server, cluster_server, cluster_token):
-    rke2_config = get_rke2_config(node_name, is_server, cluster_server, cluster_token)
+def get_rke2_init_script(node_name, is_server, cluster_server, cluster_token, extra_config=None, artifacts_url=None, serve_mirror=False):
+    rke2_config = get_rke2_config(node_name, is_server, cluster_server, cluster_token, extra_config)
     rke2_config_b64 = base64.b64encode(json.dumps(rke2_config).encode()).decode()
     rke2_type = 'server' if is_server else 'agent'
     return ' && '.join([
@@ -43,22 +176,51 @@ def get_rke2_init_script(node_name, is_server, cluster_server, cluster_token):
         "export PRIVATE_IP=$(echo $(ip -4 addr show dev eth1 | grep inet) | cut -d' ' -f2 | cut -d'/' -f1)",
         'mkdir -p /etc/rancher/rke2',
         f'echo {rke2_config_b64} | base64 -d | envsubst > /etc/rancher/rke2/config.yaml',
-        f'curl -sfL https://get.rke2.io | INSTALL_RKE2_VERSION={config.RKE2_VERSION} INSTALL_RKE2_TYPE={rke2_type} sh -',
+        *get_rke2_install_commands(rke2_type, artifacts_url, serve_mirror),
         f'systemctl enable rke2-{rke2_type}',
         f'systemctl start rke2-{rke2_type}',
         "echo PATH='$PATH:/var/lib/rancher/rke2/bin' >> ~/.bashrc",
         'echo export KUBECONFIG=/etc/rancher/rke2/rke2.yaml >> ~/.bashrc',
+        f'echo {get_rke2_fingerprint(node_name, is_server, cluster_server, cluster_token, extra_config, serve_mirror)} > {RKE2_FINGERPRINT_FILE}',
     ])
 
 
-def get_rke2_update_script(node_name, is_server, cluster_server, cluster_token):
-    rke2_config = get_rke2_config(node_name, is_server, cluster_server, cluster_token)
+def get_rke2_update_script(node_name, is_server, cluster_server, cluster_token, extra_config=None, artifacts_url=None, serve_mirror=False):
+    rke2_config = get_rke2_config(node_name, is_server, cluster_server, cluster_token, extra_config)
     rke2_config_b64 = base64.b64encode(json.dumps(rke2_config).encode()).decode()
     rke2_type = 'server' if is_server else 'agent'
-    return ' && '.join([
+    fingerprint = get_rke2_fingerprint(node_name, is_server, cluster_server, cluster_token, extra_config, serve_mirror)
+    update_script = ' && '.join([
         "export PUBLIC_IP=$(echo $(ip -4 addr show dev eth0 | grep inet) | cut -d' ' -f2 | cut -d'/' -f1)",
         "export PRIVATE_IP=$(echo $(ip -4 addr show dev eth1 | grep inet) | cut -d' ' -f2 | cut -d'/' -f1)",
         f'echo {rke2_config_b64} | base64 -d | envsubst > /etc/rancher/rke2/config.yaml',
-        f'curl -sfL https://get.rke2.io | INSTALL_RKE2_VERSION={config.RKE2_VERSION} INSTALL_RKE2_TYPE={rke2_type} sh -',
+        *get_rke2_install_commands(rke2_type, artifacts_url, serve_mirror),
         f'systemctl restart rke2-{rke2_type}',
+        f'echo {fingerprint} > {RKE2_FINGERPRINT_FILE}',
+        f'echo {RKE2_UPDATED_MESSAGE}',
     ])
+    # the install and restart are skipped if the applied config fingerprint did not change
+    return f'''
+        if [ "$(cat {RKE2_FINGERPRINT_FILE} 2>/dev/null)" == "{fingerprint}" ]; then
+            echo {RKE2_UNCHANGED_MESSAGE}
+        else
+            {update_script}
+        fi
+    '''
+
+
+def get_rke2_wait_file_script(filename, content, timeout_seconds):
+    return f'''
+        for i in $(seq {timeout_seconds // 5}); do
+            if [ "$(cat {filename} 2>/dev/null)" == "{content}" ]; then
+                exit 0
+            fi
+            sleep 5
+        done
+        exit 1
+    '''
+
+
+def get_rke2_wait_bootstrap_script(fingerprint, timeout_seconds):
+    # the fingerprint is written at the end of the init script, so it's present only when the install completed
+    return get_rke2_wait_file_script(RKE2_FINGERPRINT_FILE, fingerprint, timeout_seconds)
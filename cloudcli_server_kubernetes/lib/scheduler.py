@@ -0,0 +1,157 @@
+import time
+import uuid
+import typing
+import logging
+
+from .. import common, config
+
+if typing.TYPE_CHECKING:
+    from .nodepool import NodePool
+
+
+class NodePoolScheduler:
+    # runs node tasks with a bounded window, the next node task starts as soon as a slot is free
+    # max_parallel limits the number of running node tasks
+    # max_unavailable limits the number of running node tasks + nodes which are not ready yet after their task finished
+    # a barrier node task runs first and alone, the other node tasks start only after it's done and the node is ready
+    # the schedule is a json serializable dict which is passed between the scheduler tasks
+
+    def __init__(self, nodepool: 'NodePool', schedule: dict):
+        self.nodepool = nodepool
+        self.schedule = schedule
+
+    @staticmethod
+    def init_schedule(node_tasks, max_parallel=None, max_unavailable=None, barrier=None):
+        pending = [
+            {'task_name': task_name, 'node_number': node_number, 'task_id': str(uuid.uuid4())}
+            for task_name, node_number in node_tasks
+        ]
+        if barrier:
+            task_name, node_number = barrier
+            pending.insert(0, {'task_name': task_name, 'node_number': node_number, 'task_id': str(uuid.uuid4()), 'barrier': True})
+        return {
+            'max_parallel': max_parallel,
+            'max_unavailable': max_unavailable,
+            'pending': pending,
+            'running': [],
+            'unready': [],
+            'done': [],
+            'failed': [],
+        }
+
+    @property
+    def creds(self):
+        return self.nodepool.cluster.cnf.creds
+
+    @property
+    def is_done(self):
+        return not self.schedule['pending'] and not self.schedule['running'] and not self.schedule['unready']
+
+    def tick(self):
+        # a failed tick leaves the schedule consistent, so it's retried on the next tick
+        # if the errors continue for too long, the pending node tasks are marked as failed and the schedule ends
+        try:
+            self.check_running()
+            if self.schedule['unready']:
+                self.check_unready()
+            if self.schedule['failed']:
+                self.skip_pending()
+            else:
+                self.dispatch()
+        except Exception:
+            logging.exception(f'Failed to run the {self.nodepool.name} node pool schedule')
+            error_since = self.schedule.setdefault('error_since', time.time())
+            if time.time() - error_since > config.ROLLING_UPDATE_ERROR_TIMEOUT_SECONDS:
+                try:
+                    self.abort()
+                except Exception:
+                    logging.exception(f'Failed to abort the {self.nodepool.name} node pool schedule')
+        else:
+            self.schedule.pop('error_since', None)
+
+    def check_running(self):
+        running, done, unready, failed = [], [], [], []
+        for node_task in self.schedule['running']:
+            task_status = common.get_task_status(node_task['task_id'], self.creds)
+            if task_status['state'] == 'PENDING':
+                running.append(node_task)
+            elif task_status['state'] == 'SUCCESS':
+                if (task_status['result'] or {}).get('status') == 'unchanged':
+                    done.append(node_task)
+                else:
+                    unready.append({**node_task, 'finished_at': time.time()})
+            else:
+                failed.append({**node_task, 'error': task_status['error']})
+        self.schedule['running'] = running
+        self.schedule['done'] += done
+        self.schedule['unready'] += unready
+        self.schedule['failed'] += failed
+
+    def check_unready(self):
+        try:
+            nodes_ready = self.nodepool.cluster.get_nodes_ready()
+        except Exception:
+            logging.exception('Failed to get nodes readiness')
+            nodes_ready = {}
+        unready = []
+        for node_task in self.schedule['unready']:
+            if nodes_ready.get(self.nodepool.get_node(node_task['node_number']).server_name_prefix):
+                self.schedule['done'].append(node_task)
+            elif time.time() - node_task['finished_at'] > config.ROLLING_UPDATE_READY_TIMEOUT_SECONDS:
+                self.schedule['failed'].append({**node_task, 'error': 'Node did not become ready'})
+            else:
+                unready.append(node_task)
+        self.schedule['unready'] = unready
+
+    @property
+    def is_barrier_active(self):
+        return any(node_task.get('barrier') for node_task in self.schedule['running'] + self.schedule['unready'])
+
+    def get_available_slots(self):
+        limits = []
+        if self.schedule['max_parallel']:
+            limits.append(self.schedule['max_parallel'] - len(self.schedule['running']))
+        if self.schedule['max_unavailable']:
+            limits.append(self.schedule['max_unavailable'] - len(self.schedule['running']) - len(self.schedule['unready']))
+        return max(min(limits), 0) if limits else len(self.schedule['pending'])
+
+    def dispatch(self):
+        from cloudcli_server_kubernetes import tasks
+        cnf = self.nodepool.cluster.cnf.export()
+        available_slots = self.get_available_slots()
+        while self.schedule['pending'] and available_slots > 0 and not self.is_barrier_active:
+            node_task = self.schedule['pending'][0]
+            getattr(tasks, node_task['task_name']).apply_async(
+                (cnf, self.nodepool.name, node_task['node_number']),
+                task_id=node_task['task_id'],
+            )
+            self.schedule['running'].append(self.schedule['pending'].pop(0))
+            available_slots -= 1
+
+    def skip_pending(self, error='Skipped because another node in the node pool failed'):
+        # stop the rollout, the pending node tasks are marked as failed so that the node pool status can complete
+        from ..celery import app
+        for node_task in self.schedule['pending']:
+            app.backend.store_result(node_task['task_id'], common.CeleryRunnerResult(
+                node_task['task_name'], None, self.creds,
+                error=error,
+                meta={'nodepool_name': self.nodepool.name, 'node_number': node_task['node_number']}
+            ).export(), 'SUCCESS')
+        self.schedule['failed'] += self.schedule['pending']
+        self.schedule['pending'] = []
+
+    def abort(self):
+        # running node tasks report their own status, the schedule stops waiting for them
+        self.skip_pending('Skipped because the node pool schedule failed')
+        self.schedule['failed'] += self.schedule['running'] + self.schedule['unready']
+        self.schedule['running'] = []
+        self.schedule['unready'] = []
+
+    def get_summary(self):
+        return {
+            'nodepool_name': self.nodepool.name,
+            **{
+                key: [node_task['node_number'] for node_task in self.schedule[key]]
+                for key in ['pending', 'running', 'unready', 'done', 'failed']
+            },
+        }
@@ -0,0 +1,79 @@
+import json
+import typing
+import logging
+import datetime
+
+from .. import config, common
+
+if typing.TYPE_CHECKING:
+    from .cluster import Cluster
+
+
+def get_where(cluster: 'Cluster'):
+    from .. import db
+    return (
+        (db.cluster_snapshot.c.account == db.get_account(cluster.cnf.creds))
+        & (db.cluster_snapshot.c.cluster_name == cluster.name)
+    )
+
+
+def save(cluster: 'Cluster', status):
+    from .. import db
+    with db.get_engine().begin() as conn:
+        conn.execute(db.cluster_snapshot.delete().where(get_where(cluster)))
+        conn.execute(db.cluster_snapshot.insert().values(
+            account=db.get_account(cluster.cnf.creds),
+            cluster_name=cluster.name,
+            creds_fingerprint=common.get_creds_fingerprint(cluster.cnf.creds),
+            status=json.dumps(status),
+            updated_at=db.utcnow(),
+            refresh_requested_at=None,
+        ))
+
+
+def refresh(cluster: 'Cluster'):
+    status = cluster.get_status()
+    try:
+        save(cluster, status)
+    except Exception:
+        logging.exception(f'Failed to save cluster snapshot for {cluster.name}')
+    return status
+
+
+def get(cluster: 'Cluster'):
+    # returns the snapshot status and age in seconds, or None if there is no snapshot
+    from .. import db
+    with db.get_engine().connect() as conn:
+        row = conn.execute(db.cluster_snapshot.select().where(
+            get_where(cluster) & (db.cluster_snapshot.c.creds_fingerprint == common.get_creds_fingerprint(cluster.cnf.creds))
+        )).first()
+    if row is None:
+        return None
+    return json.loads(row.status), (db.utcnow() - row.updated_at).total_seconds()
+
+
+def request_refresh(cluster: 'Cluster'):
+    # returns True only for the first request, so a stale snapshot is refreshed by a single task
+    from .. import db
+    requested_before = db.utcnow() - datetime.timedelta(seconds=config.CLUSTER_SNAPSHOT_MAX_AGE_SECONDS)
+    with db.get_engine().begin() as conn:
+        return conn.execute(db.cluster_snapshot.update().where(
+            get_where(cluster)
+            & (db.cluster_snapshot.c.refresh_requested_at.is_(None) | (db.cluster_snapshot.c.refresh_requested_at < requested_before))
+        ).values(refresh_requested_at=db.utcnow())).rowcount == 1
+
+
+def get_status_task_id(cluster: 'Cluster'):
+    # stores the snapshot as a completed get_cluster_status task result, returns None if there is no snapshot
+    from .cluster import ClusterCeleryRunnerResult
+    snapshot = get(cluster)
+    if snapshot is None:
+        return None
+    status, age_seconds = snapshot
+    if age_seconds > config.CLUSTER_SNAPSHOT_MAX_AGE_SECONDS and request_refresh(cluster):
+        from cloudcli_server_kubernetes.tasks import get_cluster_status
+        get_cluster_status.delay(cluster.cnf.export())
+    return ClusterCeleryRunnerResult(
+        'get_cluster_status', status, cluster.cnf.creds,
+        meta={'snapshot_age_seconds': int(age_seconds)}
+    ).store()
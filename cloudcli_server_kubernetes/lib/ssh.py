@@ -0,0 +1,137 @@
+import time
+import base64
+import socket
+import logging
+import threading
+import subprocess
+import collections
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import common, config, tracing, timing
+
+
+class SshException(common.CloudcliException):
+    pass
+
+
+def get_ssh_options():
+    # a hung connection should fail the command instead of blocking the worker
+    return [
+        '-o', 'StrictHostKeyChecking=no',
+        '-o', 'UserKnownHostsFile=/dev/null',
+        '-o', 'BatchMode=yes',
+        '-o', f'ConnectTimeout={config.SSH_CONNECT_TIMEOUT_SECONDS}',
+        '-o', f'ServerAliveInterval={config.SSH_SERVER_ALIVE_INTERVAL_SECONDS}',
+        '-o', f'ServerAliveCountMax={config.SSH_SERVER_ALIVE_COUNT_MAX}',
+    ]
+
+
+def get_run_script_command(script):
+    script_b64 = base64.b64encode(script.encode()).decode()
+    return f'echo {script_b64} | base64 -d | bash'
+
+
+def run(args, on_output=None, timeout_seconds=None):
+    # runs an ssh command without raising on a non-zero exit code, returns the exit code and the tail of the output
+    # output lines are passed to on_output as they arrive
+    timeout_seconds = timeout_seconds or config.SSH_COMMAND_TIMEOUT_SECONDS
+    output, output_chars = collections.deque(), 0
+    timed_out = threading.Event()
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout_seconds, kill)
+    timer.start()
+    try:
+        for line in process.stdout:
+            if on_output:
+                on_output(line)
+            output.append(line)
+            output_chars += len(line)
+            while output_chars > config.SSH_FANOUT_OUTPUT_MAX_CHARS and len(output) > 1:
+                output_chars -= len(output.popleft())
+        exit_code = process.wait()
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+    return {
+        'exit_code': None if timed_out.is_set() else exit_code,
+        'output': ''.join(output)[-config.SSH_FANOUT_OUTPUT_MAX_CHARS:],
+        'error': f'Command did not complete in {timeout_seconds} seconds' if timed_out.is_set() else None,
+    }
+
+
+def run_on_nodes(nodes, command, max_parallel=None, on_output=None, timeout_seconds=None):
+    # runs the command on all the nodes concurrently, at most max_parallel at a time
+    # on_output is called from the executor threads with the node and each output line as it arrives
+    # returns the results in the order of the nodes, a failure on one node does not stop the others
+
+    def run_on_node(node):
+        try:
+            res = node.ssh_exec(command, on_output=partial(on_output, node) if on_output else None, timeout_seconds=timeout_seconds)
+        except Exception as e:
+            if not isinstance(e, common.CloudcliException):
+                logging.exception(f'Failed to run command on {node.server_name_prefix}')
+            res = {
+                'exit_code': None,
+                'output': '',
+                'error': str(e) if isinstance(e, common.CloudcliException) else 'An unexpected error occurred',
+            }
+        return {'nodepool_name': node.nodepool.name, 'node_number': node.node_number, **res}
+
+    if not nodes:
+        return []
+    with tracing.span('ssh_fanout', nodes=len(nodes)), timing.record('ssh'):
+        with ThreadPoolExecutor(min(len(nodes), max_parallel or config.SSH_FANOUT_MAX_PARALLEL)) as executor:
+            return list(executor.map(run_on_node, nodes))
+
+
+def get_run_summary(results):
+    return {
+        'nodes': results,
+        'succeeded': len([res for res in results if res['exit_code'] == 0]),
+        'failed': len([res for res in results if res['exit_code'] != 0]),
+    }
+
+
+def probe_ssh_port(host, port=22, timeout_seconds=None):
+    # returns True if the port accepts connections and sends the ssh protocol banner
+    try:
+        with socket.create_connection((host, port), timeout=timeout_seconds or config.SSH_READY_PROBE_TIMEOUT_SECONDS) as sock:
+            return sock.recv(4) == b'SSH-'
+    except OSError:
+        return False
+
+
+def wait_ssh_port(host, port=22, timeout_seconds=None):
+    # probes until the port is ready, with exponential backoff between attempts
+    max_time = time.monotonic() + (timeout_seconds or config.SSH_READY_TIMEOUT_SECONDS)
+    delay = config.SSH_READY_BACKOFF_INITIAL_SECONDS
+    attempts = 0
+    while True:
+        attempts += 1
+        if probe_ssh_port(host, port):
+            return attempts
+        if time.monotonic() + delay > max_time:
+            raise SshException(f'SSH is not ready on {host}:{port} after {attempts} attempts')
+        logging.debug(f'SSH is not ready on {host}:{port}, retrying in {delay} seconds')
+        time.sleep(delay)
+        delay = min(delay * 2, config.SSH_READY_BACKOFF_MAX_SECONDS)
+
+
+def wait_ssh_ready(hosts, port=22, timeout_seconds=None):
+    # probes all the hosts concurrently, raises SshException if any of them is not ready within the timeout
+    hosts = list(hosts)
+    if not hosts:
+        return
+    with tracing.span('wait_ssh_ready', hosts=len(hosts)), timing.record('wait'):
+        with ThreadPoolExecutor(min(len(hosts), config.SSH_READY_MAX_CONCURRENCY)) as executor:
+            for future in [executor.submit(wait_ssh_port, host, port, timeout_seconds) for host in hosts]:
+                future.result()
@@ -0,0 +1,170 @@
+import typing
+import secrets
+import logging
+import datetime
+
+from . import cloudcli, rke2
+from .. import common, config
+
+if typing.TYPE_CHECKING:
+    from .cluster import Cluster
+    from .node import Node
+
+
+class WarmPoolException(common.CloudcliException):
+    pass
+
+
+def get_where(cluster: 'Cluster', slot=None):
+    from .. import db
+    where = (
+        (db.warm_server.c.account == db.get_account(cluster.cnf.creds))
+        & (db.warm_server.c.cluster_name == cluster.name)
+    )
+    if slot is not None:
+        where = where & (db.warm_server.c.slot == slot)
+    return where
+
+
+def get_warm_servers(cluster: 'Cluster'):
+    from .. import db
+    with db.get_engine().connect() as conn:
+        return [
+            row._asdict()
+            for row in conn.execute(db.warm_server.select().where(get_where(cluster)).order_by(db.warm_server.c.slot))
+        ]
+
+
+def free_stale_slots(cluster: 'Cluster'):
+    from .. import db
+    stale_time = db.utcnow() - datetime.timedelta(seconds=config.WARM_POOL_STALE_SECONDS)
+    with db.get_engine().connect() as conn:
+        stale_warm_servers = [row._asdict() for row in conn.execute(db.warm_server.select().where(
+            get_where(cluster)
+            & (db.warm_server.c.status != 'ready')
+            & (db.warm_server.c.updated_at < stale_time)
+        ))]
+    for warm_server in stale_warm_servers:
+        try:
+            free_slot(cluster, warm_server)
+        except Exception:
+            logging.exception(f'Failed to free stale warm pool slot {warm_server["slot"]}')
+
+
+def trim_slots(cluster: 'Cluster'):
+    # terminates the ready servers in slots above the warm pool size, all of them if the warm pool is disabled
+    # servers which are still being created are trimmed by the next replenish after they are ready
+    trimmed_slots = []
+    for warm_server in get_warm_servers(cluster):
+        if warm_server['slot'] <= cluster.cnf.warm_pool_size or warm_server['status'] != 'ready':
+            continue
+        if not set_status(cluster, warm_server['slot'], 'terminating', 'ready'):
+            continue
+        try:
+            free_slot(cluster, warm_server)
+        except Exception:
+            # the slot is freed after WARM_POOL_STALE_SECONDS
+            logging.exception(f'Failed to trim warm pool slot {warm_server["slot"]}')
+            continue
+        trimmed_slots.append(warm_server['slot'])
+    return trimmed_slots
+
+
+def reserve_slots(cluster: 'Cluster'):
+    # returns the empty slots which were reserved by this call, the servers are created by separate tasks
+    import sqlalchemy
+    from .. import db
+    free_stale_slots(cluster)
+    account = db.get_account(cluster.cnf.creds)
+    reserved_slots = []
+    for slot in range(1, cluster.cnf.warm_pool_size + 1):
+        try:
+            with db.get_engine().begin() as conn:
+                conn.execute(db.warm_server.insert().values(
+                    account=account,
+                    cluster_name=cluster.name,
+                    slot=slot,
+                    server_name_prefix=f'{cluster.name}-warm-{secrets.token_hex(3)}',
+                    status='creating',
+                    updated_at=db.utcnow(),
+                ))
+        except sqlalchemy.exc.IntegrityError:
+            continue
+        reserved_slots.append(slot)
+    return reserved_slots
+
+
+def set_status(cluster: 'Cluster', slot, status, from_status):
+    from .. import db
+    with db.get_engine().begin() as conn:
+        return conn.execute(db.warm_server.update().where(
+            get_where(cluster, slot) & (db.warm_server.c.status == from_status)
+        ).values(status=status, updated_at=db.utcnow())).rowcount == 1
+
+
+def terminate_server(cluster: 'Cluster', server_name_prefix):
+    # the server may not exist, e.g. if it was already claimed or its creation failed before it was queued
+    server_info = cloudcli.get_server_info(cluster.cnf.creds, server_name_prefix)
+    if server_info:
+        cloudcli.terminate_server(cluster.cnf.creds, server_info['name'])
+
+
+def free_slot(cluster: 'Cluster', warm_server, terminate=True):
+    # the server is terminated first, so if it fails the slot is kept and freed again when it's stale
+    from .. import db
+    if terminate:
+        terminate_server(cluster, warm_server['server_name_prefix'])
+    with db.get_engine().begin() as conn:
+        conn.execute(db.warm_server.delete().where(get_where(cluster, warm_server['slot'])))
+
+
+def create_server(cluster: 'Cluster', slot):
+    warm_server = next((s for s in get_warm_servers(cluster) if s['slot'] == slot), None)
+    if not warm_server or warm_server['status'] != 'creating':
+        raise WarmPoolException(f'Warm pool slot {slot} is not reserved')
+    try:
+        cluster.node_pools[cluster.cnf.warm_pool_node_pool].create_server(
+            warm_server['server_name_prefix'],
+            rke2.get_rke2_preinstall_script(cluster.get_rke2_artifacts_url())
+        )
+    except Exception:
+        try:
+            free_slot(cluster, warm_server)
+        except Exception:
+            logging.exception(f'Failed to free warm pool slot {slot}')
+        raise
+    set_status(cluster, slot, 'ready', 'creating')
+    return {
+        'slot': slot,
+        'server_name_prefix': warm_server['server_name_prefix'],
+        'message': 'Warm Pool Server Created Successfully',
+    }
+
+
+def claim(node: 'Node'):
+    # renames a ready warm pool server to the node server name, returns the server info or None if none is available
+    cluster = node.nodepool.cluster
+    if not cluster.cnf.warm_pool_size or cluster.cnf.warm_pool_node_pool != node.nodepool.name:
+        return None
+    for warm_server in get_warm_servers(cluster):
+        if warm_server['status'] != 'ready' or not set_status(cluster, warm_server['slot'], 'claimed', 'ready'):
+            continue
+        try:
+            server_info = cloudcli.get_server_info(node.creds, warm_server['server_name_prefix'])
+            if not server_info:
+                raise WarmPoolException('Warm pool server not found')
+            cloudcli.rename_server(node.creds, server_info['name'], cloudcli.get_server_name(node.server_name_prefix))
+        except Exception:
+            logging.exception(f'Failed to claim warm pool server {warm_server["server_name_prefix"]}')
+            try:
+                free_slot(cluster, warm_server)
+            except Exception:
+                # the slot is freed after WARM_POOL_STALE_SECONDS
+                logging.exception(f'Failed to free warm pool slot {warm_server["slot"]}')
+            continue
+        free_slot(cluster, warm_server, terminate=False)
+        server_info = node.get_server_info()
+        if not server_info:
+            raise WarmPoolException('Server not found after claiming it from the warm pool')
+        return server_info
+    return None
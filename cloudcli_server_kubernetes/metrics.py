@@ -0,0 +1,182 @@
+import os
+import time
+import logging
+from types import SimpleNamespace
+from contextlib import contextmanager
+
+from . import config
+
+
+LONG_DURATION_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, float('inf'))
+
+NODE_LABELS = ['node'] if config.METRICS_NODE_LABELS else []
+
+# metrics are initialized only by the web app and the celery workers, so that cli commands don't pay for prometheus_client
+_metrics = None
+
+
+def init():
+    global _metrics
+    if _metrics is None:
+        from prometheus_client import Counter, Gauge, Histogram
+        _metrics = SimpleNamespace(
+            cloudcli_server_request_seconds=Histogram(
+                'cloudcli_server_request_duration_seconds',
+                'Kamatera cloudcli server API request latency',
+                ['path', 'method', 'status'],
+            ),
+            node_ssh_seconds=Histogram(
+                'node_ssh_duration_seconds',
+                'Duration of SSH commands to cluster nodes',
+                NODE_LABELS,
+                buckets=LONG_DURATION_BUCKETS,
+            ),
+            node_ssh_failures=Counter(
+                'node_ssh_failures_total',
+                'Number of failed SSH commands to cluster nodes',
+                NODE_LABELS,
+            ),
+            wait_command_seconds=Histogram(
+                'cloudcli_wait_command_duration_seconds',
+                'Time spent waiting for Kamatera queued commands to complete',
+                ['status'],
+                buckets=LONG_DURATION_BUCKETS,
+            ),
+            task_seconds=Histogram(
+                'celery_task_duration_seconds',
+                'Celery task duration',
+                ['task_name', 'state'],
+                buckets=LONG_DURATION_BUCKETS,
+            ),
+            tasks_in_flight=Gauge(
+                'celery_tasks_in_flight',
+                'Number of currently executing celery tasks',
+                ['queue'],
+                multiprocess_mode='livesum',
+            ),
+            admission_queue_depth=Gauge(
+                'admission_queue_depth',
+                'Broker queue depth checked by the provisioning admission control',
+                multiprocess_mode='max',
+            ),
+            admission_inflight_tasks=Histogram(
+                'admission_inflight_tasks',
+                'Pending and running tasks of the submitting creds, checked by the provisioning admission control',
+                buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')),
+            ),
+            admission_decisions=Counter(
+                'admission_decisions_total',
+                'Provisioning submissions admitted or rejected by the admission control',
+                ['decision', 'reason'],
+            ),
+        )
+    return _metrics
+
+
+def get_registry():
+    from prometheus_client import CollectorRegistry, REGISTRY, multiprocess
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    else:
+        return REGISTRY
+
+
+def generate_latest_metrics():
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+    init()
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
+
+
+def get_cloudcli_server_request_path_label(path):
+    # query strings contain ids, strip them to keep label cardinality bounded
+    return path.split('?')[0]
+
+
+@contextmanager
+def time_cloudcli_server_request(path, method):
+    labels = {
+        'path': get_cloudcli_server_request_path_label(path),
+        'method': method,
+        'status': 'error',
+    }
+    start_time = time.monotonic()
+    try:
+        yield labels
+    finally:
+        if _metrics:
+            _metrics.cloudcli_server_request_seconds.labels(**labels).observe(time.monotonic() - start_time)
+
+
+@contextmanager
+def time_node_ssh(node_name):
+    labels = {'node': node_name} if NODE_LABELS else {}
+    start_time = time.monotonic()
+    try:
+        yield
+    except Exception:
+        if _metrics:
+            (_metrics.node_ssh_failures.labels(**labels) if labels else _metrics.node_ssh_failures).inc()
+        raise
+    finally:
+        if _metrics:
+            (_metrics.node_ssh_seconds.labels(**labels) if labels else _metrics.node_ssh_seconds).observe(time.monotonic() - start_time)
+
+
+def observe_wait_command(status, seconds):
+    if _metrics:
+        _metrics.wait_command_seconds.labels(status=status).observe(seconds)
+
+
+def observe_admission(queue_depth, inflight, decision, reason=''):
+    if _metrics:
+        if queue_depth is not None:
+            _metrics.admission_queue_depth.set(queue_depth)
+        if inflight is not None:
+            _metrics.admission_inflight_tasks.observe(inflight)
+        _metrics.admission_decisions.labels(decision=decision, reason=reason).inc()
+
+
+_task_starts = {}
+
+
+def get_task_queue(task):
+    delivery_info = getattr(task.request, 'delivery_info', None) or {}
+    return delivery_info.get('routing_key') or 'celery'
+
+
+def on_task_prerun(task_id=None, task=None, **kwargs):
+    queue = get_task_queue(task)
+    _task_starts[task_id] = (time.monotonic(), queue)
+    init().tasks_in_flight.labels(queue=queue).inc()
+
+
+def on_task_postrun(task_id=None, task=None, state=None, **kwargs):
+    start = _task_starts.pop(task_id, None)
+    if start:
+        start_time, queue = start
+        init().tasks_in_flight.labels(queue=queue).dec()
+        init().task_seconds.labels(task_name=task.name, state=state or 'UNKNOWN').observe(time.monotonic() - start_time)
+
+
+def on_celeryd_init(**kwargs):
+    if config.CELERY_METRICS_PORT:
+        from prometheus_client import start_http_server
+        init()
+        logging.info(f'Starting celery metrics exporter on port {config.CELERY_METRICS_PORT}')
+        start_http_server(config.CELERY_METRICS_PORT, registry=get_registry())
+
+
+def on_worker_process_shutdown(pid=None, **kwargs):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+def connect_celery_signals():
+    from celery import signals
+    signals.task_prerun.connect(on_task_prerun, weak=False)
+    signals.task_postrun.connect(on_task_postrun, weak=False)
+    signals.celeryd_init.connect(on_celeryd_init, weak=False)
+    signals.worker_process_shutdown.connect(on_worker_process_shutdown, weak=False)
@@ -24,6 +24,13 @@ def create_node(task, cnf, nodepool_name, node_number, creds=None):
     return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).get_node_celery_runner(nodepool_name, node_number).create(task)
 
 
+@app.task(name='create_node_server', bind=True)
+def create_node_server(task, cnf, nodepool_name, node_number, creds=None):
+    logging.debug(f'create_node_server {cnf} {nodepool_name} {node_number}')
+    from .lib.cluster import ClusterCeleryRunner
+    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).get_node_celery_runner(nodepool_name, node_number).create_server(task)
+
+
 @app.task(name='update_cluster', bind=True)
 def update_cluster(task, cnf, creds=None):
     logging.debug(f'update_cluster {cnf}')
@@ -32,10 +39,10 @@ def update_cluster(task, cnf, creds=None):
 
 
 @app.task(name='update_nodepool', bind=True)
-def update_nodepool(task, cnf, nodepool_name, creds=None):
+def update_nodepool(task, cnf, nodepool_name, creds=None, nodepool_plan=None):
     logging.debug(f'update_nodepool {cnf} {nodepool_name}')
     from .lib.cluster import ClusterCeleryRunner
-    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).get_nodepool_celery_runner(nodepool_name).update(task)
+    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).get_nodepool_celery_runner(nodepool_name).update(task, nodepool_plan)
 
 
 @app.task(name='update_node', bind=True)
@@ -45,6 +52,34 @@ def update_node(task, cnf, nodepool_name, node_number, creds=None):
     return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).get_node_celery_runner(nodepool_name, node_number).update(task)
 
 
+@app.task(name='schedule_nodepool_nodes', bind=True)
+def schedule_nodepool_nodes(task, cnf, nodepool_name, schedule, creds=None):
+    logging.debug(f'schedule_nodepool_nodes {cnf} {nodepool_name}')
+    from .lib.cluster import ClusterCeleryRunner
+    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).get_nodepool_celery_runner(nodepool_name).run_schedule(task, schedule)
+
+
+@app.task(name='replenish_warm_pool', bind=True)
+def replenish_warm_pool(task, cnf, creds=None):
+    logging.debug(f'replenish_warm_pool {cnf}')
+    from .lib.cluster import ClusterCeleryRunner
+    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).replenish_warm_pool(task)
+
+
+@app.task(name='create_warm_server', bind=True)
+def create_warm_server(task, cnf, slot, creds=None):
+    logging.debug(f'create_warm_server {cnf} {slot}')
+    from .lib.cluster import ClusterCeleryRunner
+    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).create_warm_server(task, slot)
+
+
+@app.task(name='get_cluster_plan', bind=True)
+def get_cluster_plan(task, cnf, creds=None):
+    logging.debug(f'get_cluster_plan {cnf}')
+    from .lib.cluster import ClusterCeleryRunner
+    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).get_plan(task)
+
+
 @app.task(name='get_cluster_status', bind=True)
 def get_cluster_status(task, cnf, creds=None):
     logging.debug(f'get_cluster_status {cnf}')
@@ -57,3 +92,23 @@ def get_kubeconfig(task, cnf, creds=None):
     logging.debug(f'get_kubeconfig {cnf}')
     from .lib.cluster import ClusterCeleryRunner
     return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).get_kubeconfig(task)
+
+
+@app.task(name='run_cluster_command', bind=True)
+def run_cluster_command(task, cnf, command, nodepool_names=None, node_numbers=None, max_parallel=None, timeout_seconds=None, creds=None):
+    logging.debug(f'run_cluster_command {cnf} {nodepool_names} {node_numbers}')
+    from .lib.cluster import ClusterCeleryRunner
+    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).run_command(task, command, nodepool_names, node_numbers, max_parallel, timeout_seconds)
+
+
+@app.task(name='collect_diagnostics', bind=True)
+def collect_diagnostics(task, cnf, creds=None):
+    logging.debug(f'collect_diagnostics {cnf}')
+    from .lib.cluster import ClusterCeleryRunner
+    return ClusterCeleryRunner.init_from_cnf_creds(cnf, creds).collect_diagnostics(task)
+
+
+@app.task(name='cleanup_task_history')
+def cleanup_task_history():
+    from . import history
+    return history.cleanup()
@@ -0,0 +1,101 @@
+import time
+import contextvars
+from contextlib import contextmanager
+
+
+CATEGORIES = ['api', 'ssh', 'wait']
+
+_current_profile = contextvars.ContextVar('cloudcli_current_timing_profile', default=None)
+
+
+class TimingProfile:
+
+    def __init__(self):
+        self.categories = {category: {'count': 0, 'total': 0.0} for category in CATEGORIES}
+        self.stack = []
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def export(self):
+        return get_summary({
+            'tasks': 1,
+            'wall': self.wall,
+            'cpu': {'total': self.cpu},
+            **{category: dict(values) for category, values in self.categories.items()},
+        })
+
+
+@contextmanager
+def profile():
+    timing_profile = TimingProfile()
+    token = _current_profile.set(timing_profile)
+    start_time, start_cpu = time.monotonic(), time.thread_time()
+    try:
+        yield timing_profile
+    finally:
+        timing_profile.wall = time.monotonic() - start_time
+        timing_profile.cpu = time.thread_time() - start_cpu
+        _current_profile.reset(token)
+
+
+@contextmanager
+def record(category):
+    # times are exclusive - time spent in a nested category is not counted in the parent category
+    timing_profile = _current_profile.get()
+    if not timing_profile:
+        yield
+        return
+    frame = [category, 0.0]
+    timing_profile.stack.append(frame)
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start_time
+        timing_profile.stack.pop()
+        timing_profile.categories[category]['count'] += 1
+        timing_profile.categories[category]['total'] += elapsed - frame[1]
+        if timing_profile.stack:
+            timing_profile.stack[-1][1] += elapsed
+
+
+def get_percent(value, wall):
+    return round(value / wall * 100, 1) if wall else 0.0
+
+
+def get_summary(timing):
+    wall = timing['wall']
+    summary = {
+        'tasks': timing['tasks'],
+        'wall': round(wall, 3),
+    }
+    other = wall
+    for category in CATEGORIES:
+        total = timing[category]['total']
+        other -= total
+        summary[category] = {
+            'count': timing[category]['count'],
+            'total': round(total, 3),
+            'percent': get_percent(total, wall),
+        }
+    summary['other'] = {'total': round(max(other, 0), 3), 'percent': get_percent(max(other, 0), wall)}
+    summary['cpu'] = {'total': round(timing['cpu']['total'], 3), 'percent': get_percent(timing['cpu']['total'], wall)}
+    return summary
+
+
+def aggregate(timings):
+    timings = [timing for timing in timings if timing]
+    if not timings:
+        return None
+    return get_summary({
+        'tasks': sum(timing['tasks'] for timing in timings),
+        'wall': sum(timing['wall'] for timing in timings),
+        'cpu': {'total': sum(timing['cpu']['total'] for timing in timings)},
+        **{
+            category: {
+                'count': sum(timing[category]['count'] for timing in timings),
+                'total': sum(timing[category]['total'] for timing in timings),
+            }
+            for category in CATEGORIES
+        },
+    })
@@ -0,0 +1,175 @@
+import json
+import time
+import logging
+import secrets
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from . import config
+
+
+TRACEPARENT_HEADER = 'traceparent'
+
+_current_span = contextvars.ContextVar('cloudcli_current_span', default=None)
+_pending_spans = []
+_lock = threading.Lock()
+
+
+class Span:
+
+    def __init__(self, name, trace_id=None, parent_id=None, local_root=False, tags=None):
+        self.name = name
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.local_root = local_root
+        self.tags = {}
+        self.start_time = time.time()
+        self.end_time = None
+        for key, value in (tags or {}).items():
+            self.set_tag(key, value)
+
+    def set_tag(self, key, value):
+        if value is not None:
+            self.tags[key] = str(value)
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def export(self):
+        span = {
+            'traceId': self.trace_id,
+            'id': self.span_id,
+            'name': self.name,
+            'timestamp': int(self.start_time * 1000000),
+            'duration': max(int(((self.end_time or time.time()) - self.start_time) * 1000000), 1),
+            'localEndpoint': {'serviceName': config.TRACING_SERVICE_NAME},
+            'tags': self.tags,
+        }
+        if self.parent_id:
+            span['parentId'] = self.parent_id
+        return span
+
+
+class NoopSpan:
+
+    def set_tag(self, key, value):
+        pass
+
+
+def is_enabled():
+    return bool(config.TRACING_EXPORTER)
+
+
+def parse_traceparent(traceparent):
+    try:
+        _, trace_id, parent_id, _ = traceparent.split('-')
+        assert len(trace_id) == 32 and len(parent_id) == 16
+        return trace_id, parent_id
+    except Exception:
+        return None, None
+
+
+def get_current_traceparent():
+    span = _current_span.get()
+    return span.traceparent if span else None
+
+
+def start_span(name, traceparent=None, **tags):
+    parent = _current_span.get()
+    if parent:
+        span = Span(name, parent.trace_id, parent.span_id, tags=tags)
+    else:
+        trace_id, parent_id = parse_traceparent(traceparent) if traceparent else (None, None)
+        span = Span(name, trace_id, parent_id, local_root=True, tags=tags)
+    return span, _current_span.set(span)
+
+
+def end_span(span, token, error=None):
+    span.end_time = time.time()
+    if error is not None:
+        span.set_tag('error', error)
+    _current_span.reset(token)
+    export_span(span)
+
+
+@contextmanager
+def span(name, traceparent=None, **tags):
+    if not is_enabled():
+        yield NoopSpan()
+        return
+    span_, token = start_span(name, traceparent, **tags)
+    error = None
+    try:
+        yield span_
+    except BaseException as e:
+        error = e.__class__.__name__
+        raise
+    finally:
+        end_span(span_, token, error)
+
+
+def export_span(span):
+    try:
+        if config.TRACING_EXPORTER == 'file':
+            line = json.dumps(span.export()) + '\n'
+            with _lock:
+                with open(config.TRACING_FILE, 'a') as f:
+                    f.write(line)
+        elif config.TRACING_EXPORTER == 'zipkin':
+            with _lock:
+                _pending_spans.append(span.export())
+            if span.local_root:
+                threading.Thread(target=flush, daemon=True).start()
+        else:
+            logging.warning(f'Unknown tracing exporter: {config.TRACING_EXPORTER}')
+    except Exception:
+        logging.exception('Failed to export span')
+
+
+def flush():
+    with _lock:
+        spans = _pending_spans[:]
+        _pending_spans.clear()
+    if spans:
+        import requests
+        try:
+            requests.post(config.TRACING_ZIPKIN_URL, json=spans, timeout=5)
+        except Exception:
+            logging.exception('Failed to send spans to collector')
+
+
+_task_spans = {}
+
+
+def on_before_task_publish(headers=None, **kwargs):
+    if is_enabled() and headers is not None:
+        traceparent = get_current_traceparent()
+        if traceparent:
+            headers.setdefault(TRACEPARENT_HEADER, traceparent)
+
+
+def on_task_prerun(task_id=None, task=None, **kwargs):
+    if is_enabled():
+        _task_spans[task_id] = start_span(
+            f'celery.task/{task.name}',
+            getattr(task.request, TRACEPARENT_HEADER, None),
+            task_id=task_id,
+        )
+
+
+def on_task_postrun(task_id=None, state=None, **kwargs):
+    task_span = _task_spans.pop(task_id, None)
+    if task_span:
+        span_, token = task_span
+        span_.set_tag('state', state)
+        end_span(span_, token)
+
+
+def connect_celery_signals():
+    from celery import signals
+    signals.before_task_publish.connect(on_before_task_publish, weak=False)
+    signals.task_prerun.connect(on_task_prerun, weak=False)
+    signals.task_postrun.connect(on_task_postrun, weak=False)
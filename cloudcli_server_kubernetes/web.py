@@ -1,12 +1,30 @@
+import json
+import hashlib
 import logging
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, logger, Request, APIRouter, Depends, Form
+from fastapi import FastAPI, logger, Request, APIRouter, Depends, Form, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.openapi.docs import get_swagger_ui_html
 
-from . import common, config, version, tasks
+from . import common, config, version, tasks, metrics, tracing, admission
 
 
 router = APIRouter()
+metrics.init()
+
+
+class IndentedJSONResponse(JSONResponse):
+
+    def render(self, content) -> bytes:
+        return json.dumps(
+            content,
+            ensure_ascii=False,
+            allow_nan=False,
+            indent=2,
+            separators=(",", ":"),
+        ).encode("utf-8")
 
 
 def get_openapi_extra(use, short, flags=None, long=None, wait=False, kconfig=True, extra_run=None):
@@ -73,6 +91,30 @@ async def root():
     return {"ok": True}
 
 
+@router.get("/k8s/metrics", include_in_schema=False)
+async def get_metrics():
+    content, media_type = metrics.generate_latest_metrics()
+    return Response(content=content, media_type=media_type)
+
+
+@router.get("/k8s/openapi.json", include_in_schema=False)
+async def openapi_json(request: Request):
+    content, etag = get_openapi_schema_content()
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={config.OPENAPI_CACHE_MAX_AGE_SECONDS}',
+    }
+    if_none_match = [tag.strip().removeprefix('W/') for tag in request.headers.get('if-none-match', '').split(',')]
+    if etag in if_none_match or '*' in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type='application/json', headers=headers)
+
+
+@router.get("/k8s/docs", include_in_schema=False)
+async def docs():
+    return get_swagger_ui_html(openapi_url='/k8s/openapi.json', title=f'{app.title} - Swagger UI')
+
+
 @router.post('/k8s/task_status', openapi_extra=get_openapi_extra(
     "task_status",
     "Get task status",
@@ -86,7 +128,7 @@ async def root():
     kconfig=False
 ))
 async def task_status(task_id: str = Form(), creds: tuple = Depends(get_creds)):
-    return common.IndentedJSONResponse(common.get_task_status(task_id, creds))
+    return IndentedJSONResponse(common.get_task_status(task_id, creds))
 
 
 @router.post('/k8s/create_cluster', openapi_extra=get_openapi_extra(
@@ -96,7 +138,7 @@ async def task_status(task_id: str = Form(), creds: tuple = Depends(get_creds)):
 ))
 async def create_cluster(kconfig: str = Form(), creds: tuple = Depends(get_creds)):
     return {
-        "task_id": tasks.create_cluster.delay(kconfig, creds).id
+        "task_id": await run_in_threadpool(admission.submit, tasks.create_cluster, creds, kconfig)
     }
 
 
@@ -114,7 +156,7 @@ async def create_cluster(kconfig: str = Form(), creds: tuple = Depends(get_creds
 ))
 async def create_nodepool(kconfig: str = Form(), nodepool_name: str = Form(), creds: tuple = Depends(get_creds)):
     return {
-        "task_id": tasks.create_nodepool.delay(kconfig, nodepool_name, creds).id
+        "task_id": await run_in_threadpool(admission.submit, tasks.create_nodepool, creds, kconfig, nodepool_name)
     }
 
 
@@ -137,18 +179,29 @@ async def create_nodepool(kconfig: str = Form(), nodepool_name: str = Form(), cr
 ))
 async def create_node(kconfig: str = Form(), nodepool_name: str = Form(), node_number: str = Form(), creds: tuple = Depends(get_creds)):
     return {
-        "task_id": tasks.create_node.delay(kconfig, nodepool_name, node_number, creds).id
+        "task_id": await run_in_threadpool(admission.submit, tasks.create_node, creds, kconfig, nodepool_name, node_number)
     }
 
 
 @router.post('/k8s/update_cluster', openapi_extra=get_openapi_extra(
     "update_cluster",
     "Update a Kubernetes cluster (BETA)",
-    long="Update an existing cluster and all node-pools and nodes - in case of configuration changes. Does not cause down-time."
+    long="Update an existing cluster and all node-pools and nodes - in case of configuration changes. Does not cause down-time.\nOnly nodes with configuration changes are updated, missing nodes are created, use the plan command to see the changes in advance."
 ))
 async def update_cluster(kconfig: str = Form(), creds: tuple = Depends(get_creds)):
     return {
-        "task_id": tasks.update_cluster.delay(kconfig, creds).id
+        "task_id": await run_in_threadpool(admission.submit, tasks.update_cluster, creds, kconfig)
+    }
+
+
+@router.post('/k8s/plan', openapi_extra=get_openapi_extra(
+    "plan",
+    "Plan a Kubernetes cluster update (BETA)",
+    long="Show which nodes will be created, updated or left unchanged by update_cluster, without making any changes."
+))
+async def plan(kconfig: str = Form(), creds: tuple = Depends(get_creds)):
+    return {
+        "task_id": tasks.get_cluster_plan.delay(kconfig, creds).id
     }
 
 
@@ -166,7 +219,7 @@ async def update_cluster(kconfig: str = Form(), creds: tuple = Depends(get_creds
 ))
 async def update_nodepool(kconfig: str = Form(), nodepool_name: str = Form(), creds: tuple = Depends(get_creds)):
     return {
-        "task_id": tasks.update_nodepool.delay(kconfig, nodepool_name, creds).id
+        "task_id": await run_in_threadpool(admission.submit, tasks.update_nodepool, creds, kconfig, nodepool_name)
     }
 
 
@@ -189,37 +242,101 @@ async def update_nodepool(kconfig: str = Form(), nodepool_name: str = Form(), cr
 ))
 async def update_node(kconfig: str = Form(), nodepool_name: str = Form(), node_number: str = Form(), creds: tuple = Depends(get_creds)):
     return {
-        "task_id": tasks.update_node.delay(kconfig, nodepool_name, node_number, creds).id
+        "task_id": await run_in_threadpool(admission.submit, tasks.update_node, creds, kconfig, nodepool_name, node_number)
     }
 
 
+def get_status_snapshot_task_id(kconfig, creds):
+    from .lib import snapshot
+    from .lib.cluster import Cluster
+    return snapshot.get_status_task_id(Cluster.init_from_cnf_creds(kconfig, creds))
+
+
 @router.post('/k8s/status', openapi_extra=get_openapi_extra(
     "status",
     "Get Kubernetes cluster status (BETA)",
-    long="Get the status of the cluster and all it's node-pools and nodes."
+    [
+        {
+            "name": "fresh",
+            "usage": "Get the live status instead of the last known status",
+            "bool": True,
+        },
+    ],
+    long="Get the status of the cluster and all it's node-pools and nodes.\nReturns the last known status if available, it's refreshed in the background, the status age is returned in the task meta."
 ))
-async def status(kconfig: str = Form(), creds: tuple = Depends(get_creds)):
+async def status(kconfig: str = Form(), fresh: bool = Form(False), creds: tuple = Depends(get_creds)):
+    task_id = None if fresh else await run_in_threadpool(get_status_snapshot_task_id, kconfig, creds)
     return {
-        "task_id": tasks.get_cluster_status.delay(kconfig, creds).id
+        "task_id": task_id or tasks.get_cluster_status.delay(kconfig, creds).id
     }
 
 
+def get_operations_task_id(kconfig, creds, limit):
+    from . import history
+    from .lib.cluster import Cluster, ClusterCeleryRunnerResult
+    cluster = Cluster.init_from_cnf_creds(kconfig, creds)
+    return ClusterCeleryRunnerResult('get_operations', history.get_recent_operations(cluster, limit), cluster.cnf.creds).store()
+
+
+@router.post('/k8s/operations', openapi_extra=get_openapi_extra(
+    "operations",
+    "Get recent cluster operations (BETA)",
+    [
+        {
+            "name": "limit",
+            "usage": "Maximum number of operations to return, most recent first (default 50)",
+        },
+    ],
+    long="Get the journal of recent operations on the cluster, including the tasks which ran and their current state."
+))
+async def operations(kconfig: str = Form(), limit: int = Form(50), creds: tuple = Depends(get_creds)):
+    return {
+        "task_id": await run_in_threadpool(get_operations_task_id, kconfig, creds, min(max(limit, 1), 1000))
+    }
+
+
+def get_cached_kubeconfig_task_id(kconfig, creds):
+    from .lib import kubeconfigcache
+    from .lib.cluster import Cluster
+    return kubeconfigcache.get_kubeconfig_task_id(Cluster.init_from_cnf_creds(kconfig, creds))
+
+
 @router.post('/k8s/kubeconfig', openapi_extra=get_openapi_extra(
     "kubeconfig",
     "Get cluster kubeconfig (BETA)",
     long="Get the kubeconfig file for the cluster."
 ))
-async def status(kconfig: str = Form(), creds: tuple = Depends(get_creds)):
+async def kubeconfig(kconfig: str = Form(), creds: tuple = Depends(get_creds)):
+    task_id = await run_in_threadpool(get_cached_kubeconfig_task_id, kconfig, creds)
     return {
-        "task_id": tasks.get_kubeconfig.delay(kconfig, creds).id
+        "task_id": task_id or tasks.get_kubeconfig.delay(kconfig, creds).id
     }
 
 
-@asynccontextmanager
-async def lifespan(app_):
-    common.setup_logging(handlers=logger.logger.handlers)
-    app_.include_router(router)
-    logging.info('App initialized')
+@router.post('/k8s/collect_diagnostics', openapi_extra=get_openapi_extra(
+    "collect_diagnostics",
+    "Collect cluster diagnostics (BETA)",
+    long="Collect the rke2 logs and configuration from all the nodes and the kubectl output from the first controlplane node into a zip archive.\nThe task result has the bundle_id to download the archive using the diagnostics_bundle endpoint."
+))
+async def collect_diagnostics(kconfig: str = Form(), creds: tuple = Depends(get_creds)):
+    return {
+        "task_id": tasks.collect_diagnostics.delay(kconfig, creds).id
+    }
+
+
+@router.post('/k8s/diagnostics_bundle', response_class=StreamingResponse)
+async def diagnostics_bundle(bundle_id: str = Form(), creds: tuple = Depends(get_creds)):
+    from .lib import diagnostics
+    bundle = await run_in_threadpool(diagnostics.get_bundle, bundle_id, creds)
+    if not bundle:
+        return IndentedJSONResponse(status_code=404, content={"message": "Diagnostics bundle not found"})
+    return StreamingResponse(diagnostics.iter_bundle_chunks(bundle_id), media_type='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{bundle.cluster_name}-diagnostics-{bundle_id}.zip"',
+        'Content-Length': str(bundle.size),
+    })
+
+
+def get_openapi_schema():
     schema = app.openapi()
     schema['components']["securitySchemes"] = {
         "APIKeyHeader": {
@@ -236,6 +353,48 @@ async def lifespan(app_):
     schema["security"] = [
         {"APIKeyHeader": [], "APISecretHeader": []}
     ]
+    return schema
+
+
+def encode_openapi_schema(schema):
+    return json.dumps(schema, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def write_openapi_schema(filename):
+    with open(filename, 'wb') as f:
+        f.write(encode_openapi_schema(get_openapi_schema()))
+
+
+_openapi_schema_content = None
+
+
+def get_openapi_schema_content():
+    # the schema is encoded once per process, or loaded from the file generated at build time for this version
+    # returns the encoded schema and its etag
+    global _openapi_schema_content
+    if _openapi_schema_content is None:
+        content = None
+        if config.OPENAPI_SCHEMA_FILE:
+            try:
+                with open(config.OPENAPI_SCHEMA_FILE, 'rb') as f:
+                    content = f.read()
+                if json.loads(content)['info']['version'] != version.VERSION:
+                    logging.warning(f'OpenAPI schema file {config.OPENAPI_SCHEMA_FILE} is outdated, generating the schema')
+                    content = None
+            except Exception:
+                logging.exception(f'Failed to load OpenAPI schema file {config.OPENAPI_SCHEMA_FILE}, generating the schema')
+                content = None
+        if content is None:
+            content = encode_openapi_schema(get_openapi_schema())
+        _openapi_schema_content = content, f'"{hashlib.sha256(content).hexdigest()}"'
+    return _openapi_schema_content
+
+
+@asynccontextmanager
+async def lifespan(app_):
+    common.setup_logging(handlers=logger.logger.handlers)
+    get_openapi_schema_content()
+    logging.info('App initialized')
     try:
         yield
     finally:
@@ -243,6 +402,18 @@ async def lifespan(app_):
         logging.shutdown()
 
 
+async def admission_exception_handler(request: Request, exc: admission.AdmissionException):
+    return IndentedJSONResponse(
+        status_code=429,
+        content={
+            "message": str(exc),
+        },
+        headers={
+            "Retry-After": str(exc.retry_after_seconds),
+        },
+    )
+
+
 async def global_exception_handler(request: Request, exc: Exception):
     if isinstance(exc, common.CloudcliException):
         message = str(exc)
@@ -256,7 +427,7 @@ async def global_exception_handler(request: Request, exc: Exception):
             "exception": str(exc),
             # "traceback": traceback.format_exception(exc),
         })
-    return common.IndentedJSONResponse(
+    return IndentedJSONResponse(
         status_code=500,
         content=content,
     )
@@ -266,7 +437,22 @@ app = FastAPI(
     version=version.VERSION,
     title='Kamatera Cloud CLI Kubernetes',
     lifespan=lifespan,
-    docs_url='/k8s/docs',
-    openapi_url='/k8s/openapi.json',
+    # the schema and docs are served by the router, see openapi_json
+    docs_url=None,
+    redoc_url=None,
+    openapi_url=None,
 )
+app.include_router(router)
+app.add_exception_handler(admission.AdmissionException, admission_exception_handler)
 app.add_exception_handler(Exception, global_exception_handler)
+
+
+@app.middleware('http')
+async def tracing_middleware(request: Request, call_next):
+    with tracing.span(
+        f'{request.method} {request.url.path}',
+        request.headers.get(tracing.TRACEPARENT_HEADER),
+    ) as span:
+        response = await call_next(request)
+        span.set_tag('status', response.status_code)
+        return response
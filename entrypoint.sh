@@ -1,3 +1,7 @@
 #!/usr/bin/env bash
 
+if [ -n "${PROMETHEUS_MULTIPROC_DIR}" ]; then
+    rm -rf "${PROMETHEUS_MULTIPROC_DIR}" && mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+fi
+
 exec gunicorn -k uvicorn.workers.UvicornWorker -c gunicorn_conf.py "cloudcli_server_kubernetes.web:app"
@@ -66,3 +66,9 @@ log_data = {
     "port": port,
 }
 print(json.dumps(log_data))
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
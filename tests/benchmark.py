@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# offline benchmark of cluster create, update and status
+# the celery tasks run in an in-process worker against a simulated Kamatera API server and a fake ssh
+# usage: python tests/benchmark.py [NODES...], for example: python tests/benchmark.py 10 100 500
+import re
+import sys
+import json
+import time
+import tempfile
+import threading
+import collections
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from celery import signals
+from celery.contrib.testing import worker as celery_worker
+
+from cloudcli_server_kubernetes import config, tasks, common
+from cloudcli_server_kubernetes.lib import kubeapi
+from cloudcli_server_kubernetes.lib.node import Node
+
+
+CREDS = ('benchmark', 'benchmark-secret')
+
+KUBECONFIG = '''
+clusters:
+- cluster:
+    server: https://127.0.0.1:6443
+users:
+- user:
+    token: benchmark-token
+'''
+
+
+class FakeKamateraApiServer(ThreadingHTTPServer):
+    # all the worker threads may connect at the same time
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeKamateraApi:
+    # implements the Kamatera API endpoints used by the cluster tasks
+    # every request takes latency seconds, server create commands complete after command_seconds
+
+    def __init__(self, latency=0.0, command_seconds=0.0):
+        self.latency = latency
+        self.command_seconds = command_seconds
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.servers = {}
+        self.calls = collections.Counter()
+        self.httpd = FakeKamateraApiServer(('127.0.0.1', 0), self.get_handler_class())
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def respond(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                status, body = api.handle(method, self.path, json.loads(self.rfile.read(length)) if length else None)
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, method, path, data):
+        url = urlparse(path)
+        with self.lock:
+            self.calls[f'{method} {url.path}'] += 1
+        time.sleep(self.latency)
+        with self.lock:
+            self.complete_commands()
+            if method == 'POST' and url.path == '/service/server':
+                return self.create_server(data)
+            elif method == 'POST' and url.path == '/service/server/info':
+                return self.get_servers_info(data['name'])
+            elif method == 'GET' and url.path == '/svc/queue':
+                return 200, [
+                    {'id': command_id, 'commandInfo': 'Create Server', 'serviceName': command['name'], 'status': command['status']}
+                    for command_id, command in self.commands.items()
+                ]
+            elif method == 'GET' and url.path == '/service/queue':
+                command = self.commands.get(parse_qs(url.query)['id'][0])
+                return 200, [{'status': command['status']}] if command else []
+        return 404, {'message': f'Not found: {method} {url.path}'}
+
+    def create_server(self, data):
+        command_id = str(len(self.commands) + 1)
+        self.commands[command_id] = {
+            'name': data['name'],
+            'status': 'pending',
+            'complete_time': time.time() + self.command_seconds,
+        }
+        return 200, [command_id]
+
+    def complete_commands(self):
+        for command in self.commands.values():
+            if command['status'] == 'pending' and command['complete_time'] <= time.time():
+                command['status'] = 'complete'
+                server_number = len(self.servers) + 1
+                self.servers[command['name']] = {
+                    'name': command['name'],
+                    'power': 'on',
+                    'networks': [
+                        {'network': 'wan-benchmark', 'ips': [f'100.64.{server_number // 256}.{server_number % 256}']},
+                        {'network': 'lan-benchmark', 'ips': [f'10.0.{server_number // 256}.{server_number % 256}']},
+                    ],
+                }
+
+    def get_servers_info(self, name_pattern):
+        name_pattern = re.compile(name_pattern)
+        servers = [server for name, server in self.servers.items() if name_pattern.fullmatch(name)]
+        return (200, servers) if servers else (500, {'message': 'No servers found'})
+
+
+class FakeSsh:
+    # replaces Node.ssh, every command takes latency seconds
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def __call__(self, node, command, server_info=None):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if command == 'cat /var/lib/rancher/rke2/server/node-token':
+            return 'benchmark-token\n'
+        elif command == 'cat /etc/rancher/rke2/rke2.yaml':
+            return KUBECONFIG
+        return ''
+
+
+class FakeKubeApiClient:
+    # replaces the kubernetes api client, all the servers are ready nodes
+
+    def __init__(self, api: FakeKamateraApi):
+        self.api = api
+
+    def get_version(self):
+        return {'gitVersion': config.RKE2_VERSION}
+
+    def get_nodes(self):
+        with self.api.lock:
+            return [
+                {'metadata': {'name': name}, 'status': {'conditions': [{'type': 'Ready', 'status': 'True'}]}}
+                for name in self.api.servers
+            ]
+
+    def get_node_metrics(self):
+        return {}
+
+
+class WorkerSlots:
+    # tracks the number of tasks running at the same time in the worker
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.max_running = 0
+            self.busy_seconds = 0.0
+
+    def task_prerun(self, task_id=None, **kwargs):
+        with self.lock:
+            self.started[task_id] = time.time()
+            self.max_running = max(self.max_running, len(self.started))
+
+    def task_postrun(self, task_id=None, **kwargs):
+        with self.lock:
+            self.busy_seconds += time.time() - self.started.pop(task_id, time.time())
+
+    def __enter__(self):
+        signals.task_prerun.connect(self.task_prerun, weak=False)
+        signals.task_postrun.connect(self.task_postrun, weak=False)
+        return self
+
+    def __exit__(self, *args):
+        signals.task_prerun.disconnect(self.task_prerun)
+        signals.task_postrun.disconnect(self.task_postrun)
+
+
+def get_cnf(nodes):
+    # a cluster of the given total number of nodes - a single controlplane node and a worker node pool
+    return {
+        "cluster": {
+            "name": f"benchmark-{nodes}",
+            "datacenter": "benchmark-datacenter",
+            "ssh-key": {
+                "private": "benchmark-private-key",
+                "public": "benchmark-public-key"
+            },
+            "private-network": {
+                "name": "benchmark-private-network"
+            }
+        },
+        "node-pools": {
+            "worker1": {
+                "nodes": nodes - 1,
+            }
+        }
+    }
+
+
+def wait_task_status(task_id, poll_seconds=0.2):
+    task_status = common.get_task_status(task_id, CREDS)
+    while task_status['state'] == 'PENDING':
+        time.sleep(poll_seconds)
+        task_status = common.get_task_status(task_id, CREDS)
+    return task_status
+
+
+def run_phase(name, nodes, task, cnf, api: FakeKamateraApi, ssh: FakeSsh, slots: WorkerSlots, concurrency):
+    with api.lock:
+        api.calls.clear()
+    with ssh.lock:
+        ssh.calls = 0
+    slots.reset()
+    start_time = time.time()
+    task_status = wait_task_status(task.delay(cnf, creds=CREDS).id)
+    wall_seconds = time.time() - start_time
+    return {
+        'phase': name,
+        'nodes': nodes,
+        'state': task_status['state'],
+        'error': task_status['error'],
+        'wall_seconds': round(wall_seconds, 2),
+        'api_calls': sum(api.calls.values()),
+        'api_calls_by_endpoint': dict(api.calls),
+        'ssh_calls': ssh.calls,
+        'max_running_tasks': slots.max_running,
+        'worker_utilization': round(slots.busy_seconds / (wall_seconds * concurrency), 3),
+    }
+
+
+def run_benchmark(nodes, concurrency=64, api_latency=0.01, ssh_latency=0.01, command_seconds=0.5, command_poll_seconds=0.1):
+    # returns the create, update and status results for a cluster of the given number of nodes
+    cnf = get_cnf(nodes)
+    updated_cnf = json.loads(json.dumps(cnf))
+    updated_cnf['node-pools']['worker1']['rke2-config'] = {'node-label': ['benchmark=true']}
+    with (
+        tempfile.TemporaryDirectory() as tmpdir,
+        FakeKamateraApi(api_latency, command_seconds) as api,
+        WorkerSlots() as slots,
+    ):
+        ssh = FakeSsh(ssh_latency)
+        with (
+            mock.patch.object(config, 'KAMATERA_API_SERVER', api.url),
+            mock.patch.object(config, 'KAMATERA_COMMAND_POLL_SECONDS', command_poll_seconds),
+            mock.patch.object(config, 'DATABASE_URL', f'sqlite:///{tmpdir}/cloudcli.db'),
+            mock.patch.object(Node, 'ssh', lambda self, command, server_info=None: ssh(self, command, server_info)),
+            mock.patch.object(Node, 'wait_ssh_ready', lambda self, server_info=None: None),
+            mock.patch.object(kubeapi, 'KubeApiClient', lambda kubeconfig: FakeKubeApiClient(api)),
+        ):
+            tasks.app.conf.update(
+                result_backend=f'db+sqlite:///{tmpdir}/celery_results.db',
+                broker_url='memory://',
+                broker_transport_options={'polling_interval': 0.01},
+            )
+            # the result backend is cached per thread, it's recreated for the benchmark database
+            tasks.app._local.__dict__.pop('backend', None)
+            try:
+                with celery_worker.start_worker(tasks.app, concurrency=concurrency, pool='threads', perform_ping_check=False):
+                    return [
+                        run_phase('create', nodes, tasks.create_cluster, cnf, api, ssh, slots, concurrency),
+                        run_phase('update', nodes, tasks.update_cluster, updated_cnf, api, ssh, slots, concurrency),
+                        run_phase('status', nodes, tasks.get_cluster_status, updated_cnf, api, ssh, slots, concurrency),
+                    ]
+            finally:
+                tasks.app._local.__dict__.pop('backend', None)
+
+
+def main(*nodes):
+    for num_nodes in [int(n) for n in nodes] or [10, 100, 500]:
+        for result in run_benchmark(num_nodes):
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
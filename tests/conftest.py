@@ -0,0 +1,51 @@
+import pytest
+
+from cloudcli_server_kubernetes import config, tasks
+
+
+class MockBackend:
+
+    def __init__(self):
+        self.results = {}
+
+    def store_result(self, task_id, result, state):
+        self.results[task_id] = result
+
+
+@pytest.fixture
+def make_cnf():
+    # returns a function which creates a cluster configuration with the given name, node pools and cluster settings
+
+    def _make_cnf(name, node_pools=None, cluster=None):
+        return {
+            "cluster": {
+                "name": name,
+                "datacenter": "test-datacenter",
+                "ssh-key": {
+                    "private": "test-private-key",
+                    "public": "test-public-key"
+                },
+                "private-network": {
+                    "name": "test-private-network"
+                },
+                **(cluster or {}),
+            },
+            **({"node-pools": node_pools} if node_pools else {}),
+        }
+
+    return _make_cnf
+
+
+@pytest.fixture
+def sqlite_db(monkeypatch, tmp_path):
+    # uses a new sqlite database, returns the directory which contains it
+    monkeypatch.setattr(config, 'DATABASE_URL', f'sqlite:///{tmp_path}/cloudcli.db')
+    return tmp_path
+
+
+@pytest.fixture
+def result_backend(monkeypatch):
+    # stores the task results in memory, in the results dict by task id
+    backend = MockBackend()
+    monkeypatch.setattr(tasks.app._local, 'backend', backend, raising=False)
+    return backend
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# load test of the web app, reports throughput and latency percentiles per scenario
+# runs in-process by calling the ASGI app directly, or against gunicorn started with gunicorn_conf.py
+# usage:
+#   python tests/loadtest.py
+#   python tests/loadtest.py --web-concurrency 1,2,4
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import tempfile
+import threading
+import statistics
+import subprocess
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import requests
+
+# measure with production logging, debug logging is enabled by default for development
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from cloudcli_server_kubernetes import tasks, common
+from cloudcli_server_kubernetes.lib.cluster import ClusterCeleryRunnerResult
+from cloudcli_server_kubernetes.lib.nodepool import NodePoolCeleryRunnerResult
+
+
+CREDS = ('loadtest', 'loadtest-secret')
+
+HEADERS = {
+    'AuthClientId': CREDS[0],
+    'AuthSecret': CREDS[1],
+}
+
+CNF = {
+    "cluster": {
+        "name": "loadtest",
+        "datacenter": "loadtest-datacenter",
+        "ssh-key": {
+            "private": "loadtest-private-key",
+            "public": "loadtest-public-key"
+        },
+        "private-network": {
+            "name": "loadtest-private-network"
+        }
+    },
+    "node-pools": {
+        "worker1": {
+            "nodes": 3,
+        }
+    }
+}
+
+
+def store_result(result: common.CeleryRunnerResult):
+    task_id = str(uuid.uuid4())
+    tasks.app.backend.store_result(task_id, result.export(), 'SUCCESS')
+    return task_id
+
+
+def store_cluster_task_tree(node_pools, nodes):
+    # stores a completed create cluster task with node_pools node pool tasks of nodes node tasks each
+    # returns the cluster task id, getting its status requires getting the status of the whole tree
+    nodepool_task_ids = []
+    for nodepool_number in range(1, node_pools + 1):
+        nodepool_name = f'worker{nodepool_number}'
+        nodepool_task_ids.append(store_result(NodePoolCeleryRunnerResult('create', {
+            'nodepool_name': nodepool_name,
+            'nodes_task_ids': [
+                store_result(common.CeleryRunnerResult('create_node', {
+                    'nodepool_name': nodepool_name,
+                    'node_number': node_number,
+                    'message': 'Server Created Successfully',
+                }, CREDS, meta={'nodepool_name': nodepool_name, 'node_number': node_number}))
+                for node_number in range(1, nodes + 1)
+            ],
+        }, CREDS, meta={'nodepool_name': nodepool_name})))
+    return store_result(ClusterCeleryRunnerResult('create', {'task_ids': nodepool_task_ids}, CREDS))
+
+
+def get_scenarios(cluster_task_id, num_requests, concurrency, burst_concurrency):
+    # each scenario returns the method, path and form data for the request number
+    kconfig = json.dumps(CNF)
+    return [
+        ('task_status', num_requests, concurrency, lambda i: ('POST', '/k8s/task_status', {'task_id': cluster_task_id})),
+        ('create_node_burst', num_requests, burst_concurrency, lambda i: ('POST', '/k8s/create_node', {
+            'kconfig': kconfig, 'nodepool_name': 'worker1', 'node_number': str(i % 3 + 1)
+        })),
+        ('openapi', num_requests, concurrency, lambda i: ('GET', '/k8s/openapi.json', None)),
+    ]
+
+
+def get_report(config_name, scenario_name, latencies, errors, seconds):
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'config': config_name,
+        'scenario': scenario_name,
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) / seconds, 1),
+        **{f'p{p}_ms': round(quantiles[p - 1] * 1000, 2) for p in (50, 95, 99)},
+    }
+
+
+async def asgi_request(app, method, path, form=None):
+    # minimal ASGI http client, returns the response status
+    body = urlencode(form).encode() if form else b''
+    request_messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response_complete = asyncio.Event()
+    response = {}
+
+    async def receive():
+        if request_messages:
+            return request_messages.pop(0)
+        await response_complete.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body' and not message.get('more_body'):
+            response_complete.set()
+
+    await app({
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [
+            (b'host', b'loadtest'),
+            (b'content-type', b'application/x-www-form-urlencoded'),
+            (b'content-length', str(len(body)).encode()),
+            *[(k.lower().encode(), v.encode()) for k, v in HEADERS.items()],
+        ],
+        'client': ('127.0.0.1', 0),
+        'server': ('loadtest', 80),
+    }, receive, send)
+    return response.get('status')
+
+
+async def run_inprocess_scenario(app, get_request, num_requests, concurrency):
+    latencies, errors = [], 0
+    request_numbers = iter(range(num_requests))
+
+    async def worker():
+        nonlocal errors
+        for i in request_numbers:
+            start_time = time.perf_counter()
+            status = await asgi_request(app, *get_request(i))
+            latencies.append(time.perf_counter() - start_time)
+            if status != 200:
+                errors += 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start_time
+
+
+async def run_inprocess(scenarios):
+    from cloudcli_server_kubernetes.web import app
+    reports = []
+    async with app.router.lifespan_context(app):
+        for scenario_name, num_requests, concurrency, get_request in scenarios:
+            reports.append(get_report('inprocess', scenario_name, *await run_inprocess_scenario(app, get_request, num_requests, concurrency)))
+    return reports
+
+
+def run_http_scenario(url, get_request, num_requests, concurrency):
+    local = threading.local()
+
+    def request(i):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        method, path, form = get_request(i)
+        start_time = time.perf_counter()
+        try:
+            status = local.session.request(method, f'{url}{path}', data=form, headers=HEADERS).status_code
+        except requests.RequestException:
+            status = None
+        return time.perf_counter() - start_time, status == 200
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(request, range(num_requests)))
+    return [latency for latency, _ in results], len([ok for _, ok in results if not ok]), time.perf_counter() - start_time
+
+
+def run_gunicorn(web_concurrency, result_backend, scenarios, port=18080):
+    # starts gunicorn with the same worker class and config as the docker image entrypoint
+    env = {
+        **os.environ,
+        'WEB_CONCURRENCY': str(web_concurrency),
+        'BIND': f'127.0.0.1:{port}',
+        'ACCESS_LOG': '',
+        'LOG_LEVEL': 'WARNING',
+        'CELERY_BROKER': 'memory://',
+        'CELERY_RESULT_BACKEND': result_backend,
+    }
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-k', 'uvicorn.workers.UvicornWorker', '-c', 'gunicorn_conf.py', 'cloudcli_server_kubernetes.web:app'],
+        cwd=root_dir, env=env, stdout=subprocess.DEVNULL,
+    )
+    url = f'http://127.0.0.1:{port}'
+    try:
+        wait_ready(url)
+        return [
+            get_report(f'web_concurrency={web_concurrency}', scenario_name, *run_http_scenario(url, get_request, num_requests, concurrency))
+            for scenario_name, num_requests, concurrency, get_request in scenarios
+        ]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def wait_ready(url, timeout_seconds=30):
+    max_time = time.time() + timeout_seconds
+    while True:
+        try:
+            if requests.get(f'{url}/k8s/').status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        if time.time() > max_time:
+            raise Exception(f'Timeout waiting for {url}')
+        time.sleep(.2)
+
+
+def run_loadtest(web_concurrency=None, url=None, num_requests=200, concurrency=10, burst_concurrency=50, node_pools=3, nodes=50, tmpdir=None):
+    # in-process unless web_concurrency values or url of a running server are set
+    # a running server must use the same CELERY_RESULT_BACKEND as set here
+    with tempfile.TemporaryDirectory() as default_tmpdir:
+        result_backend = f'db+sqlite:///{tmpdir or default_tmpdir}/celery_results.db'
+        tasks.app.conf.update(result_backend=result_backend, broker_url='memory://')
+        # the result backend is cached per thread, it's recreated for the load test database
+        tasks.app._local.__dict__.pop('backend', None)
+        try:
+            scenarios = get_scenarios(store_cluster_task_tree(node_pools, nodes), num_requests, concurrency, burst_concurrency)
+            if url:
+                return [
+                    get_report(url, scenario_name, *run_http_scenario(url, get_request, n, c))
+                    for scenario_name, n, c, get_request in scenarios
+                ]
+            elif web_concurrency:
+                return [
+                    report
+                    for n in web_concurrency
+                    for report in run_gunicorn(n, result_backend, scenarios)
+                ]
+            else:
+                return asyncio.run(run_inprocess(scenarios))
+        finally:
+            tasks.app._local.__dict__.pop('backend', None)
+
+
+@click.command()
+@click.option('--web-concurrency', help='Comma separated WEB_CONCURRENCY values to start gunicorn with, in-process if not set')
+@click.option('--url', help='URL of a running server, it must use the load test CELERY_RESULT_BACKEND, see --tmpdir')
+@click.option('--tmpdir', help='Directory for the load test result backend database')
+@click.option('--requests', 'num_requests', default=200, help='Number of requests per scenario')
+@click.option('--concurrency', default=10, help='Concurrent requests for task status polling and openapi fetches')
+@click.option('--burst-concurrency', default=50, help='Concurrent requests for create node submissions')
+@click.option('--node-pools', default=3, help='Number of node pools in the polled cluster task tree')
+@click.option('--nodes', default=50, help='Number of nodes per node pool in the polled cluster task tree')
+def main(web_concurrency, url, tmpdir, num_requests, concurrency, burst_concurrency, node_pools, nodes):
+    for report in run_loadtest(
+        [int(n) for n in web_concurrency.split(',')] if web_concurrency else None,
+        url, num_requests, concurrency, burst_concurrency, node_pools, nodes, tmpdir
+    ):
+        print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import json
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from prometheus_client import REGISTRY
+
+from cloudcli_server_kubernetes import config, admission, history, web
+
+
+class MockTask:
+    name = 'create_node'
+
+    def __init__(self):
+        self.sent = []
+
+    def run(self, cnf, nodepool_name, node_number, creds):
+        pass
+
+    def apply_async(self, args, task_id):
+        self.sent.append((task_id, args))
+        return SimpleNamespace(id=task_id)
+
+
+def get_decisions(decision, reason=''):
+    return REGISTRY.get_sample_value('admission_decisions_total', {'decision': decision, 'reason': reason}) or 0
+
+
+def test_admission_inflight(monkeypatch, make_cnf, sqlite_db):
+    monkeypatch.setattr(config, 'ADMISSION_MAX_INFLIGHT_PER_CREDS', 2)
+    monkeypatch.setattr(admission, 'get_queue_depth', lambda: 0)
+    task, creds, cnf = MockTask(), ('aaa', 'bbb'), json.dumps(make_cnf('test-admission', {'worker1': {'nodes': 2}}))
+    admitted = get_decisions('admitted')
+    task_ids = [admission.submit(task, creds, cnf, 'worker1', node_number) for node_number in (1, 2)]
+    assert [args for _, args in task.sent] == [(cnf, 'worker1', 1, creds), (cnf, 'worker1', 2, creds)]
+    assert history.count_inflight(creds) == 2
+    assert get_decisions('admitted') == admitted + 2
+    rejected = get_decisions('rejected', 'inflight')
+    with pytest.raises(admission.AdmissionException) as excinfo:
+        admission.submit(task, creds, cnf, 'worker1', 3)
+    assert excinfo.value.retry_after_seconds == config.ADMISSION_RETRY_AFTER_SECONDS
+    assert len(task.sent) == 2
+    assert get_decisions('rejected', 'inflight') == rejected + 1
+    # other creds have their own limit
+    admission.submit(task, ('aaa', 'ccc'), cnf, 'worker1', 3)
+    # completed tasks are not counted
+    history.on_task_postrun(task_ids[0], task, (cnf, 'worker1', 1, creds), {}, None, 'SUCCESS')
+    assert history.count_inflight(creds) == 1
+    admission.submit(task, creds, cnf, 'worker1', 3)
+
+
+def test_admission_submit_failure(monkeypatch, make_cnf, sqlite_db):
+    monkeypatch.setattr(config, 'ADMISSION_MAX_INFLIGHT_PER_CREDS', 1)
+    monkeypatch.setattr(admission, 'get_queue_depth', lambda: 0)
+    task, creds, cnf = MockTask(), ('aaa', 'bbb'), json.dumps(make_cnf('test-admission', {'worker1': {'nodes': 2}}))
+    send = task.apply_async
+
+    def apply_async(args, task_id):
+        raise Exception('broker is not available')
+
+    task.apply_async = apply_async
+    with pytest.raises(Exception, match='broker is not available'):
+        admission.submit(task, creds, cnf, 'worker1', 1)
+    # the task which failed to be sent is not counted as in flight
+    assert history.count_inflight(creds) == 0
+    task.apply_async = send
+    admission.submit(task, creds, cnf, 'worker1', 1)
+    assert history.count_inflight(creds) == 1
+
+
+def test_admission_queue_depth(monkeypatch):
+    monkeypatch.setattr(config, 'ADMISSION_MAX_INFLIGHT_PER_CREDS', 0)
+    monkeypatch.setattr(config, 'ADMISSION_MAX_QUEUE_DEPTH', 10)
+    monkeypatch.setattr(admission, 'get_queue_depth', lambda: 10)
+    with pytest.raises(admission.AdmissionException):
+        admission.check(('aaa', 'bbb'))
+    monkeypatch.setattr(admission, 'get_queue_depth', lambda: 9)
+    admission.check(('aaa', 'bbb'))
+    assert REGISTRY.get_sample_value('admission_queue_depth') == 9
+
+
+def test_admission_check_failure(monkeypatch):
+    # submissions are admitted if the limits can't be checked
+    monkeypatch.setattr(config, 'ADMISSION_MAX_INFLIGHT_PER_CREDS', 0)
+
+    def get_queue_depth():
+        raise Exception('broker is not available')
+
+    monkeypatch.setattr(admission, 'get_queue_depth', get_queue_depth)
+    admission.check(('aaa', 'bbb'))
+
+
+def test_admission_response():
+    res = asyncio.run(web.admission_exception_handler(None, admission.AdmissionException('Too many pending tasks', 15)))
+    assert res.status_code == 429
+    assert res.headers['retry-after'] == '15'
+    assert json.loads(res.body) == {'message': 'Too many pending tasks'}
@@ -0,0 +1,12 @@
+from benchmark import run_benchmark
+
+
+def test_benchmark():
+    create, update, status = run_benchmark(10, concurrency=8)
+    assert [r['state'] for r in (create, update, status)] == ['SUCCESS', 'SUCCESS', 'SUCCESS']
+    assert create['api_calls_by_endpoint']['POST /service/server'] == 10
+    assert 'POST /service/server' not in update['api_calls_by_endpoint']
+    # only the worker nodes are updated
+    assert update['ssh_calls'] >= 9
+    assert status['api_calls_by_endpoint'] == {'POST /service/server/info': 11}
+    assert 1 <= create['max_running_tasks'] <= 8
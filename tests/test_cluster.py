@@ -1,10 +1,12 @@
 import os
 import json
+import base64
 import tempfile
 
 from celery.contrib.testing import worker as celery_worker
 
-from cloudcli_server_kubernetes import tasks, common
+from cloudcli_server_kubernetes import tasks, common, db
+from cloudcli_server_kubernetes.lib import rke2
 
 
 MINIMAL_CNF = {
@@ -38,8 +40,29 @@ def test_cluster_celery_runner_create(monkeypatch):
         'mock_node_ssh_calls': [],
     }
 
+    def get_server_info(node):
+        return {
+            **node['command']['kwargs']['json'],
+            'networks': [
+                {
+                    'network': 'wan-a',
+                    'ips': ['1.2.3.4']
+                },
+                {
+                    'network': 'lan-b',
+                    'ips': ['10.0.0.2']
+                }
+            ]
+        }
+
     def mock_cloudcli_server_request(path, *args, **kwargs):
-        if path == '/service/server/info' and kwargs.get('json', {}).get('name') in [f'test-cluster-{n}-.*' for n in ['controlplane-1', 'worker1-1', 'worker1-2', 'worker1-3']]:
+        if path == '/service/server/info' and kwargs.get('json', {}).get('name') == 'test-cluster-.*':
+            return 200, [
+                get_server_info(node)
+                for nodes in state['created_node_pools'].values()
+                for node in nodes.values()
+            ]
+        elif path == '/service/server/info' and kwargs.get('json', {}).get('name') in [f'test-cluster-{n}-.*' for n in ['controlplane-1', 'worker1-1', 'worker1-2', 'worker1-3']]:
             for node_pool_name, nodes in state['created_node_pools'].items():
                 for node_num, node in nodes.items():
                     if kwargs['json']['name'] == f'test-cluster-{node_pool_name}-{node_num}-.*':
@@ -89,9 +112,11 @@ def test_cluster_celery_runner_create(monkeypatch):
         state['mock_node_ssh_calls'].append([command, server_info])
         if command == 'cat /var/lib/rancher/rke2/server/node-token':
             return 'test-token'
+        return state.get('ssh_output')
 
     monkeypatch.setattr("cloudcli_server_kubernetes.lib.cloudcli.cloudcli_server_request", mock_cloudcli_server_request)
     monkeypatch.setattr("cloudcli_server_kubernetes.lib.node.Node.ssh", mock_node_ssh)
+    monkeypatch.setattr("cloudcli_server_kubernetes.lib.node.Node.wait_ssh_ready", lambda self, server_info=None: None)
     with tempfile.TemporaryDirectory() as tmpdir:
         tasks.app.conf.update(
             result_backend='db+sqlite:///' + os.path.join(tmpdir, 'celery_results.db'),
@@ -132,8 +157,101 @@ def test_cluster_celery_runner_create(monkeypatch):
                 ]
               ]
             assert res['error'] is None
-            assert res['meta'].keys() == {'task_ids', 'subtasks'}
+            assert res['meta'].keys() == {'task_ids', 'subtasks', 'timing'}
+            assert res['meta']['timing']['tasks'] == 7
+            assert res['meta']['timing'].keys() == {'tasks', 'wall', 'api', 'ssh', 'wait', 'other', 'cpu'}
             assert len(res['meta']['task_ids']) == 2
             assert len(res['meta']['subtasks']) == 2
-    assert len(state['commands']) == 4
-    assert state['created_node_pools'].keys() == {'worker1', 'controlplane'}
+            assert len(state['commands']) == 4
+            assert state['created_node_pools'].keys() == {'worker1', 'controlplane'}
+            num_ssh_calls = len(state['mock_node_ssh_calls'])
+            task_id = tasks.update_cluster.delay(MINIMAL_CNF, creds=creds).id
+            res = common.wait_task_status(task_id, creds)
+            assert res['task_name'] == 'update_cluster'
+            assert res['state'] == 'SUCCESS'
+            assert res['meta']['plan']['summary'] == {'create': 0, 'update': 0, 'unchanged': 4}
+            assert res['result'] == [[], []]
+            assert [c[0] for c in state['mock_node_ssh_calls'][num_ssh_calls:]] == ['cat /var/lib/rancher/rke2/server/node-token']
+            updated_cnf = json.loads(json.dumps(MINIMAL_CNF))
+            updated_cnf['node-pools']['worker1']['rke2-config'] = {'node-label': ['test=true']}
+            task_id = tasks.update_cluster.delay(updated_cnf, creds=creds).id
+            res = common.wait_task_status(task_id, creds)
+            assert res['state'] == 'SUCCESS'
+            assert res['meta']['plan']['node_pools']['worker1'] == {'create': [], 'update': [1, 2, 3], 'unchanged': []}
+            assert res['meta']['plan']['node_pools']['controlplane'] == {'create': [], 'update': [], 'unchanged': [1]}
+            assert sorted(r['node_number'] for r in res['result'][0]) == [1, 2, 3]
+            assert res['meta']['node_statuses'] == {'updated': 3}
+            # enabling the rke2 mirror updates only the first controlplane node, which serves it
+            mirror_cnf = json.loads(json.dumps(updated_cnf))
+            mirror_cnf['cluster']['rke2-mirror'] = 'controlplane'
+            num_ssh_calls = len(state['mock_node_ssh_calls'])
+            task_id = tasks.update_cluster.delay(mirror_cnf, creds=creds).id
+            res = common.wait_task_status(task_id, creds)
+            assert res['state'] == 'SUCCESS'
+            assert res['meta']['plan']['node_pools']['controlplane'] == {'create': [], 'update': [1], 'unchanged': []}
+            assert res['meta']['plan']['node_pools']['worker1'] == {'create': [], 'update': [], 'unchanged': [1, 2, 3]}
+            assert any(
+                'cloudcli-rke2-mirror' in base64.b64decode(c[0].split()[1]).decode()
+                for c in state['mock_node_ssh_calls'][num_ssh_calls:] if c[0].startswith('echo ')
+            )
+            task_id = tasks.update_cluster.delay(mirror_cnf, creds=creds).id
+            res = common.wait_task_status(task_id, creds)
+            assert res['meta']['plan']['summary'] == {'create': 0, 'update': 0, 'unchanged': 4}
+            # the recorded node states were lost, so the plan updates all the nodes, but rke2 on the nodes is unchanged
+            with db.get_engine().begin() as conn:
+                conn.execute(db.node_state.delete())
+            state['ssh_output'] = f'{rke2.RKE2_UNCHANGED_MESSAGE}\n'
+            task_id = tasks.update_cluster.delay(updated_cnf, creds=creds).id
+            res = common.wait_task_status(task_id, creds)
+            assert res['state'] == 'SUCCESS'
+            assert res['meta']['plan']['summary'] == {'create': 0, 'update': 4, 'unchanged': 0}
+            assert sorted((r['nodepool_name'], r['node_number'], r['status']) for r in res['result'][0] + res['result'][1]) == [
+                ('controlplane', 1, 'unchanged'),
+                ('worker1', 1, 'unchanged'),
+                ('worker1', 2, 'unchanged'),
+                ('worker1', 3, 'unchanged'),
+            ]
+            assert res['meta']['node_statuses'] == {'unchanged': 4}
+
+
+def test_cluster_cache():
+    from cloudcli_server_kubernetes.lib.cluster import Cluster, cluster_cache
+    cluster_cache.clear()
+    cnf = json.dumps(MINIMAL_CNF)
+    cluster = Cluster.init_from_cnf_creds(cnf, ('aaa', 'bbb'))
+    assert Cluster.init_from_cnf_creds(cnf, ['aaa', 'bbb']) is cluster
+    other_creds_cluster = Cluster.init_from_cnf_creds(cnf, ('aaa', 'ccc'))
+    assert other_creds_cluster is not cluster
+    assert other_creds_cluster.cnf.creds == ('aaa', 'ccc')
+    assert cluster.cnf.creds == ('aaa', 'bbb')
+    for i in range(cluster_cache.max_size):
+        Cluster.init_from_cnf_creds(cnf, ('aaa', f'secret-{i}'))
+    assert Cluster.init_from_cnf_creds(cnf, ('aaa', 'bbb')) is not cluster
+
+
+def test_node_create_init_script_bootstrap(monkeypatch):
+    from cloudcli_server_kubernetes.lib import cloudcli, plan, rke2
+    from cloudcli_server_kubernetes.lib.cluster import Cluster
+    state = {'created_servers': [], 'ssh_scripts': [], 'recorded_fingerprints': []}
+
+    def mock_cloudcli_server_request(path, *args, **kwargs):
+        assert path == '/service/server' and kwargs.get('method') == 'POST'
+        state['created_servers'].append(kwargs['json'])
+        return 200, ['1']
+
+    monkeypatch.setattr(cloudcli, 'cloudcli_server_request', mock_cloudcli_server_request)
+    monkeypatch.setattr(cloudcli, 'find_server_command_in_queue', lambda *args: None)
+    monkeypatch.setattr(cloudcli, 'wait_command', lambda *args: None)
+    monkeypatch.setattr(cloudcli, 'get_server_info', lambda creds, name: {'name': state['created_servers'][0]['name']} if state['created_servers'] else None)
+    monkeypatch.setattr('cloudcli_server_kubernetes.lib.node.Node.ssh_run_script', lambda self, script, server_info=None: state['ssh_scripts'].append(script))
+    monkeypatch.setattr('cloudcli_server_kubernetes.lib.node.Node.wait_ssh_ready', lambda self, server_info=None: state['ssh_scripts'].append('wait_ssh_ready'))
+    monkeypatch.setattr(plan, 'record_node_state', lambda node, fingerprint: state['recorded_fingerprints'].append(fingerprint))
+    cnf = json.loads(json.dumps(MINIMAL_CNF))
+    cnf['cluster']['bootstrap'] = 'init-script'
+    node = Cluster.init_from_cnf_creds(cnf, ('aaa', 'bbb')).node_pools['controlplane'].get_node(1)
+    assert node.create()['message'] == 'Server Created Successfully'
+    rke2_args = node.get_rke2_args()
+    assert state['created_servers'][0]['script-file'] == f'#!/bin/bash\n{rke2.get_rke2_init_script(*rke2_args)}\n'
+    fingerprint = rke2.get_rke2_fingerprint(*rke2_args)
+    assert len(state['ssh_scripts']) == 2 and state['ssh_scripts'][0] == 'wait_ssh_ready' and fingerprint in state['ssh_scripts'][1]
+    assert state['recorded_fingerprints'] == [fingerprint]
@@ -66,3 +66,9 @@ def test_minimal(input_cnf, expected_cnf, file_name):
         assert np.node_config == {}
         assert np.is_server
         assert np.rke2_config == {}
+
+
+def test_invalid_node_pool_number():
+    with pytest.raises(CnfConfigError) as excinfo:
+        Cnf({**MINIMAL_CNF, 'node-pools': {'worker1': {'nodes': 2, 'max-parallel': 'abc'}}}, ('key', 'secret'))
+    assert str(excinfo.value) == 'node-pools.worker1.nodes, max-parallel, max-unavailable and join-concurrency must be numbers'
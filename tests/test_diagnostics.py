@@ -0,0 +1,134 @@
+import io
+import sys
+import json
+import asyncio
+import subprocess
+import zipfile
+import datetime
+
+from click.testing import CliRunner
+
+from cloudcli_server_kubernetes import config, db, history, web, cli
+from cloudcli_server_kubernetes.lib import ssh, diagnostics
+from cloudcli_server_kubernetes.lib.node import Node
+from cloudcli_server_kubernetes.lib.cluster import Cluster
+
+
+def mock_node(monkeypatch, lines=3, random_lines=False):
+    commands = []
+
+    def mock_ssh_exec(self, command, server_info=None, on_output=None, timeout_seconds=None):
+        commands.append((self.server_name_prefix, command))
+        if self.nodepool.name == 'worker1' and self.node_number == 2:
+            raise ssh.SshException('SSH is not ready')
+        if random_lines:
+            # not compressible, so the archive size limit is reached
+            script = f'import os; [print(os.urandom(40).hex()) for i in range({lines})]'
+        else:
+            script = f'[print("{self.server_name_prefix} line", i) for i in range({lines})]'
+        return ssh.run([sys.executable, '-c', script], on_output, timeout_seconds)
+
+    monkeypatch.setattr(Node, 'get_server_info', lambda self: {'name': self.server_name_prefix})
+    monkeypatch.setattr(Node, 'ssh_exec', mock_ssh_exec)
+    return commands
+
+
+def download(bundle_id, creds):
+    async def get_body():
+        res = await web.diagnostics_bundle(bundle_id, creds)
+        if res.status_code != 200:
+            return res.status_code, None
+        return res.status_code, b''.join([chunk async for chunk in res.body_iterator])
+
+    return asyncio.run(get_body())
+
+
+def test_collect_diagnostics(monkeypatch, make_cnf, sqlite_db, tmp_path):
+    cnf = json.dumps(make_cnf('test-diagnostics', {'worker1': {'nodes': 2}}))
+    monkeypatch.setattr(config, 'DIAGNOSTICS_CHUNK_BYTES', 256)
+    monkeypatch.setattr(history, 'is_database_result_backend', lambda: False)
+    commands = mock_node(monkeypatch)
+    creds = ('aaa', 'bbb')
+    res = diagnostics.collect(Cluster.init_from_cnf_creds(cnf, creds))
+    assert res['files_collected'] == 2 + 2 + len(diagnostics.CLUSTER_FILES)
+    assert res['files_failed'] == 2
+    assert not res['truncated'] and not res['timed_out']
+    assert any('kubectl get nodes' in command for node, command in commands if node == 'test-diagnostics-controlplane-1')
+    assert not any('kubectl' in command for node, command in commands if node != 'test-diagnostics-controlplane-1')
+    status_code, content = download(res['bundle_id'], creds)
+    assert status_code == 200 and len(content) == res['size'] > 256
+    with zipfile.ZipFile(io.BytesIO(content)) as zf:
+        assert zf.read('test-diagnostics-worker1-1/rke2-journal.log') == b''.join(
+            f'test-diagnostics-worker1-1 line {i}\n'.encode() for i in range(3)
+        )
+        manifest = json.loads(zf.read('manifest.json'))
+    assert manifest['files']['test-diagnostics-worker1-2/rke2-journal.log'] == {'error': 'SSH is not ready'}
+    assert manifest['files']['test-diagnostics-controlplane-1/rke2-config.yaml']['exit_code'] == 0
+    # download using the cli
+    monkeypatch.setattr(config, 'KAMATERA_API_CLIENT_ID', 'aaa')
+    monkeypatch.setattr(config, 'KAMATERA_API_SECRET', 'bbb')
+    output_file = str(tmp_path / 'diagnostics.zip')
+    res_cli = CliRunner().invoke(cli.main, ['cluster', 'diagnostics-bundle', cnf, res['bundle_id'], output_file])
+    assert res_cli.exit_code == 0, res_cli.output
+    with open(output_file, 'rb') as f:
+        assert f.read() == content
+    # only the creds which collected the bundle can download it
+    assert download(res['bundle_id'], ('aaa', 'ccc')) == (404, None)
+    old = db.utcnow() - datetime.timedelta(seconds=config.DIAGNOSTICS_EXPIRES_SECONDS + 60)
+    with db.get_engine().begin() as conn:
+        conn.execute(db.diagnostics_bundle.update().values(created_at=old))
+        conn.execute(db.diagnostics_chunk.update().values(created_at=old))
+    num_chunks = len(list(diagnostics.iter_bundle_chunks(res['bundle_id'])))
+    assert num_chunks > 2
+    # chunks are deleted in batches by their (bundle_id, chunk_number) key
+    cleanup = history.cleanup(batch_size=2)
+    assert cleanup['diagnostics_bundles'] == 1 and cleanup['diagnostics_chunks'] == num_chunks
+    assert download(res['bundle_id'], creds) == (404, None)
+
+
+def test_collect_diagnostics_limits(monkeypatch, make_cnf, sqlite_db):
+    cnf = json.dumps(make_cnf('test-diagnostics', {'worker1': {'nodes': 2}}))
+    monkeypatch.setattr(config, 'DIAGNOSTICS_MAX_FILE_BYTES', 1000)
+    monkeypatch.setattr(config, 'DIAGNOSTICS_MAX_BYTES', 1500)
+    monkeypatch.setattr(diagnostics, 'COPY_BLOCK_BYTES', 100)
+    mock_node(monkeypatch, lines=1000, random_lines=True)
+    creds = ('aaa', 'bbb')
+    res = diagnostics.collect(Cluster.init_from_cnf_creds(cnf, creds))
+    assert res['truncated']
+    status_code, content = download(res['bundle_id'], creds)
+    assert status_code == 200
+    with zipfile.ZipFile(io.BytesIO(content)) as zf:
+        manifest = json.loads(zf.read('manifest.json'))
+        for name, file_res in manifest['files'].items():
+            if file_res.get('bytes'):
+                assert file_res['truncated'] and file_res['bytes'] <= 1000
+    assert any((file_res.get('error') or '').startswith('Skipped') for file_res in manifest['files'].values())
+
+
+def test_rke2_config_redacted(tmp_path):
+    rke2_config = '\n'.join([
+        'token: test-token',
+        'agent-token: test-agent-token',
+        'etcd-s3-access-key: test-access-key',
+        'etcd-s3-secret-key: "test-secret-key"',
+        'datastore-endpoint: postgres://user:test-password@db:5432/rke2',
+        'node-name: test-diagnostics-controlplane-1',
+        'tls-san:',
+        '  - 1.2.3.4',
+    ])
+    (tmp_path / 'config.yaml').write_text(rke2_config)
+    command = dict(diagnostics.NODE_FILES)['rke2-config.yaml'].format(max_bytes=10000)
+    output = subprocess.run(
+        ['bash', '-c', command.replace('/etc/rancher/rke2/config.yaml', str(tmp_path / 'config.yaml'))],
+        capture_output=True, text=True, check=True
+    ).stdout
+    assert output.splitlines() == [
+        'token: REDACTED',
+        'agent-token: REDACTED',
+        'etcd-s3-access-key: REDACTED',
+        'etcd-s3-secret-key: REDACTED',
+        'datastore-endpoint: REDACTED',
+        'node-name: test-diagnostics-controlplane-1',
+        'tls-san:',
+        '  - 1.2.3.4',
+    ]
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from cloudcli_server_kubernetes import config
+from cloudcli_server_kubernetes.lib import cloudcli, goldenimage, rke2
+from cloudcli_server_kubernetes.lib.cluster import Cluster
+from cloudcli_server_kubernetes.lib.nodepool import NodePool
+
+
+def test_golden_image(monkeypatch, make_cnf):
+    state = {'servers': {}, 'calls': []}
+
+    def mock_create_server(self, server_name_prefix, init_script=None):
+        assert self.name == 'worker1'
+        assert init_script == rke2.get_rke2_golden_image_script()
+        state['servers'][server_name_prefix] = {'name': f'{server_name_prefix}-abc', 'power': 'off'}
+
+    def mock_terminate_server(creds, name):
+        state['calls'].append(['terminate', name])
+        state['servers'].pop(name.rsplit('-', 1)[0])
+
+    monkeypatch.setattr(NodePool, 'create_server', mock_create_server)
+    monkeypatch.setattr(cloudcli, 'get_server_info', lambda creds, name_startswith: state['servers'].get(name_startswith))
+    monkeypatch.setattr(cloudcli, 'create_server_image', lambda creds, name, image_name: state['calls'].append(['image', name, image_name]) or {'status': 'complete'})
+    monkeypatch.setattr(cloudcli, 'terminate_server', mock_terminate_server)
+    cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-golden', {'worker1': {'nodes': 1, 'node-config': {'cpu': '4B'}}})), ('aaa', 'bbb'))
+    res = goldenimage.create(cluster, 'worker1')
+    assert res['rke2_version'] == config.RKE2_VERSION
+    assert state['calls'] == [
+        ['image', 'test-golden-golden-abc', goldenimage.get_default_image_name(cluster)],
+        ['terminate', 'test-golden-golden-abc'],
+    ]
+    assert state['servers'] == {}
+
+
+def test_golden_image_create_image_error(monkeypatch, make_cnf):
+    servers = {}
+
+    def mock_create_server(self, server_name_prefix, init_script=None):
+        servers[server_name_prefix] = {'name': f'{server_name_prefix}-abc', 'power': 'off'}
+
+    def mock_cloudcli_server_request(path, creds, **kwargs):
+        if path == '/service/server/image':
+            return 200, [123]
+        elif path == '/service/queue?id=123':
+            return 200, [{'status': 'error'}]
+        raise Exception(f'Unexpected request {path}')
+
+    monkeypatch.setattr(NodePool, 'create_server', mock_create_server)
+    monkeypatch.setattr(cloudcli, 'get_server_info', lambda creds, name_startswith: servers.get(name_startswith))
+    monkeypatch.setattr(cloudcli, 'cloudcli_server_request', mock_cloudcli_server_request)
+    monkeypatch.setattr(config, 'KAMATERA_COMMAND_POLL_SECONDS', 0)
+    cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-golden', {'worker1': {'nodes': 1, 'node-config': {'cpu': '4B'}}})), ('aaa', 'bbb'))
+    with pytest.raises(goldenimage.GoldenImageException, match='Create server image failed: error'):
+        goldenimage.create(cluster, 'worker1')
+    # the prepared server is not terminated
+    assert list(servers) == ['test-golden-golden']
@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import datetime
+import subprocess
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from celery.backends.database import DatabaseBackend
+from celery.backends.database.models import Task
+
+from cloudcli_server_kubernetes import config, db, tasks, common, history
+from cloudcli_server_kubernetes.lib.cluster import Cluster
+
+
+def test_task_history(make_cnf, sqlite_db):
+    creds = ('aaa', 'bbb')
+    cnf = json.dumps(make_cnf('test-history', {'worker1': {'nodes': 2}}))
+    for task_id, node_number, error in [('task-1', 1, None), ('task-2', 2, 'Server does not exist')]:
+        args = (cnf, 'worker1', node_number, creds)
+        history.on_task_prerun(task_id, tasks.update_node, args, {})
+        retval = common.CeleryRunnerResult('update_node', {'status': 'updated'} if not error else None, creds, error=error).export()
+        history.on_task_postrun(task_id, tasks.update_node, args, {}, retval, 'SUCCESS')
+    history.on_task_prerun('task-3', tasks.get_cluster_status, (cnf,), {'creds': creds})
+    # internal tasks are not recorded
+    history.on_task_prerun('task-4', tasks.schedule_nodepool_nodes, (cnf, 'worker1', {}), {'creds': creds})
+    operations = history.get_recent_operations(Cluster.init_from_cnf_creds(cnf, creds))
+    assert [(o['task_id'], o['event'], o['task_state']) for o in operations] == [
+        ('task-3', 'get_cluster_status_started', 'STARTED'),
+        ('task-2', 'update_node_failed', 'FAILURE'),
+        ('task-2', 'update_node_started', 'FAILURE'),
+        ('task-1', 'update_node_finished', 'SUCCESS'),
+        ('task-1', 'update_node_started', 'SUCCESS'),
+    ]
+    assert operations[1]['error'] == 'Server does not exist'
+    assert operations[2]['nodepool_name'] == 'worker1' and operations[2]['node_number'] == 2
+    assert history.get_recent_operations(Cluster.init_from_cnf_creds(cnf, ('aaa', 'ccc'))) == []
+    assert len(history.get_recent_operations(Cluster.init_from_cnf_creds(cnf, creds), limit=2)) == 2
+
+
+def test_task_history_cleanup(monkeypatch, make_cnf, sqlite_db):
+    result_backend = f'db+sqlite:///{sqlite_db}/celery_results.db'
+    monkeypatch.setitem(tasks.app.conf, 'result_backend', result_backend)
+    backend = DatabaseBackend(app=tasks.app, url=result_backend[3:])
+    monkeypatch.setattr(tasks.app._local, 'backend', backend, raising=False)
+    cnf = json.dumps(make_cnf('test-history', {'worker1': {'nodes': 2}}))
+    for i in range(5):
+        history.on_task_prerun(f'task-{i}', tasks.get_cluster_status, (cnf,), {'creds': ('aaa', 'bbb')})
+        backend.store_result(f'task-{i}', {'ok': True}, 'SUCCESS')
+    old = db.utcnow() - datetime.timedelta(seconds=config.TASK_HISTORY_EXPIRES_SECONDS + 60)
+    with db.get_engine().begin() as conn:
+        conn.execute(db.task_history.update().where(db.task_history.c.task_id != 'task-4').values(created_at=old))
+        conn.execute(db.cluster_journal.update().where(db.cluster_journal.c.task_id != 'task-4').values(created_at=old))
+    with history.get_result_backend_engine().begin() as conn:
+        conn.execute(Task.__table__.update().where(Task.__table__.c.task_id != 'task-4').values(date_done=old))
+    assert history.cleanup(batch_size=3) == {
+        'task_history': 4, 'cluster_journal': 4, 'task_results': 4, 'diagnostics_chunks': 0, 'diagnostics_bundles': 0
+    }
+    # the cleanup creates the date_done index on the celery results table
+    result_backend_indexes = sqlalchemy.inspect(history.get_result_backend_engine()).get_indexes(Task.__table__.name)
+    assert history.RESULT_BACKEND_DATE_DONE_INDEX in [index['name'] for index in result_backend_indexes]
+    # on postgres it's created without blocking writes
+    assert str(sqlalchemy.schema.CreateIndex(history.get_result_backend_index()).compile(dialect=postgresql.dialect())).strip() == (
+        'CREATE INDEX CONCURRENTLY ix_celery_taskmeta_date_done ON celery_taskmeta (date_done)'
+    )
+    assert [o['task_id'] for o in history.get_recent_operations(Cluster.init_from_cnf_creds(cnf, ('aaa', 'bbb')))] == ['task-4']
+    assert backend.get_task_meta('task-4')['status'] == 'SUCCESS'
+    assert history.cleanup() == {
+        'task_history': 0, 'cluster_journal': 0, 'task_results': 0, 'diagnostics_chunks': 0, 'diagnostics_bundles': 0
+    }
+
+
+def test_result_expires():
+    # only database results are deleted by the cleanup, other result backends expire them
+    for result_backend, result_expires in [('db+sqlite:///results.db', 'None'), ('redis://localhost:6379/0', str(60*60*24*14))]:
+        assert subprocess.run(
+            [sys.executable, '-c', 'from cloudcli_server_kubernetes.celery import app; print(app.conf.result_expires)'],
+            env={**os.environ, 'CELERY_RESULT_BACKEND': result_backend}, capture_output=True, text=True, check=True
+        ).stdout.strip() == result_expires
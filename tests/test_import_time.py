@@ -0,0 +1,37 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+
+# cumulative import time budgets in milliseconds, can be relaxed on slow machines with IMPORT_TIME_BUDGET_FACTOR
+IMPORT_TIME_BUDGET_FACTOR = float(os.getenv('IMPORT_TIME_BUDGET_FACTOR', '1'))
+HEAVY_MODULES = ['fastapi', 'starlette', 'celery', 'kombu', 'prometheus_client']
+
+
+def get_import_times(module):
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True
+    ).stderr
+    import_times = {}
+    for line in output.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_time, cumulative_time, name = [part.strip() for part in line.replace('import time:', '').split('|')]
+            if cumulative_time.isdigit():
+                import_times[name] = int(cumulative_time) / 1000
+    return import_times
+
+
+@pytest.mark.parametrize('module, budget_ms', [
+    # cli startup, all commands import their dependencies lazily
+    ('cloudcli_server_kubernetes.cli', 150),
+    # used by the kubeconfig / status / node cli commands
+    ('cloudcli_server_kubernetes.lib.cluster', 400),
+])
+def test_import_time(module, budget_ms):
+    import_times = get_import_times(module)
+    heavy_modules = [name for name in HEAVY_MODULES if name in import_times]
+    assert not heavy_modules, f'{module} should not import {heavy_modules}'
+    assert import_times[module] < budget_ms * IMPORT_TIME_BUDGET_FACTOR, f'{module} import took {import_times[module]}ms'
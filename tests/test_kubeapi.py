@@ -0,0 +1,103 @@
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from cloudcli_server_kubernetes.lib import kubeapi, kubeconfigcache
+from cloudcli_server_kubernetes.lib.cnf import Cnf
+from cloudcli_server_kubernetes.lib.node import Node
+from cloudcli_server_kubernetes.lib.cluster import Cluster
+
+
+RESPONSES = {
+    '/version': {'gitVersion': 'v1.31.1+rke2r1'},
+    '/api/v1/nodes': {'items': [
+        {
+            'metadata': {'name': 'test-kubeapi-controlplane-1'},
+            'status': {
+                'conditions': [{'type': 'Ready', 'status': 'True'}],
+                'nodeInfo': {'kubeletVersion': 'v1.31.1+rke2r1'},
+                'addresses': [{'type': 'InternalIP', 'address': '10.0.0.2'}],
+                'capacity': {'cpu': '2'},
+            },
+        },
+        {
+            'metadata': {'name': 'test-kubeapi-worker1-1'},
+            'status': {'conditions': [{'type': 'Ready', 'status': 'False'}]},
+        },
+    ]},
+    '/apis/metrics.k8s.io/v1beta1/nodes': {'items': [
+        {'metadata': {'name': 'test-kubeapi-controlplane-1'}, 'usage': {'cpu': '100m', 'memory': '1Gi'}},
+    ]},
+}
+
+
+class MockKubeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    client_ports = set()
+
+    def do_GET(self):
+        self.client_ports.add(self.client_address[1])
+        body = json.dumps(RESPONSES[self.path]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_kube_api(monkeypatch, make_cnf):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockKubeApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        kubeconfig = json.dumps({
+            'clusters': [{'cluster': {'server': f'http://127.0.0.1:{server.server_port}'}}],
+            'users': [{'user': {'token': 'test-token'}}],
+        })
+        monkeypatch.setattr(Cluster, 'get_kubeconfig', lambda self, controlplane_server_info=None, cached=False: kubeconfig)
+        cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-kubeapi')), ('aaa', 'bbb'))
+        assert cluster.get_nodes_ready() == {'test-kubeapi-controlplane-1': True, 'test-kubeapi-worker1-1': False}
+        nodes_status = cluster.call_kube_api(kubeapi.get_nodes_status)
+        assert nodes_status['test-kubeapi-controlplane-1'] == {
+            'ready': True,
+            'kubelet_version': 'v1.31.1+rke2r1',
+            'addresses': {'InternalIP': '10.0.0.2'},
+            'capacity': {'cpu': '2'},
+            'usage': {'cpu': '100m', 'memory': '1Gi'},
+        }
+        assert nodes_status['test-kubeapi-worker1-1']['usage'] is None
+        # all requests use the same pooled connection
+        assert len(MockKubeApiHandler.client_ports) == 1
+    finally:
+        server.shutdown()
+
+
+def test_kube_api_client_per_controlplane_ip(monkeypatch, make_cnf):
+    kubeconfigs = []
+
+    def mock_get_kubeconfig(self, controlplane_server_info=None, cached=False):
+        time.sleep(.1)
+        ip = controlplane_server_info['ip'] if controlplane_server_info else '1.2.3.4'
+        kubeconfigs.append(ip)
+        return json.dumps({
+            'clusters': [{'cluster': {'server': f'https://{ip}:6443'}}],
+            'users': [{'user': {'token': 'test-token'}}],
+        })
+
+    monkeypatch.setattr(Cluster, 'get_kubeconfig', mock_get_kubeconfig)
+    monkeypatch.setattr(Node, 'get_public_private_ips', lambda self, server_info=None: (server_info['ip'], '10.0.0.2'))
+    monkeypatch.setattr(kubeconfigcache, 'invalidate', lambda cluster, controlplane_ip=None: None)
+    cluster = Cluster(Cnf(json.dumps(make_cnf('test-kubeapi')), ('aaa', 'bbb')))
+    # concurrent calls on the shared cluster create a single client
+    with ThreadPoolExecutor(5) as executor:
+        kube_apis = list(executor.map(lambda i: cluster.get_kube_api(), range(5)))
+    assert len(kubeconfigs) == 1 and all(kube_api is kube_apis[0] for kube_api in kube_apis)
+    assert cluster.get_kube_api({'ip': '1.2.3.4'}) is kube_apis[0]
+    # the controlplane ip changed
+    kube_api = cluster.get_kube_api({'ip': '5.6.7.8'})
+    assert kube_api is not kube_apis[0] and kube_api.server == 'https://5.6.7.8:6443'
+    assert cluster.get_kube_api() is kube_api
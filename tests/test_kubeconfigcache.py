@@ -0,0 +1,79 @@
+import json
+import datetime
+
+from cryptography.fernet import Fernet
+
+from cloudcli_server_kubernetes import config, db, common
+from cloudcli_server_kubernetes.lib import kubeconfigcache
+from cloudcli_server_kubernetes.lib.cluster import Cluster
+from cloudcli_server_kubernetes.lib.node import Node
+
+
+KUBECONFIG = '''
+clusters:
+- cluster:
+    server: https://127.0.0.1:6443
+users:
+- user:
+    token: test-token
+'''
+
+
+def test_kubeconfig_cache(monkeypatch, make_cnf, sqlite_db, result_backend):
+    cnf = json.dumps(make_cnf('test-kubeconfig-cache'))
+    ssh_calls = []
+    public_ips = ['1.2.3.4']
+    monkeypatch.setattr(Node, 'get_server_info', lambda self: {'name': self.server_name_prefix})
+    monkeypatch.setattr(Node, 'get_public_private_ips', lambda self, server_info=None: (public_ips[0], '10.0.0.1'))
+    monkeypatch.setattr(Node, 'ssh', lambda self, command, server_info=None: ssh_calls.append(command) or KUBECONFIG)
+    monkeypatch.setattr(config, 'KUBECONFIG_CACHE_ENCRYPTION_KEYS', Fernet.generate_key().decode())
+    creds = ('aaa', 'bbb')
+    cluster = Cluster.init_from_cnf_creds(cnf, creds)
+    assert kubeconfigcache.get_kubeconfig_task_id(cluster) is None
+    kubeconfig = cluster.get_kubeconfig()
+    assert 'https://1.2.3.4:6443' in kubeconfig
+    with db.get_engine().connect() as conn:
+        row = conn.execute(db.kubeconfig_cache.select()).first()
+    assert row.creds_fingerprint == common.get_creds_fingerprint(creds)
+    # stored encrypted
+    assert 'test-token' not in row.kubeconfig
+    # cache hits don't connect to the controlplane
+    assert cluster.get_kubeconfig(cached=True) == kubeconfig
+    task_id = kubeconfigcache.get_kubeconfig_task_id(cluster)
+    result = common.CeleryRunnerResult.parse(result_backend.results[task_id], creds)
+    assert result.result == kubeconfig and result.meta == {'cached': True}
+    assert len(ssh_calls) == 1
+    # kubeconfig is not returned for other creds of the same account
+    other_cluster = Cluster.init_from_cnf_creds(cnf, ('aaa', 'ccc'))
+    assert kubeconfigcache.get(other_cluster) is None
+    # expired
+    with db.get_engine().begin() as conn:
+        conn.execute(db.kubeconfig_cache.update().values(updated_at=db.utcnow() - datetime.timedelta(hours=2)))
+    assert kubeconfigcache.get(cluster) is None
+    cluster.get_kubeconfig(cached=True)
+    assert len(ssh_calls) == 2
+    # invalidated only when the controlplane ip changed
+    kubeconfigcache.invalidate(cluster, '1.2.3.4')
+    assert kubeconfigcache.get(cluster) == kubeconfig
+    public_ips[0] = '5.6.7.8'
+    kubeconfigcache.invalidate(cluster, '5.6.7.8')
+    assert kubeconfigcache.get(cluster) is None
+    assert 'https://5.6.7.8:6443' in cluster.get_kubeconfig(cached=True)
+
+
+def test_kubeconfig_cache_keys(monkeypatch, make_cnf, sqlite_db):
+    old_key, new_key = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+    cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-kubeconfig-cache')), ('aaa', 'bbb'))
+    # not cached without a key
+    monkeypatch.setattr(config, 'KUBECONFIG_CACHE_ENCRYPTION_KEYS', None)
+    kubeconfigcache.save(cluster, '1.2.3.4', KUBECONFIG)
+    with db.get_engine().connect() as conn:
+        assert conn.execute(db.kubeconfig_cache.select()).first() is None
+    monkeypatch.setattr(config, 'KUBECONFIG_CACHE_ENCRYPTION_KEYS', old_key)
+    kubeconfigcache.save(cluster, '1.2.3.4', KUBECONFIG)
+    # decrypted with an old key after rotation
+    monkeypatch.setattr(config, 'KUBECONFIG_CACHE_ENCRYPTION_KEYS', f'{new_key},{old_key}')
+    assert kubeconfigcache.get(cluster) == KUBECONFIG
+    # a cached kubeconfig which can't be decrypted is a cache miss
+    monkeypatch.setattr(config, 'KUBECONFIG_CACHE_ENCRYPTION_KEYS', new_key)
+    assert kubeconfigcache.get(cluster) is None
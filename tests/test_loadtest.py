@@ -0,0 +1,11 @@
+from loadtest import run_loadtest
+
+
+def test_loadtest_inprocess():
+    reports = run_loadtest(num_requests=20, concurrency=4, burst_concurrency=10, node_pools=2, nodes=3)
+    assert [report['scenario'] for report in reports] == ['task_status', 'create_node_burst', 'openapi']
+    for report in reports:
+        assert report['config'] == 'inprocess'
+        assert report['requests'] == 20
+        assert report['errors'] == 0
+        assert 0 < report['p50_ms'] <= report['p95_ms'] <= report['p99_ms']
@@ -0,0 +1,52 @@
+import asyncio
+
+from prometheus_client import REGISTRY
+
+from cloudcli_server_kubernetes import metrics, web
+from cloudcli_server_kubernetes.lib import cloudcli
+
+
+class MockResponse:
+    status_code = 200
+
+    def json(self):
+        return [{'status': 'complete'}]
+
+
+def get_sample_value(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+def test_cloudcli_server_request_metrics(monkeypatch):
+    monkeypatch.setattr('requests.request', lambda **kwargs: MockResponse())
+    labels = {'path': '/service/queue', 'method': 'GET', 'status': '200'}
+    count = get_sample_value('cloudcli_server_request_duration_seconds_count', labels)
+    assert cloudcli.cloudcli_server_request('/service/queue?id=123', ('aaa', 'bbb')) == (200, [{'status': 'complete'}])
+    assert cloudcli.cloudcli_server_request('/service/queue?id=456', ('aaa', 'bbb')) == (200, [{'status': 'complete'}])
+    assert get_sample_value('cloudcli_server_request_duration_seconds_count', labels) == count + 2
+
+
+def test_node_ssh_failure_metrics():
+    count = get_sample_value('node_ssh_duration_seconds_count')
+    failures = get_sample_value('node_ssh_failures_total')
+    try:
+        with metrics.time_node_ssh('test-cluster-worker1-1'):
+            raise Exception('ssh failed')
+    except Exception:
+        pass
+    assert get_sample_value('node_ssh_duration_seconds_count') == count + 1
+    assert get_sample_value('node_ssh_failures_total') == failures + 1
+
+
+def test_metrics_endpoint():
+    response = asyncio.run(web.get_metrics())
+    assert response.status_code == 200
+    body = response.body.decode()
+    for name in [
+        'cloudcli_server_request_duration_seconds',
+        'node_ssh_duration_seconds',
+        'cloudcli_wait_command_duration_seconds',
+        'celery_task_duration_seconds',
+        'celery_tasks_in_flight',
+    ]:
+        assert f'# TYPE {name}' in body
@@ -0,0 +1,50 @@
+import os
+import json
+import asyncio
+import tempfile
+
+from starlette.requests import Request
+
+from cloudcli_server_kubernetes import config, web
+
+
+def get_openapi_json(if_none_match=None):
+    headers = [(b'if-none-match', if_none_match.encode())] if if_none_match else []
+    return asyncio.run(web.openapi_json(Request({'type': 'http', 'method': 'GET', 'path': '/k8s/openapi.json', 'headers': headers})))
+
+
+def test_openapi_schema(monkeypatch):
+    monkeypatch.setattr(web, '_openapi_schema_content', None)
+    res = get_openapi_json()
+    assert res.status_code == 200
+    schema = json.loads(res.body)
+    assert schema['paths']['/k8s/status']['post']['x-cloudcli-k8s']['use'] == 'status'
+    assert schema['security'] == [{"APIKeyHeader": [], "APISecretHeader": []}]
+    assert '/k8s/openapi.json' not in schema['paths']
+    etag = res.headers['etag']
+    assert res.headers['cache-control'] == f'public, max-age={config.OPENAPI_CACHE_MAX_AGE_SECONDS}'
+    assert get_openapi_json().body is res.body
+    res = get_openapi_json(f'"other", W/{etag}')
+    assert res.status_code == 304 and res.body == b'' and res.headers['etag'] == etag
+    assert get_openapi_json('"other"').status_code == 200
+
+
+def test_openapi_schema_file(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'openapi.json')
+        web.write_openapi_schema(filename)
+        with open(filename, 'rb') as f:
+            content = f.read()
+        monkeypatch.setattr(config, 'OPENAPI_SCHEMA_FILE', filename)
+        monkeypatch.setattr(web, '_openapi_schema_content', None)
+        # the file is served as is
+        monkeypatch.setattr(web, 'get_openapi_schema', lambda: 1 / 0)
+        assert get_openapi_json().body == content
+        # files of other versions are ignored
+        schema = json.loads(content)
+        schema['info']['version'] = 'outdated'
+        with open(filename, 'w') as f:
+            json.dump(schema, f)
+        monkeypatch.setattr(web, '_openapi_schema_content', None)
+        monkeypatch.setattr(web, 'get_openapi_schema', lambda: {'info': {'version': 'generated'}})
+        assert json.loads(get_openapi_json().body) == {'info': {'version': 'generated'}}
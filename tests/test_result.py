@@ -0,0 +1,46 @@
+import pickle
+
+import pytest
+
+from cloudcli_server_kubernetes import common, config
+from cloudcli_server_kubernetes.lib.cluster import ClusterCeleryRunnerResult
+
+
+def test_result_export_parse():
+    creds = ('aaa', 'bbb')
+    status = {'node_pools': {'worker1': {str(n): {'name': f'worker1-{n}', 'networks': []} for n in range(100)}}}
+    exported = ClusterCeleryRunnerResult('get_cluster_status', status, creds, meta={'snapshot_age_seconds': 1}).export()
+    assert 'creds' not in exported and 'bbb' not in str(pickle.dumps(exported))
+    assert exported.keys() == {'__result_type', 'object_name', 'task_name', 'creds_fingerprint', 'payload_zlib'}
+    assert len(exported['payload_zlib']) < config.RESULT_COMPRESS_MIN_BYTES
+    result = common.CeleryRunnerResult.parse(exported, ['aaa', 'bbb'])
+    assert isinstance(result, ClusterCeleryRunnerResult)
+    assert result.result == status and result.meta == {'snapshot_age_seconds': 1} and result.error is None
+    with pytest.raises(common.CloudcliException):
+        common.CeleryRunnerResult.parse(exported, ('aaa', 'ccc'))
+    with pytest.raises(common.CloudcliException):
+        common.CeleryRunnerResult.parse(exported, None)
+    # small results are not compressed and empty fields are omitted
+    exported = common.CeleryRunnerResult('create_node', {'node_number': 1}, creds).export()
+    assert exported['result'] == {'node_number': 1} and 'error' not in exported and 'meta' not in exported
+
+
+def test_result_error_traceback():
+    def fail():
+        raise common.CloudcliException('failed')
+    exported = common.CeleryRunnerResult('create_node', fail, ('aaa', 'bbb')).export()
+    assert exported['error'] == 'failed' and 'CloudcliException: failed' in exported['traceback']
+    tb = 'x' * (config.RESULT_TRACEBACK_MAX_CHARS * 2) + 'end'
+    assert common.truncate_traceback(tb).endswith('end')
+    assert len(common.truncate_traceback(tb)) < config.RESULT_TRACEBACK_MAX_CHARS + 10
+
+
+def test_result_parse_stored_with_creds():
+    # results stored before the creds fingerprint was added
+    exported = {
+        '__result_type': 'CeleryRunnerResult', 'object_name': 'common', 'task_name': 'create_node',
+        'result': {'node_number': 1}, 'error': None, 'traceback': None, 'creds': ('aaa', 'bbb'), 'meta': None, 'timing': None,
+    }
+    assert common.CeleryRunnerResult.parse(exported, ('aaa', 'bbb')).result == {'node_number': 1}
+    with pytest.raises(common.CloudcliException):
+        common.CeleryRunnerResult.parse(exported, ('aaa', 'ccc'))
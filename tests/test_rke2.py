@@ -0,0 +1,75 @@
+import os
+import subprocess
+import tempfile
+
+from cloudcli_server_kubernetes import config
+from cloudcli_server_kubernetes.lib import rke2
+
+
+RKE2_ARGS = ('test-cluster-worker1-1', False, 'https://1.2.3.4:9345', 'test-token', {})
+
+
+def assert_valid_bash(script):
+    subprocess.run(['bash', '-n'], input=script, text=True, check=True)
+
+
+def test_rke2_mirror_scripts():
+    artifacts_url = rke2.get_rke2_artifacts_url('http://10.0.0.2:8089/')
+    assert artifacts_url == f'http://10.0.0.2:8089/{config.RKE2_VERSION.replace("+", "%2B")}'
+    default_script = rke2.get_rke2_init_script(*RKE2_ARGS)
+    mirror_script = rke2.get_rke2_init_script(*RKE2_ARGS, artifacts_url=artifacts_url)
+    serve_mirror_script = rke2.get_rke2_init_script('test-cluster-controlplane-1', True, None, None, serve_mirror=True)
+    for script in [default_script, mirror_script, serve_mirror_script, rke2.get_rke2_update_script(*RKE2_ARGS, artifacts_url=artifacts_url)]:
+        assert_valid_bash(script)
+    assert 'https://get.rke2.io' in default_script
+    for filename, url in rke2.get_rke2_upstream_urls().items():
+        # downloaded from upstream only if the mirror doesn't have it
+        assert f'{artifacts_url}/{filename} || curl -sfL -o {rke2.RKE2_ARTIFACTS_PATH}/{filename} {url}' in mirror_script
+    assert 'INSTALL_RKE2_ARTIFACT_PATH' in serve_mirror_script and 'cloudcli-rke2-mirror' in serve_mirror_script
+    # the mirror does not change the applied config, so it doesn't require updating existing nodes
+    assert rke2.get_rke2_fingerprint(*RKE2_ARGS) in mirror_script
+
+
+def test_rke2_skip_installed():
+    script = rke2.get_rke2_init_script(*RKE2_ARGS)
+    preinstall_script = rke2.get_rke2_preinstall_script()
+    for s in [script, preinstall_script]:
+        assert_valid_bash(s)
+        assert f'/usr/local/bin/rke2 --version' in s
+    assert rke2.RKE2_PREINSTALLED_FILE in preinstall_script
+    assert 'systemctl start' not in preinstall_script
+
+
+def test_rke2_mirror_version_bump(monkeypatch):
+    # the workers are updated to the new version before the controlplane which serves the mirror downloaded it
+    monkeypatch.setattr(config, 'RKE2_VERSION', 'v1.99.0+rke2r1')
+    artifacts_url = rke2.get_rke2_artifacts_url('http://10.0.0.2:8089')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        monkeypatch.setattr(rke2, 'RKE2_ARTIFACTS_PATH', os.path.join(tmpdir, 'artifacts'))
+        os.mkdir(os.path.join(tmpdir, 'bin'))
+        with open(os.path.join(tmpdir, 'bin', 'curl'), 'w') as f:
+            f.write('\n'.join([
+                '#!/bin/bash',
+                'echo "$4" >> ' + os.path.join(tmpdir, 'curl.log'),
+                'if [[ "$4" == http://10.0.0.2:8089/* ]]; then exit 22; fi',
+                'echo "$4" > "$3"',
+            ]))
+        with open(os.path.join(tmpdir, 'bin', 'sh'), 'w') as f:
+            f.write(f'#!/bin/bash\necho "$1" > {tmpdir}/install.log\n')
+        for filename in ['curl', 'sh']:
+            os.chmod(os.path.join(tmpdir, 'bin', filename), 0o755)
+        subprocess.run(
+            ['bash', '-c', ' && '.join(rke2.get_rke2_install_commands('agent', artifacts_url))],
+            env={**os.environ, 'PATH': f'{tmpdir}/bin:{os.environ["PATH"]}'}, check=True
+        )
+        with open(os.path.join(tmpdir, 'curl.log')) as f:
+            assert f.read().split() == [
+                url
+                for filename, upstream_url in rke2.get_rke2_upstream_urls().items()
+                for url in [f'{artifacts_url}/{filename}', upstream_url]
+            ]
+        for filename, url in rke2.get_rke2_upstream_urls().items():
+            with open(os.path.join(rke2.RKE2_ARTIFACTS_PATH, filename)) as f:
+                assert f.read().strip() == url
+        with open(os.path.join(tmpdir, 'install.log')) as f:
+            assert f.read().strip() == f'{rke2.RKE2_ARTIFACTS_PATH}/install.sh'
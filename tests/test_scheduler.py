@@ -0,0 +1,155 @@
+import json
+from types import SimpleNamespace
+
+import celery
+
+from cloudcli_server_kubernetes import tasks, common, config
+from cloudcli_server_kubernetes.lib.cluster import Cluster
+from cloudcli_server_kubernetes.lib.nodepool import NodePoolCeleryRunner
+from cloudcli_server_kubernetes.lib.scheduler import NodePoolScheduler
+
+
+NODE_POOLS = {
+    "worker1": {
+        "nodes": 4,
+        "max-parallel": 2,
+        "max-unavailable": 2,
+    }
+}
+
+
+def test_scheduler_rolling_update(monkeypatch, make_cnf, result_backend):
+    state = {'dispatched': [], 'task_states': {}, 'nodes_ready': {}}
+
+    def mock_apply_async(args, task_id):
+        state['dispatched'].append(args[2])
+        state['task_states'][task_id] = 'PENDING'
+
+    def mock_get_task_status(task_id, creds):
+        return {'state': state['task_states'][task_id], 'result': {'status': 'updated'}, 'error': 'failed'}
+
+    monkeypatch.setattr(tasks.update_node, 'apply_async', mock_apply_async)
+    monkeypatch.setattr(common, 'get_task_status', mock_get_task_status)
+    monkeypatch.setattr(Cluster, 'get_nodes_ready', lambda self: state['nodes_ready'])
+    cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-scheduler', NODE_POOLS)), ('aaa', 'bbb'))
+    assert cluster.cnf.node_pools['worker1'].max_parallel == 2
+    schedule = NodePoolScheduler.init_schedule([('update_node', n) for n in [1, 2, 3, 4]], 2, 2)
+    task_ids = {node_task['node_number']: node_task['task_id'] for node_task in schedule['pending']}
+    scheduler = NodePoolScheduler(cluster.node_pools['worker1'], schedule)
+    scheduler.tick()
+    assert state['dispatched'] == [1, 2]
+    # node 1 finished but is not ready yet, so it's still unavailable and no new node can start
+    state['task_states'][task_ids[1]] = 'SUCCESS'
+    scheduler.tick()
+    assert state['dispatched'] == [1, 2]
+    assert scheduler.get_summary()['unready'] == [1]
+    state['nodes_ready']['test-scheduler-worker1-1'] = True
+    scheduler.tick()
+    assert state['dispatched'] == [1, 2, 3]
+    # a failed node stops the rollout
+    state['task_states'][task_ids[2]] = 'FAILURE'
+    scheduler.tick()
+    assert list(result_backend.results) == [task_ids[4]]
+    assert result_backend.results[task_ids[4]]['error'] == 'Skipped because another node in the node pool failed'
+    assert not scheduler.is_done
+    state['task_states'][task_ids[3]] = 'SUCCESS'
+    state['nodes_ready']['test-scheduler-worker1-3'] = True
+    scheduler.tick()
+    assert scheduler.is_done
+    assert scheduler.get_summary() == {
+        'nodepool_name': 'worker1',
+        'pending': [],
+        'running': [],
+        'unready': [],
+        'done': [1, 3],
+        'failed': [2, 4],
+    }
+
+
+def test_scheduler_controlplane_join(monkeypatch, make_cnf):
+    state = {'dispatched': [], 'task_states': {}, 'nodes_ready': {}}
+
+    def mock_apply_async(args, task_id):
+        state['dispatched'].append(args[2])
+        state['task_states'][task_id] = 'PENDING'
+
+    monkeypatch.setattr(tasks.create_node, 'apply_async', mock_apply_async)
+    monkeypatch.setattr(common, 'get_task_status', lambda task_id, creds: {'state': state['task_states'][task_id], 'result': {}, 'error': None})
+    monkeypatch.setattr(Cluster, 'get_nodes_ready', lambda self: state['nodes_ready'])
+    cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf(
+        'test-scheduler', {'controlplane': {'nodes': 5, 'join-concurrency': 2}}, {'allow-high-availability': True}
+    )), ('aaa', 'bbb'))
+    join_concurrency = cluster.cnf.node_pools['controlplane'].join_concurrency
+    assert join_concurrency == 2
+    schedule = NodePoolScheduler.init_schedule(
+        [('create_node', n) for n in [2, 3, 4, 5]], join_concurrency, join_concurrency, barrier=('create_node', 1)
+    )
+    task_ids = {node_task['node_number']: node_task['task_id'] for node_task in schedule['pending']}
+    scheduler = NodePoolScheduler(cluster.node_pools['controlplane'], schedule)
+    scheduler.tick()
+    assert state['dispatched'] == [1]
+    # the other nodes wait until the first node is ready
+    state['task_states'][task_ids[1]] = 'SUCCESS'
+    scheduler.tick()
+    assert state['dispatched'] == [1]
+    state['nodes_ready']['test-scheduler-controlplane-1'] = True
+    scheduler.tick()
+    assert state['dispatched'] == [1, 2, 3]
+
+
+def test_scheduler_tick_errors(monkeypatch, make_cnf, result_backend):
+    state = {'dispatched': [], 'fail': True}
+
+    def mock_apply_async(args, task_id):
+        state['dispatched'].append(args[2])
+
+    def mock_get_task_status(task_id, creds):
+        if state['fail']:
+            raise Exception('result backend is not available')
+        return {'state': 'PENDING', 'result': None, 'error': None}
+
+    monkeypatch.setattr(tasks.update_node, 'apply_async', mock_apply_async)
+    monkeypatch.setattr(common, 'get_task_status', mock_get_task_status)
+    cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-scheduler', NODE_POOLS)), ('aaa', 'bbb'))
+    schedule = NodePoolScheduler.init_schedule([('update_node', n) for n in [1, 2, 3, 4]], 2, 2)
+    task_ids = {node_task['node_number']: node_task['task_id'] for node_task in schedule['pending']}
+    scheduler = NodePoolScheduler(cluster.node_pools['worker1'], schedule)
+    scheduler.tick()
+    assert state['dispatched'] == [1, 2]
+    # a failed tick keeps the schedule unchanged so it can be retried
+    scheduler.tick()
+    assert scheduler.get_summary()['running'] == [1, 2] and scheduler.get_summary()['pending'] == [3, 4]
+    assert 'error_since' in scheduler.schedule
+    state['fail'] = False
+    scheduler.tick()
+    assert 'error_since' not in scheduler.schedule
+    # after errors for too long, the pending node tasks are marked as failed and the schedule ends
+    state['fail'] = True
+    scheduler.tick()
+    scheduler.schedule['error_since'] -= config.ROLLING_UPDATE_ERROR_TIMEOUT_SECONDS + 1
+    scheduler.tick()
+    assert scheduler.is_done
+    assert sorted(result_backend.results) == sorted([task_ids[3], task_ids[4]])
+    assert result_backend.results[task_ids[3]]['error'] == 'Skipped because the node pool schedule failed'
+    assert scheduler.get_summary()['failed'] == [3, 4, 1, 2]
+
+
+def test_create_controlplane_status(monkeypatch, make_cnf):
+    # the status of the create controlplane task includes the tasks which create the other servers in advance
+    monkeypatch.setattr(celery, 'group', lambda signatures: SimpleNamespace(
+        delay=lambda: SimpleNamespace(children=[SimpleNamespace(id=f'server-{s.args[2]}') for s in signatures])
+    ))
+    monkeypatch.setattr(tasks.schedule_nodepool_nodes, 'delay', lambda *args: None)
+    task_statuses = {}
+    monkeypatch.setattr(common, 'get_task_status', lambda task_id, creds: task_statuses.setdefault(task_id, {
+        'state': 'SUCCESS', 'result': {}, 'error': None, 'meta': {},
+    }))
+    cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf(
+        'test-scheduler', {'controlplane': {'nodes': 3}}, {'allow-high-availability': True}
+    )), ('aaa', 'bbb'))
+    result = common.CeleryRunnerResult.parse(NodePoolCeleryRunner(cluster.node_pools['controlplane']).create(None), ('aaa', 'bbb'))
+    assert result.result['servers_task_ids'] == ['server-2', 'server-3']
+    task_statuses['server-3'] = {'state': 'FAILURE', 'result': None, 'error': 'Failed to create server', 'meta': {}}
+    task_status = result.get_task_status()
+    assert len(task_status['meta']['subtasks']) == 5
+    assert task_status['state'] == 'FAILURE'
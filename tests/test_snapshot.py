@@ -0,0 +1,36 @@
+import json
+import datetime
+
+from cloudcli_server_kubernetes import db, tasks, common
+from cloudcli_server_kubernetes.lib import snapshot
+from cloudcli_server_kubernetes.lib.cluster import Cluster
+
+
+def test_cluster_snapshot(monkeypatch, make_cnf, sqlite_db, result_backend):
+    cnf = json.dumps(make_cnf('test-snapshot'))
+    refresh_calls = []
+    monkeypatch.setattr(tasks.get_cluster_status, 'delay', lambda cnf: refresh_calls.append(cnf))
+    monkeypatch.setattr(Cluster, 'get_status', lambda self: {'cluster_server': 'https://1.2.3.4:9345'})
+    creds = ('aaa', 'bbb')
+    cluster = Cluster.init_from_cnf_creds(cnf, creds)
+    assert snapshot.get_status_task_id(cluster) is None
+    snapshot.refresh(cluster)
+    task_id = snapshot.get_status_task_id(cluster)
+    result = common.CeleryRunnerResult.parse(result_backend.results[task_id], creds)
+    assert result.get_task_status() == {
+        'task_name': 'get_cluster_status',
+        'state': 'SUCCESS',
+        'result': {'cluster_server': 'https://1.2.3.4:9345'},
+        'error': None,
+        'meta': {'snapshot_age_seconds': 0},
+    }
+    assert refresh_calls == []
+    # the snapshot is not returned for other creds of the same account
+    assert snapshot.get_status_task_id(Cluster.init_from_cnf_creds(cnf, ('aaa', 'ccc'))) is None
+    # a stale snapshot is still returned, and refreshed in the background only once
+    with db.get_engine().begin() as conn:
+        conn.execute(db.cluster_snapshot.update().values(updated_at=db.utcnow() - datetime.timedelta(hours=1)))
+    for _ in range(3):
+        task_id = snapshot.get_status_task_id(cluster)
+        assert result_backend.results[task_id]['meta']['snapshot_age_seconds'] >= 3600
+    assert len(refresh_calls) == 1
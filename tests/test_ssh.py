@@ -0,0 +1,150 @@
+import sys
+import json
+import socket
+import threading
+import subprocess
+
+import pytest
+
+from cloudcli_server_kubernetes import config, common, timing
+from cloudcli_server_kubernetes.lib import ssh
+from cloudcli_server_kubernetes.lib.node import Node
+from cloudcli_server_kubernetes.lib.cluster import Cluster, ClusterCeleryRunner, ClusterException
+
+
+class FakeSshd:
+    # accepts connections and sends the ssh banner, the port is closed until start() is called
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        self.sock.listen()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                conn.sendall(b'SSH-2.0-OpenSSH_9.6\r\n')
+
+    def close(self):
+        self.sock.close()
+
+
+def test_wait_ssh_ready(monkeypatch):
+    monkeypatch.setattr(config, 'SSH_READY_BACKOFF_INITIAL_SECONDS', 0.05)
+    monkeypatch.setattr(config, 'SSH_READY_BACKOFF_MAX_SECONDS', 0.2)
+    monkeypatch.setattr(config, 'SSH_READY_PROBE_TIMEOUT_SECONDS', 0.5)
+    sshds = [FakeSshd(), FakeSshd()]
+    try:
+        assert not ssh.probe_ssh_port('127.0.0.1', sshds[0].port)
+        sshds[0].start()
+        assert ssh.wait_ssh_port('127.0.0.1', sshds[0].port, timeout_seconds=1) == 1
+        # the second port opens after some failed attempts
+        threading.Timer(0.3, sshds[1].start).start()
+        assert ssh.wait_ssh_port('127.0.0.1', sshds[1].port, timeout_seconds=5) > 1
+    finally:
+        for sshd in sshds:
+            sshd.close()
+
+
+def test_wait_ssh_ready_timeout(monkeypatch):
+    monkeypatch.setattr(config, 'SSH_READY_BACKOFF_INITIAL_SECONDS', 0.05)
+    monkeypatch.setattr(config, 'SSH_READY_PROBE_TIMEOUT_SECONDS', 0.5)
+    sshd, closed_sshd = FakeSshd(), FakeSshd()
+    sshd.start()
+    try:
+        with pytest.raises(ssh.SshException):
+            ssh.wait_ssh_ready(['127.0.0.1', '127.0.0.1'], port=closed_sshd.port, timeout_seconds=0.3)
+        ssh.wait_ssh_ready(['127.0.0.1', '127.0.0.1'], port=sshd.port, timeout_seconds=1)
+    finally:
+        sshd.close()
+        closed_sshd.close()
+
+
+def test_node_ssh_options_and_timeout(monkeypatch, make_cnf):
+    calls = []
+
+    def mock_check_output(args, text, timeout):
+        calls.append((args, timeout))
+        raise subprocess.TimeoutExpired(args, timeout)
+
+    monkeypatch.setattr(subprocess, 'check_output', mock_check_output)
+    monkeypatch.setattr(config, 'SSH_COMMAND_TIMEOUT_SECONDS', 5)
+    node = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-ssh', {'worker1': {'nodes': 3}})), ('aaa', 'bbb')).node_pools['controlplane'].get_node(1)
+    monkeypatch.setattr(node, 'get_public_private_ips', lambda server_info=None: ('1.2.3.4', '10.0.0.1'))
+    with pytest.raises(ssh.SshException):
+        node.ssh('true')
+    args, timeout = calls[0]
+    assert timeout == 5
+    assert f'ConnectTimeout={config.SSH_CONNECT_TIMEOUT_SECONDS}' in args
+    assert f'ServerAliveInterval={config.SSH_SERVER_ALIVE_INTERVAL_SECONDS}' in args
+    assert args[-2:] == ['root@1.2.3.4', 'true']
+
+
+def test_node_ssh_exec_timing(monkeypatch, make_cnf):
+    calls = []
+    monkeypatch.setattr(ssh, 'run', lambda args, on_output=None, timeout_seconds=None: calls.append(args) or {'exit_code': 0, 'output': '', 'error': None})
+    node = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-ssh', {'worker1': {'nodes': 3}})), ('aaa', 'bbb')).node_pools['controlplane'].get_node(1)
+    monkeypatch.setattr(node, 'get_public_private_ips', lambda server_info=None: ('1.2.3.4', '10.0.0.1'))
+    with timing.profile() as timing_profile:
+        assert node.ssh_exec('true')['exit_code'] == 0
+    assert calls[0][-2:] == ['root@1.2.3.4', 'true']
+    assert timing_profile.categories['ssh']['count'] == 1
+
+
+def test_run_output_and_timeout(monkeypatch):
+    monkeypatch.setattr(config, 'SSH_FANOUT_OUTPUT_MAX_CHARS', 20)
+    lines = []
+    res = ssh.run([sys.executable, '-c', 'import sys; [print(f"line {i}") for i in range(5)]; sys.exit(3)'], lines.append)
+    assert lines == [f'line {i}\n' for i in range(5)]
+    # only the tail of the output is kept
+    assert res == {'exit_code': 3, 'output': 'line 3\nline 4\n', 'error': None}
+    res = ssh.run([sys.executable, '-c', 'import time; print("started", flush=True); time.sleep(10)'], timeout_seconds=0.5)
+    assert res == {'exit_code': None, 'output': 'started\n', 'error': 'Command did not complete in 0.5 seconds'}
+
+
+def test_cluster_run_command(monkeypatch, make_cnf):
+    running, max_running, lock = [0], [0], threading.Lock()
+
+    def mock_ssh_exec(self, command, server_info=None, on_output=None, timeout_seconds=None):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        try:
+            if self.node_number == 2 and self.nodepool.name == 'worker1':
+                raise ssh.SshException('Server not found')
+            return ssh.run([sys.executable, '-c', f'import time; time.sleep(.2); print({command!r}, {self.node_number})'], on_output)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setattr(Node, 'ssh_exec', mock_ssh_exec)
+    cluster = Cluster.init_from_cnf_creds(json.dumps(make_cnf('test-ssh', {'worker1': {'nodes': 3}})), ('aaa', 'bbb'))
+    outputs = []
+    res = cluster.run_command('hostname', max_parallel=2, on_output=lambda node, line: outputs.append((node.server_name_prefix, line)))
+    assert max_running[0] == 2
+    assert sorted((r['nodepool_name'], r['node_number'], r['exit_code'], r['error']) for r in res['nodes']) == [
+        ('controlplane', 1, 0, None),
+        ('worker1', 1, 0, None),
+        ('worker1', 2, None, 'Server not found'),
+        ('worker1', 3, 0, None),
+    ]
+    assert res['succeeded'] == 3 and res['failed'] == 1
+    assert sorted(outputs) == [
+        ('test-ssh-controlplane-1', 'hostname 1\n'),
+        ('test-ssh-worker1-1', 'hostname 1\n'),
+        ('test-ssh-worker1-3', 'hostname 3\n'),
+    ]
+    res = cluster.run_command('hostname', nodepool_names=['worker1'], node_numbers=[1, 3])
+    assert [(r['nodepool_name'], r['node_number']) for r in res['nodes']] == [('worker1', 1), ('worker1', 3)]
+    with pytest.raises(ClusterException):
+        cluster.run_command('hostname', nodepool_names=['worker2'])
+    result = common.CeleryRunnerResult.parse(ClusterCeleryRunner(cluster).run_command(None, 'hostname', ['controlplane']), ('aaa', 'bbb'))
+    assert result.result['nodes'][0]['output'] == 'hostname 1\n'
@@ -0,0 +1,28 @@
+import time
+
+from cloudcli_server_kubernetes import timing
+
+
+def test_profile_exclusive_categories_and_aggregate():
+    with timing.profile() as timing_profile:
+        with timing.record('wait'):
+            time.sleep(0.05)
+            with timing.record('api'):
+                time.sleep(0.02)
+        with timing.record('ssh'):
+            time.sleep(0.02)
+    res = timing_profile.export()
+    assert res['tasks'] == 1
+    assert res['api']['count'] == res['ssh']['count'] == res['wait']['count'] == 1
+    assert 0.02 <= res['api']['total'] < 0.05
+    assert 0.05 <= res['wait']['total'] < 0.07
+    assert abs(res['api']['total'] + res['ssh']['total'] + res['wait']['total'] + res['other']['total'] - res['wall']) < 0.005
+    aggregated = timing.aggregate([res, None, res])
+    assert aggregated['tasks'] == 2
+    assert aggregated['api']['count'] == 2
+    assert aggregated['wait']['percent'] == round(res['wait']['total'] / res['wall'] * 100, 1)
+
+
+def test_record_without_profile():
+    with timing.record('api'):
+        pass
@@ -0,0 +1,50 @@
+import os
+import json
+import tempfile
+from types import SimpleNamespace
+
+from cloudcli_server_kubernetes import tracing
+
+
+def read_spans(filename):
+    with open(filename) as f:
+        return {span['name']: span for span in map(json.loads, f)}
+
+
+def test_span_file_exporter_and_celery_propagation(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'traces.jsonl')
+        monkeypatch.setattr('cloudcli_server_kubernetes.config.TRACING_EXPORTER', 'file')
+        monkeypatch.setattr('cloudcli_server_kubernetes.config.TRACING_FILE', filename)
+        headers = {}
+        with tracing.span('POST /k8s/create_cluster') as web_span:
+            tracing.on_before_task_publish(headers=headers)
+        assert headers[tracing.TRACEPARENT_HEADER] == web_span.traceparent
+        task = SimpleNamespace(name='create_cluster', request=SimpleNamespace(traceparent=headers[tracing.TRACEPARENT_HEADER]))
+        tracing.on_task_prerun(task_id='task-1', task=task)
+        with tracing.span('cloudcli_server_request', path='/service/server'):
+            pass
+        try:
+            with tracing.span('ssh', node='test-cluster-controlplane-1'):
+                raise Exception('ssh failed')
+        except Exception:
+            pass
+        tracing.on_task_postrun(task_id='task-1', state='SUCCESS')
+        assert tracing.get_current_traceparent() is None
+        spans = read_spans(filename)
+    assert spans.keys() == {'POST /k8s/create_cluster', 'celery.task/create_cluster', 'cloudcli_server_request', 'ssh'}
+    assert len({span['traceId'] for span in spans.values()}) == 1
+    assert 'parentId' not in spans['POST /k8s/create_cluster']
+    assert spans['celery.task/create_cluster']['parentId'] == spans['POST /k8s/create_cluster']['id']
+    assert spans['cloudcli_server_request']['parentId'] == spans['celery.task/create_cluster']['id']
+    assert spans['ssh']['parentId'] == spans['celery.task/create_cluster']['id']
+    assert spans['ssh']['tags'] == {'node': 'test-cluster-controlplane-1', 'error': 'Exception'}
+    assert spans['celery.task/create_cluster']['tags'] == {'task_id': 'task-1', 'state': 'SUCCESS'}
+
+
+def test_span_disabled():
+    headers = {}
+    with tracing.span('test') as span:
+        span.set_tag('key', 'value')
+        tracing.on_before_task_publish(headers=headers)
+    assert headers == {}
@@ -0,0 +1,115 @@
+import re
+import json
+
+import pytest
+
+from cloudcli_server_kubernetes import config
+from cloudcli_server_kubernetes.lib import cloudcli, warmpool
+from cloudcli_server_kubernetes.lib.cluster import Cluster
+from cloudcli_server_kubernetes.lib.nodepool import NodePool
+
+
+def get_cnf(make_cnf, warm_pool_size=2):
+    return make_cnf(
+        'test-warm',
+        {'worker1': {'nodes': 3}, 'worker2': {'nodes': 1}},
+        {'warm-pool': {'size': warm_pool_size, 'node-pool': 'worker1'}} if warm_pool_size else None,
+    )
+
+
+def test_warm_pool(monkeypatch, make_cnf, sqlite_db):
+    servers = {}
+
+    def mock_create_server(self, server_name_prefix, init_script=None):
+        assert init_script and 'rke2-preinstalled' in init_script
+        servers[server_name_prefix] = {'name': f'{server_name_prefix}-abc'}
+
+    def mock_rename_server(creds, name, new_name):
+        server_name_prefix = [prefix for prefix, server in servers.items() if server['name'] == name][0]
+        # the random suffix of the server name may contain dashes
+        servers[re.match(r'^(test-warm-worker1-\d+)-', new_name).group(1)] = {'name': new_name}
+        del servers[server_name_prefix]
+
+    monkeypatch.setattr(NodePool, 'create_server', mock_create_server)
+    monkeypatch.setattr(cloudcli, 'rename_server', mock_rename_server)
+    monkeypatch.setattr(cloudcli, 'get_server_info', lambda creds, name_startswith: servers.get(name_startswith))
+    cluster = Cluster.init_from_cnf_creds(json.dumps(get_cnf(make_cnf)), ('aaa', 'bbb'))
+    assert warmpool.reserve_slots(cluster) == [1, 2]
+    assert warmpool.reserve_slots(cluster) == []
+    # nothing to claim until the servers are created
+    assert warmpool.claim(cluster.node_pools['worker1'].get_node(1)) is None
+    for slot in [1, 2]:
+        warmpool.create_server(cluster, slot)
+    assert [s['status'] for s in warmpool.get_warm_servers(cluster)] == ['ready', 'ready']
+    assert warmpool.claim(cluster.node_pools['worker2'].get_node(1)) is None
+    assert warmpool.claim(cluster.node_pools['worker1'].get_node(1))['name'].startswith('test-warm-worker1-1-')
+    assert warmpool.claim(cluster.node_pools['worker1'].get_node(2))['name'].startswith('test-warm-worker1-2-')
+    assert warmpool.claim(cluster.node_pools['worker1'].get_node(3)) is None
+    assert sorted(servers) == ['test-warm-worker1-1', 'test-warm-worker1-2']
+    assert warmpool.reserve_slots(cluster) == [1, 2]
+
+
+def test_warm_pool_terminate(monkeypatch, make_cnf, sqlite_db):
+    servers, terminated = {}, []
+
+    def mock_create_server(self, server_name_prefix, init_script=None):
+        servers[server_name_prefix] = {'name': f'{server_name_prefix}-abc'}
+        if state['fail_create']:
+            raise cloudcli.CloudcliApiException('Create server failed')
+
+    def mock_terminate_server(creds, name):
+        terminated.append(name)
+        del servers[name[:-len('-abc')]]
+
+    state = {'fail_create': True}
+    monkeypatch.setattr(NodePool, 'create_server', mock_create_server)
+    monkeypatch.setattr(cloudcli, 'terminate_server', mock_terminate_server)
+    monkeypatch.setattr(cloudcli, 'get_server_info', lambda creds, name_startswith: servers.get(name_startswith))
+    cluster = Cluster.init_from_cnf_creds(json.dumps(get_cnf(make_cnf)), ('aaa', 'bbb'))
+    assert warmpool.reserve_slots(cluster) == [1, 2]
+    # a server which failed to be created is terminated and its slot is freed
+    with pytest.raises(cloudcli.CloudcliApiException):
+        warmpool.create_server(cluster, 1)
+    assert len(terminated) == 1 and not servers
+    assert [s['slot'] for s in warmpool.get_warm_servers(cluster)] == [2]
+    state['fail_create'] = False
+    assert warmpool.reserve_slots(cluster) == [1]
+    warmpool.create_server(cluster, 1)
+    warmpool.create_server(cluster, 2)
+    # a stale claimed server is terminated
+    warmpool.set_status(cluster, 1, 'claimed', 'ready')
+    monkeypatch.setattr(config, 'WARM_POOL_STALE_SECONDS', -1)
+    assert warmpool.reserve_slots(cluster) == [1]
+    assert len(terminated) == 2 and len(servers) == 1
+    warmpool.create_server(cluster, 1)
+    # servers above the warm pool size are terminated, all of them when the warm pool is disabled
+    assert warmpool.trim_slots(Cluster.init_from_cnf_creds(json.dumps(get_cnf(make_cnf, 1)), ('aaa', 'bbb'))) == [2]
+    assert warmpool.trim_slots(Cluster.init_from_cnf_creds(json.dumps(get_cnf(make_cnf, None)), ('aaa', 'bbb'))) == [1]
+    assert len(terminated) == 4 and not servers
+    assert warmpool.get_warm_servers(cluster) == []
+
+
+def test_warm_pool_terminate_error(monkeypatch, make_cnf, sqlite_db):
+    requests = []
+
+    def mock_cloudcli_server_request(path, creds, **kwargs):
+        requests.append(path)
+        if path == '/service/server/terminate':
+            return 200, [123]
+        elif path == '/service/queue?id=123':
+            return 200, [{'status': 'error'}]
+        raise Exception(f'Unexpected request {path}')
+
+    monkeypatch.setattr(cloudcli, 'cloudcli_server_request', mock_cloudcli_server_request)
+    monkeypatch.setattr(cloudcli, 'get_server_info', lambda creds, name_startswith: {'name': f'{name_startswith}-abc'})
+    monkeypatch.setattr(config, 'KAMATERA_COMMAND_POLL_SECONDS', 0)
+    monkeypatch.setattr(config, 'WARM_POOL_STALE_SECONDS', -1)
+    cluster = Cluster.init_from_cnf_creds(json.dumps(get_cnf(make_cnf)), ('aaa', 'bbb'))
+    assert warmpool.reserve_slots(cluster) == [1, 2]
+    # the stale slots are not freed because the terminate command failed
+    assert warmpool.reserve_slots(cluster) == []
+    assert requests.count('/service/server/terminate') == 2
+    assert [s['slot'] for s in warmpool.get_warm_servers(cluster)] == [1, 2]
+    with pytest.raises(cloudcli.CloudcliApiException, match='Terminate server failed: error'):
+        warmpool.free_slot(cluster, warmpool.get_warm_servers(cluster)[0])
+    assert [s['slot'] for s in warmpool.get_warm_servers(cluster)] == [1, 2]